@@ -94,8 +94,7 @@ def train(args):
     #   Load data                                                                                     #
     ###################################################################################################
 
-    cp_emb = [np.load(path) for path in args.ent_emb_paths]
-    cp_emb = torch.tensor(np.concatenate(cp_emb, 1))
+    cp_emb = load_concept_embeddings(args.ent_emb_paths, mmap=args.ent_emb_mmap and args.freeze_ent_emb, dtype=args.ent_emb_dtype)
 
     concept_num, concept_dim = cp_emb.size(0), cp_emb.size(1)
     print('num_concepts: {}, concept_dim: {}'.format(concept_num, concept_dim))
@@ -127,8 +127,7 @@ def train(args):
     else:
         use_contextualized = False
     print("Embeddings", args.ent_emb_paths)
-    cp_emb = [np.load(path) for path in args.ent_emb_paths]
-    cp_emb = torch.tensor(np.concatenate(cp_emb, 1), dtype=torch.float)
+    cp_emb = load_concept_embeddings(args.ent_emb_paths, mmap=args.ent_emb_mmap and args.freeze_ent_emb, dtype=args.ent_emb_dtype)
 
     concept_num, concept_dim = cp_emb.size(0), cp_emb.size(1)
     print('| num_concepts: {} |'.format(concept_num))
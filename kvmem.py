@@ -44,6 +44,7 @@ def main():
     parser.add_argument('--decoder_num_layers', default=2, type=int)
     parser.add_argument('--decoder_bidirectional', default=True, type=bool_flag, nargs='?', const=True)
     parser.add_argument('--cpt_out_dim', type=int, default=300, help='num of dimension for concepts in processing')
+    parser.add_argument('--triple_cache_size', type=int, default=100000, help='number of triple encodings cached across eval batches (0 = no cache)')
     parser.add_argument('--subsample', default=1.0, type=float)
 
     # regularization
@@ -122,9 +123,8 @@ def train(args):
     #   Load data                                                                                     #
     ###################################################################################################
 
-    cp_emb, rel_emb = [np.load(path) for path in args.ent_emb_paths], np.load(args.rel_emb_path)
-    cp_emb = np.concatenate(cp_emb, axis=1)
-    cp_emb = torch.tensor(cp_emb)
+    cp_emb = load_concept_embeddings(args.ent_emb_paths, mmap=args.ent_emb_mmap and args.freeze_ent_emb, dtype=args.ent_emb_dtype)
+    rel_emb = np.load(args.rel_emb_path)
 
     concept_num, concept_dim = cp_emb.size(0), cp_emb.size(1)
     print('num_concepts: {}, concept_dim: {}'.format(concept_num, concept_dim))
@@ -159,7 +159,7 @@ def train(args):
                       decoder_num_layers=args.decoder_num_layers, decoder_bidirectional=args.decoder_bidirectional,
                       decoder_input_p=args.d_dropouti, decoder_output_p=args.d_dropouto,
                       decoder_emb_p=args.d_dropoute, decoder_hidden_p=args.d_dropoutr, decoder_mlp_p=args.d_dropoutm,
-                      encoder_config=lstm_config)
+                      encoder_config=lstm_config, triple_cache_size=args.triple_cache_size)
 
         if args.freeze_ent_emb:
             freeze_net(model.decoder.concept_emb)
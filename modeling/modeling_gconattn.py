@@ -44,8 +44,8 @@ class GconAttn(nn.Module):
         q2a = masked_softmax(attn, mask, dim=-1)  # (nbz, sl, sl)
         a2q = masked_softmax(attn, mask, dim=0)  # (nbz, sl, sl)
 
-        beta = (q2a.unsqueeze(3) * a.unsqueeze(1)).sum(2)  # (nbz, sl, cpt_dim), unsqueeze dim of a, sum over dim of a
-        alpha = (a2q.unsqueeze(3) * q.unsqueeze(2)).sum(1)  # (nbz, sl, cpt_dim), unsqueeze dim of q, sum over dim of q
+        beta = torch.bmm(q2a, a)  # (nbz, sl, cpt_dim), sum over dim of a
+        alpha = torch.bmm(a2q.transpose(1, 2), q)  # (nbz, sl, cpt_dim), sum over dim of q
 
         qm = self.MLP(torch.cat((a, beta, a - beta, a * beta), dim=-1))  # (nbz, sl, out_dim)
         am = self.MLP(torch.cat((q, alpha, q - alpha, q * alpha), dim=-1))  # (nbz, sl, out_dim)
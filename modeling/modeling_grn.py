@@ -545,7 +545,7 @@ class GraphRelationNet(nn.Module):
         if init_range > 0:
             self.apply(self._init_weights)
 
-        if pretrained_concept_emb is not None and not use_contextualized:
+        if pretrained_concept_emb is not None and not use_contextualized and not isinstance(pretrained_concept_emb, MmapEmbedding):
             self.concept_emb.emb.weight.data.copy_(pretrained_concept_emb)
 
     def _init_rn(self, module):
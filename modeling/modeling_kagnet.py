@@ -1,12 +1,16 @@
+from array import array
+
 import dgl.function as fn
-import networkx as nx
 import torch.utils.data as data
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.nn import init
 
 from modeling.modeling_encoder import TextEncoder, MODEL_NAME_TO_CLASS
 from utils.data_utils import *
 from utils.layers import *
 from utils.parser_utils import *
+from utils.path_store import load_path_statements
+from utils.graph_store import GraphStore, GRAPH_STORE_EXT, is_graph_store, jsonl_to_graph_store
 
 gcn_msg = fn.copy_src(src='h', out='m')
 gcn_reduce = fn.sum(msg='m', out='h')
@@ -264,126 +268,100 @@ class KnowledgeAwareGraphNetwork(nn.Module):
         self.graph_encoder = GCNEncoder(self.concept_dim, self.graph_hidden_dim, self.graph_output_dim,
                                         pretrained_concept_emd=None, concept_emd=self.concept_emd)
 
-    def forward(self, s_vec_batched, qa_pairs_batched, cpt_paths_batched, rel_paths_batched, qa_path_num_batched, path_len_batched, graphs, concept_mapping_dicts, ana_mode=False):
+    def forward(self, s_vec_batched, qa_pairs, cpt_paths, rel_paths, qa_path_num, path_len, qa_num, graphs, concept_mapping, ana_mode=False):
+        """
+        s_vec_batched: (n_statement, sent_dim)
+        qa_pairs: (n_qa, 2), the (question concept, answer concept) pairs of all statements, grouped by statement
+        cpt_paths, rel_paths: (n_path, max_path_len), the paths of all qa pairs, grouped by qa pair
+        qa_path_num: (n_qa,), number of paths of every qa pair
+        path_len: (n_path,)
+        qa_num: (n_statement,), number of qa pairs of every statement
+        graphs: DGLGraph holding the schema graphs of all statements
+        concept_mapping: (qa_node_ids, path_node_ids), node ids in graphs of the concepts of qa_pairs and cpt_paths,
+                         graphs.number_of_nodes() for concepts missing from the schema graph of their statement
+
+        returns: (n_statement, 1)
+        """
+        qa_node_ids, path_node_ids = concept_mapping
         output_graphs = self.graph_encoder(graphs)
         new_concept_embed = torch.cat((output_graphs.ndata["h"], s_vec_batched.new_zeros((1, self.graph_output_dim))))  # len(output_concept_embeds) as padding
 
-        final_vecs = []
-
-        if ana_mode:
-            path_att_scores = []
-            qa_pair_att_scores = []
-
-        n_qa_pairs = [len(t) for t in qa_pairs_batched]
-        total_qa_pairs = sum(n_qa_pairs)
-        s_vec_expanded = s_vec_batched.new_zeros((total_qa_pairs, s_vec_batched.size(1)))
-        i = 0
-        for n, s_vec in zip(n_qa_pairs, s_vec_batched):
-            j = i + n
-            s_vec_expanded[i:j] = s_vec
-            i = j
-        qa_ids_batched = torch.cat(qa_pairs_batched, 0)  # N x 2
-        qa_vecs = self.concept_emd(qa_ids_batched).view(total_qa_pairs, -1)
-        new_qa_ids = []
-        for qa_ids, mdict in zip(qa_pairs_batched, concept_mapping_dicts):
-            id_mapping = lambda x: mdict.get(x, len(new_concept_embed) - 1)
-            new_qa_ids += [[id_mapping(q), id_mapping(a)] for q, a in qa_ids]
-        new_qa_ids = torch.tensor(new_qa_ids, device=s_vec_batched.device)
-        new_qa_vecs = new_concept_embed[new_qa_ids].view(total_qa_pairs, -1)
-        raw_qas_vecs = torch.cat((qa_vecs, new_qa_vecs, s_vec_expanded), dim=1)  # all the qas triple vectors associated with a statement
-        qas_vecs_batched = self.qas_encoder(raw_qas_vecs)
-        if self.path_attention:
-            query_vecs_batched = self.qas_pathlstm_att(qas_vecs_batched)
-        flat_cpt_paths_batched = torch.cat(cpt_paths_batched, 0)
-        mdicted_cpaths = []
-        for cpt_path in flat_cpt_paths_batched:
-            mdicted_cpaths.append([id_mapping(c) for c in cpt_path])
-        mdicted_cpaths = torch.tensor(mdicted_cpaths, device=s_vec_batched.device)
-
-        new_batched_all_qa_cpt_paths_embeds = new_concept_embed[mdicted_cpaths]
-        batched_all_qa_cpt_paths_embeds = self.concept_emd(torch.cat(cpt_paths_batched, 0))  # old concept embed
+        n_statement, n_qa = s_vec_batched.size(0), qa_pairs.size(0)
+        device = s_vec_batched.device
+        path_qa = torch.arange(n_qa, device=device).repeat_interleave(qa_path_num)  # qa pair of every path
+        # a statement without qa pairs is represented by one row of zeros and an empty path vector
+        row_num = torch.max(qa_num, qa_num.new_ones(()))
+        row_statement = torch.arange(n_statement, device=device).repeat_interleave(row_num)
+        qa_rows = (qa_num > 0)[row_statement].nonzero().view(-1)
 
-        batched_all_qa_cpt_paths_embeds = torch.cat((batched_all_qa_cpt_paths_embeds, new_batched_all_qa_cpt_paths_embeds), 2)
-
-        batched_all_qa_rel_paths_embeds = self.relation_emd(torch.cat(rel_paths_batched, 0))  # N_PATHS x D x MAX_PATH_LEN
-
-        batched_all_qa_cpt_rel_path_embeds = torch.cat((batched_all_qa_cpt_paths_embeds,
-                                                        batched_all_qa_rel_paths_embeds), 2)
+        qa_vecs = torch.cat((self.concept_emd(qa_pairs).view(n_qa, -1), new_concept_embed[qa_node_ids].view(n_qa, -1)), 1)
+        qa_vecs = s_vec_batched.new_zeros((row_statement.size(0), qa_vecs.size(1))).index_copy(0, qa_rows, qa_vecs)
+        raw_qas_vecs = torch.cat((qa_vecs, s_vec_batched[row_statement]), dim=1)  # all the qas triple vectors associated with a statement
+        qas_vecs = self.qas_encoder(raw_qas_vecs)
 
-        # if False then abiliate the LSTM
-        if True:
-            batched_lstm_outs, _ = self.lstm(batched_all_qa_cpt_rel_path_embeds)
+        batched_lstm_outs = self._encode_paths(cpt_paths, path_node_ids, rel_paths, path_len, new_concept_embed)
 
+        # pooling over all paths of every (question concept, answer concept) pair
+        if self.path_attention:
+            query_vecs = self.qas_pathlstm_att(qas_vecs[qa_rows])
+            att_scores = (batched_lstm_outs * query_vecs[path_qa]).sum(1)  # path-level attention scores
+            norm_att_scores = segment_softmax(att_scores, path_qa, n_qa)
+            pooled_path_vecs = batched_lstm_outs.new_zeros((n_qa, self.lstm_dim)).index_add(0, path_qa, batched_lstm_outs * norm_att_scores.unsqueeze(1))
         else:
-            batched_lstm_outs = s_vec.new_zeros((batched_all_qa_cpt_rel_path_embeds.size(0),
-                                                 batched_all_qa_cpt_rel_path_embeds.size(1),
-                                                 self.lstm_dim))
-        b_idx = torch.arange(batched_lstm_outs.size(0)).to(batched_lstm_outs.device)
-        batched_lstm_outs = batched_lstm_outs[b_idx, torch.cat(path_len_batched, 0) - 1, :]
-
-        qa_pair_cur_start = 0
-        path_cur_start = 0
-        # for each question-answer statement
-        for s_vec, qa_ids, cpt_paths, rel_paths, mdict, qa_path_num, path_len in zip(s_vec_batched, qa_pairs_batched, cpt_paths_batched,
-                                                                                     rel_paths_batched, concept_mapping_dicts, qa_path_num_batched,
-                                                                                     path_len_batched):  # len = batch_size * num_choices
-
-            n_qa_pairs = qa_ids.size(0)
-            qa_pair_cur_end = qa_pair_cur_start + n_qa_pairs
-
-            if n_qa_pairs == 0 or False:  # if "or True" then we can do ablation study
-                raw_qas_vecs = torch.cat([s_vec.new_zeros((self.concept_dim + self.graph_output_dim) * 2), s_vec], 0).view(1, -1)
-                qas_vecs = self.qas_encoder(raw_qas_vecs)
-                latent_rel_vecs = torch.cat((qas_vecs, s_vec.new_zeros(1, self.lstm_dim)), dim=1)
-            else:
-                pooled_path_vecs = []
-                qas_vecs = qas_vecs_batched[qa_pair_cur_start:qa_pair_cur_end]
-                for j in range(n_qa_pairs):
-                    if self.path_attention:
-                        query_vec = query_vecs_batched[qa_pair_cur_start + j]
-
-                    path_cur_end = path_cur_start + qa_path_num[j]
-
-                    # pooling over all paths for a certain (question concept, answer concept) pair
-                    blo = batched_lstm_outs[path_cur_start:path_cur_end]
-                    if self.path_attention:  # TODO: use an attention module for better readability
-                        att_scores = torch.mv(blo, query_vec)  # path-level attention scores
-                        norm_att_scores = F.softmax(att_scores, 0)
-                        att_pooled_path_vec = torch.mv(blo.t(), norm_att_scores)
-                        if ana_mode:
-                            path_att_scores.append(norm_att_scores)
-                    else:
-                        att_pooled_path_vec = blo.mean(0)
-
-                    path_cur_start = path_cur_end
-                    pooled_path_vecs.append(att_pooled_path_vec)
-
-                pooled_path_vecs = torch.stack(pooled_path_vecs, 0)
-                latent_rel_vecs = torch.cat((qas_vecs, pooled_path_vecs), 1)  # qas and KE-qas
-
-            # pooling over all (question concept, answer concept) pairs
-            if self.path_attention:
-                sent_as_query = self.sent_ltrel_att(s_vec)  # sent attend on qas
-                r_att_scores = torch.mv(qas_vecs, sent_as_query)  # qa-pair-level attention scores
-                norm_r_att_scores = F.softmax(r_att_scores, 0)
-                if ana_mode:
-                    qa_pair_att_scores.append(norm_r_att_scores)
-                final_vec = torch.mv(latent_rel_vecs.t(), norm_r_att_scores)
-            else:
-                final_vec = latent_rel_vecs.mean(0).to(s_vec.device)  # mean pooling
-            final_vecs.append(torch.cat((final_vec, s_vec), 0))
+            pooled_path_vecs = batched_lstm_outs.new_zeros((n_qa, self.lstm_dim)).index_add(0, path_qa, batched_lstm_outs)
+            pooled_path_vecs = pooled_path_vecs / qa_path_num.unsqueeze(1).float()
+        pooled_path_vecs = qas_vecs.new_zeros((qas_vecs.size(0), self.lstm_dim)).index_copy(0, qa_rows, pooled_path_vecs)
+        latent_rel_vecs = torch.cat((qas_vecs, pooled_path_vecs), 1)  # qas and KE-qas
 
-            qa_pair_cur_start = qa_pair_cur_end
+        # pooling over all (question concept, answer concept) pairs of every statement
+        if self.path_attention:
+            sent_as_query = self.sent_ltrel_att(s_vec_batched)  # sent attend on qas
+            r_att_scores = (qas_vecs * sent_as_query[row_statement]).sum(1)  # qa-pair-level attention scores
+            norm_r_att_scores = segment_softmax(r_att_scores, row_statement, n_statement)
+            final_vecs = latent_rel_vecs.new_zeros((n_statement, latent_rel_vecs.size(1))).index_add(0, row_statement, latent_rel_vecs * norm_r_att_scores.unsqueeze(1))
+        else:
+            final_vecs = latent_rel_vecs.new_zeros((n_statement, latent_rel_vecs.size(1))).index_add(0, row_statement, latent_rel_vecs)
+            final_vecs = final_vecs / row_num.unsqueeze(1).float()  # mean pooling
 
-        logits = self.hidden2output(torch.stack(final_vecs))
+        logits = self.hidden2output(torch.cat((final_vecs, s_vec_batched), 1))
         if not ana_mode:
             return logits
         else:
+            path_att_scores = list(norm_att_scores.split(qa_path_num.tolist())) if self.path_attention else []
+            qa_pair_att_scores = list(norm_r_att_scores.split(row_num.tolist())) if self.path_attention else []
             return logits, (path_att_scores, qa_pair_att_scores)
 
 
+    def _encode_paths(self, cpt_paths, path_node_ids, rel_paths, path_len, new_concept_embed):
+        """
+        run the path LSTM once per distinct path of the batch, as packed sequences without the padding
+
+        returns: (n_path, lstm_dim), the LSTM output at the last concept of every path
+        """
+        if cpt_paths.size(0) == 0:
+            return new_concept_embed.new_zeros((0, self.lstm_dim))
+        # a path is only a duplicate if it also maps to the same graph nodes, since their embeddings are part of its input
+        keys = torch.cat((cpt_paths, path_node_ids, rel_paths, path_len.unsqueeze(1)), 1)
+        keys, inverse = torch.unique(keys, dim=0, return_inverse=True)
+        max_path_len = cpt_paths.size(1)
+        cpt_paths, path_node_ids, rel_paths, path_len = keys.split([max_path_len, max_path_len, max_path_len, 1], 1)
+        path_len = path_len.view(-1)
+
+        batched_all_qa_cpt_paths_embeds = torch.cat((self.concept_emd(cpt_paths), new_concept_embed[path_node_ids]), 2)
+        batched_all_qa_rel_paths_embeds = self.relation_emd(rel_paths)  # N_PATHS x MAX_PATH_LEN x D
+        batched_all_qa_cpt_rel_path_embeds = torch.cat((batched_all_qa_cpt_paths_embeds,
+                                                        batched_all_qa_rel_paths_embeds), 2)
+
+        lstm_inputs = pack_padded_sequence(batched_all_qa_cpt_rel_path_embeds, path_len.cpu(), batch_first=True, enforce_sorted=False)
+        batched_lstm_outs, _ = self.lstm(lstm_inputs)
+        batched_lstm_outs, _ = pad_packed_sequence(batched_lstm_outs, batch_first=True)
+        b_idx = torch.arange(batched_lstm_outs.size(0)).to(batched_lstm_outs.device)
+        batched_lstm_outs = batched_lstm_outs[b_idx, path_len - 1, :]
+        return batched_lstm_outs[inverse]
+
+
 class LMKagNet(nn.Module):
-    # qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, batched_graph, concept_mapping_dicts
+    # qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, qa_num_data, batched_graph, concept_mapping
     def __init__(self, model_name, concept_dim, relation_dim, concept_num, relation_num,
                  qas_encoded_dim, pretrained_concept_emb, pretrained_relation_emb,
                  lstm_dim, lstm_layer_num, graph_hidden_dim, graph_output_dim,
@@ -409,13 +387,12 @@ class LMKagNet(nn.Module):
         returns: (batch_size, 1)
         """
         bs, nc = inputs[0].size(0), inputs[0].size(1)
-        inputs = [x.view(x.size(0) * x.size(1), *x.size()[2:]) for x in inputs[:-7]] + inputs[-7:]  # merge the batch dimension and the num_choice dimension
-        print(len(inputs))
-        *lm_inputs, qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, batched_graph, concept_mapping_dicts = inputs
-        print([len(x[0]) for x in [qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, batched_graph, concept_mapping_dicts]])
-        print([x.device for x in [qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, batched_graph, concept_mapping_dicts]])
+        inputs = [x.view(x.size(0) * x.size(1), *x.size()[2:]) for x in inputs[:-8]] + list(inputs[-8:])  # merge the batch dimension and the num_choice dimension
+        # the path data are flat over the bs * nc statements
+        *lm_inputs, qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, qa_num_data, batched_graph, concept_mapping = inputs
         sent_vecs, all_hidden_states = self.encoder(*lm_inputs, layer_id=layer_id)
-        logits, attn = self.decoder(sent_vecs.view(bs, nc, -1).to(qa_pair_data.device), qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, batched_graph, concept_mapping_dicts)
+        logits, attn = self.decoder(sent_vecs.to(qa_pair_data.device), qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data,
+                                    qa_num_data, batched_graph, concept_mapping)
         logits = logits.view(bs, nc)
         return logits, attn
 
@@ -440,11 +417,11 @@ class KagNetDataLoader(data.Dataset):
             self.test_qids, self.test_labels, *self.test_encoder_data = load_input_tensors(test_statement_path, model_type, model_name, max_seq_length, format=format)
         self.num_choice = self.train_encoder_data[0].size(1)
 
-        # self.qa_pair_data, self.cpt_path_data, self.rel_path_data, self.qa_path_num_data, self.path_len_data
-        self.train_decoder_list_data = list(self._load_paths_data(train_path_jsonl, max_path_len, use_cache))
-        self.dev_decoder_list_data = list(self._load_paths_data(dev_path_jsonl, max_path_len, use_cache))
+        # qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data
+        self.train_path_data = self._load_paths_data(train_path_jsonl, max_path_len, use_cache)
+        self.dev_path_data = self._load_paths_data(dev_path_jsonl, max_path_len, use_cache)
         if test_statement_path is not None:
-            self.test_decoder_list_data = list(self._load_paths_data(test_path_jsonl, max_path_len, use_cache))
+            self.test_path_data = self._load_paths_data(test_path_jsonl, max_path_len, use_cache)
 
         # self.nxgs
         self.train_graph_data = self._load_graphs(train_ngx_jsonl, use_cache)
@@ -463,94 +440,76 @@ class KagNetDataLoader(data.Dataset):
             assert all(len(self.test_qids) == x.size(0) for x in [self.test_labels] + self.test_encoder_data)
 
     def _load_paths_data(self, pf_jsonl, max_path_len, use_cache):  # load all qa and paths
-        # use_cache = False
-        save_file = pf_jsonl + ".pk"
+        """
+        returns: a PathTensorData with one entry per statement, cached as a packed file next to pf_jsonl
+        """
+        save_file = pf_jsonl + ".tensors.bin"
         if use_cache and os.path.exists(save_file):
-            print(f'using cached paths from {save_file}')
-            with open(save_file, 'rb') as handle:
-                qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data = pickle.load(handle)
-            return qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data
-
-        nrow = sum(1 for _ in open(pf_jsonl, 'r'))
-        qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data = [], [], [], [], []
-        with open(pf_jsonl, 'r', encoding='utf-8') as fin:
-            for line in tqdm(fin, total=nrow, desc="loading paths"):
-                s = json.loads(line)
-                qa_pairs, paths, rels, qa_path_num, path_len = [], [], [], [], []
-                for qas in s:  # iterate over all (question concept, answer concept) pairs
-                    pf_res = qas["pf_res"]
-                    if pf_res is not None:
-                        for item in pf_res:
-                            p = item["path"]
-                            r = item["rel"]
-                            q = p[0]
-                            a = p[-1]
-                            new_qa_pair = (q, a) not in qa_pairs
-                            if new_qa_pair:
-                                qa_pairs.append((q, a))
-                                qa_path_num.append(0)
-
-                            if len(p) > max_path_len and not new_qa_pair:
-                                continue  # cut off by length of concepts
-                            assert len(p) - 1 == len(r)
-                            path_len.append(len(p))
-
-                            p += [0] * (max_path_len - len(p))  # padding
-                            for i in range(len(r)):
-                                for j in range(len(r[i])):
-                                    if r[i][j] - 17 in r[i]:
-                                        r[i][j] -= 17  # to delete realtedto* and antonym*
-
-                            r = [n[0] for n in r]  # only pick the top relation while multiple ones are okay
-                            r += [0] * (max_path_len - len(r))  # padding
-                            paths.append(p)
-                            rels.append(r)
-                            qa_path_num[-1] += 1
-
-                qa_pair_data.append(torch.tensor(qa_pairs) if qa_pairs else torch.zeros((0, 2), dtype=torch.int64))
-                cpt_path_data.append(torch.tensor(paths) if paths else torch.zeros((0, max_path_len), dtype=torch.int64))
-                rel_path_data.append(torch.tensor(rels) if rels else torch.zeros((0, max_path_len), dtype=torch.int64))
-                qa_path_num_data.append(torch.tensor(qa_path_num) if qa_path_num else torch.zeros(0, dtype=torch.int64))
-                path_len_data.append(torch.tensor(path_len) if path_len else torch.zeros(0, dtype=torch.int64))
-
-        qa_pair_data = list(map(list, zip(*(iter(qa_pair_data),) * self.num_choice)))
-        cpt_path_data = list(map(list, zip(*(iter(cpt_path_data),) * self.num_choice)))
-        rel_path_data = list(map(list, zip(*(iter(rel_path_data),) * self.num_choice)))
-        qa_path_num_data = list(map(list, zip(*(iter(qa_path_num_data),) * self.num_choice)))
-        path_len_data = list(map(list, zip(*(iter(path_len_data),) * self.num_choice)))
-
-        print([x[0].size() for x in [qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data]])
-
-        with open(save_file, 'wb') as fout:
-            pickle.dump([qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data], fout)
-
-        return qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data
+            path_data, cached_max_path_len = PathTensorData.load(save_file)
+            if cached_max_path_len == max_path_len:
+                print(f'using cached paths from {save_file}')
+                return path_data
+
+        nrow, statements = load_path_statements(pf_jsonl)
+        qa_offsets, path_offsets = array('q', [0]), array('q', [0])
+        qa_pairs, paths, rels, qa_path_num, path_len = array('q'), array('q'), array('q'), array('q'), array('q')
+        for s in tqdm(statements, total=nrow, desc="loading paths"):
+            seen_qa_pairs = set()
+            for qas in s:  # iterate over all (question concept, answer concept) pairs
+                pf_res = qas["pf_res"]
+                if pf_res is not None:
+                    for item in pf_res:
+                        p = item["path"]
+                        r = item["rel"]
+                        q = p[0]
+                        a = p[-1]
+                        new_qa_pair = (q, a) not in seen_qa_pairs
+                        if new_qa_pair:
+                            seen_qa_pairs.add((q, a))
+                            qa_pairs.extend((q, a))
+                            qa_path_num.append(0)
+
+                        if len(p) > max_path_len and not new_qa_pair:
+                            continue  # cut off by length of concepts
+                        assert len(p) - 1 == len(r)
+                        path_len.append(len(p))
+
+                        p = p + [0] * (max_path_len - len(p))  # padding
+                        for i in range(len(r)):
+                            for j in range(len(r[i])):
+                                if r[i][j] - 17 in r[i]:
+                                    r[i][j] -= 17  # to delete realtedto* and antonym*
+
+                        r = [n[0] for n in r]  # only pick the top relation while multiple ones are okay
+                        r += [0] * (max_path_len - len(r))  # padding
+                        paths.extend(p)
+                        rels.extend(r)
+                        qa_path_num[-1] += 1
+            qa_offsets.append(len(qa_path_num))
+            path_offsets.append(len(path_len))
+
+        path_data = PathTensorData(*[torch.from_numpy(np.frombuffer(x, dtype=np.int64).copy()) for x in (qa_offsets, qa_pairs, qa_path_num, path_offsets)],
+                                   torch.from_numpy(np.frombuffer(paths, dtype=np.int64).reshape(-1, max_path_len).copy()),
+                                   torch.from_numpy(np.frombuffer(rels, dtype=np.int64).reshape(-1, max_path_len).copy()),
+                                   torch.from_numpy(np.frombuffer(path_len, dtype=np.int64).copy()))
+        path_data.qa_pairs = path_data.qa_pairs.view(-1, 2)
+        path_data.save(save_file)
+        print(f'path tensors saved to {save_file}')
+        print()
+        return path_data
 
     def _load_graphs(self, graph_ngx_jsonl, use_cache):
-        save_file = graph_ngx_jsonl + ".pk"
+        """
+        returns: a GraphStore of the schema graphs, graph i * num_choice + j belongs to choice j of instance i
+        """
+        if is_graph_store(graph_ngx_jsonl):
+            return GraphStore(graph_ngx_jsonl)
+        save_file = graph_ngx_jsonl + GRAPH_STORE_EXT
         if use_cache and os.path.exists(save_file):
             print(f'using cached graphs from {save_file}')
-            with open(save_file, 'rb') as fin:
-                dgs = pickle.load(fin)
-            return dgs
-
-        dgs = []
-        with open(graph_ngx_jsonl, 'r', encoding='utf-8') as fin:
-            nxgs = [line for line in fin]
-        for nxg_str in tqdm(nxgs, total=len(nxgs), desc='loading graphs'):
-            nxg = nx.node_link_graph(json.loads(nxg_str))
-            dg = dgl.DGLGraph(multigraph=True)
-            dg.from_networkx(nxg)
-            cids = [nxg.nodes[n_id]['cid'] for n_id in range(len(dg))]
-            dg.ndata.update({'cncpt_ids': torch.tensor(cids)})
-            dgs.append(dg)
-
-        dgs = list(map(list, zip(*(iter(dgs),) * self.num_choice)))
-
-        with open(save_file, 'wb') as fout:
-            pickle.dump(dgs, fout)
-
-        return dgs
+        else:
+            jsonl_to_graph_store(graph_ngx_jsonl, save_file)
+        return GraphStore(save_file)
 
     def __len__(self):
         return self.n_samples
@@ -577,20 +536,20 @@ class KagNetDataLoader(data.Dataset):
         else:
             train_indexes = torch.randperm(len(self.train_qids))
         return MultiGPUNxgDataBatchGenerator(self.device0, self.device1, self.batch_size, train_indexes, self.train_qids, self.train_labels,
-                                             tensors0=self.train_encoder_data, lists1=self.train_decoder_list_data, graph_data=self.train_graph_data)
+                                             tensors0=self.train_encoder_data, path_data=self.train_path_data, graph_data=self.train_graph_data)
 
     def train_eval(self):
         return MultiGPUNxgDataBatchGenerator(self.device0, self.device1, torch.arange(len(self.train_qids)), self.train_qids, self.train_labels,
-                                             tensors0=self.train_encoder_data, lists1=self.train_decoder_list_data, graph_data=self.train_graph_data)
+                                             tensors0=self.train_encoder_data, path_data=self.train_path_data, graph_data=self.train_graph_data)
 
     def dev(self):
         return MultiGPUNxgDataBatchGenerator(self.device0, self.device1, torch.arange(len(self.dev_qids)), self.dev_qids, self.dev_labels,
-                                             tensors0=self.dev_encoder_data, lists1=self.dev_decoder_list_data, graph_data=self.dev_graph_data)
+                                             tensors0=self.dev_encoder_data, path_data=self.dev_path_data, graph_data=self.dev_graph_data)
 
     def test(self):
         if self.is_inhouse:
             return MultiGPUNxgDataBatchGenerator(self.device0, self.device1, self.eval_batch_size, self.inhouse_test_indexes, self.train_qids, self.train_labels,
-                                                 tensors0=self.train_encoder_data, lists1=self.train_decoder_list_data, graph_data=self.train_graph_data)
+                                                 tensors0=self.train_encoder_data, path_data=self.train_path_data, graph_data=self.train_graph_data)
         else:
             return MultiGPUNxgDataBatchGenerator(self.device0, self.device1, self.eval_batch_size, torch.arange(len(self.test_qids)), self.test_qids, self.test_labels,
-                                                 tensors0=self.test_encoder_data, lists1=self.test_decoder_list_data, graph_data=self.test_graph_data)
+                                                 tensors0=self.test_encoder_data, path_data=self.test_path_data, graph_data=self.test_graph_data)
@@ -3,10 +3,73 @@ from utils.data_utils import *
 from utils.layers import *
 
 
+class TripleEncodingCache(object):
+    """
+    least-recently-used cache of triple encodings that is looked up one batch of keys at a time
+
+    The keys are kept sorted so that a batch is looked up with a single searchsorted, and the recency of an
+    entry is the number of the last lookup that used it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.slots = np.zeros(0, dtype=np.int64)  # row of self.values of every key
+        self.last_used = np.full(self.capacity, -1, dtype=np.int64)
+        self.values = None
+        self.step = 0
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def lookup(self, keys, encode):
+        """
+        keys: np.ndarray of sorted unique int64 keys, at most capacity of them
+        encode: function mapping a boolean mask over keys to the encodings of the masked keys
+
+        returns: tensor of shape (len(keys), dim)
+        """
+        assert keys.shape[0] <= self.capacity
+        self.step += 1
+        pos = np.searchsorted(self.keys, keys)
+        hit = pos < len(self)
+        hit[hit] = self.keys[pos[hit]] == keys[hit]
+        slots = np.empty(keys.shape[0], dtype=np.int64)
+        slots[hit] = self.slots[pos[hit]]
+        self.last_used[slots[hit]] = self.step
+        miss = ~hit
+        n_miss = int(miss.sum())
+        if n_miss > 0:
+            new_values = encode(miss)
+            if self.values is None:
+                self.values = new_values.new_empty((self.capacity, new_values.size(1)))
+            # free slots come first, slots used by this lookup come last
+            new_slots = np.argpartition(self.last_used, n_miss - 1)[:n_miss] if n_miss < self.capacity else np.arange(self.capacity)
+            evicted = np.zeros(self.capacity, dtype=np.bool_)
+            evicted[new_slots] = True
+            keep = ~evicted[self.slots]
+            kept_keys, kept_slots = self.keys[keep], self.slots[keep]
+            ins = np.searchsorted(kept_keys, keys[miss])
+            self.keys, self.slots = np.insert(kept_keys, ins, keys[miss]), np.insert(kept_slots, ins, new_slots)
+            self.last_used[new_slots] = self.step
+            self.values[torch.from_numpy(new_slots).to(self.values.device)] = new_values
+            slots[miss] = new_slots
+        return self.values[torch.from_numpy(slots).to(self.values.device)]
+
+
 class KVM(nn.Module):
     def __init__(self, concept_num, concept_dim, concept_in_dim, freeze_ent_emb, pretrained_concept_emb, relation_num, s_dim, num_layers, bidirectional,
-                 input_p, output_p, emb_p, hidden_p, dropoutm, mask_with_s_len, gamma=0.5):
+                 input_p, output_p, emb_p, hidden_p, dropoutm, mask_with_s_len, gamma=0.5, triple_cache_size=0):
+        """
+        triple_cache_size: int (optional, default 0) number of triple encodings kept across batches in eval mode,
+                           0 disables the cache
+        """
         super().__init__()
+        self.concept_num = concept_num
+        self.relation_num = relation_num
 
         self.concept_emb = CustomizedEmbedding(concept_num=concept_num, concept_out_dim=concept_dim, concept_in_dim=concept_in_dim,
                                                pretrained_concept_emb=pretrained_concept_emb, freeze_ent_emb=freeze_ent_emb, use_contextualized=False)
@@ -34,6 +97,34 @@ class KVM(nn.Module):
         self.hidd2out = nn.Linear(self.hidden_dim, 1)
         self.max_pool = MaxPoolLayer()
         # self.mean_pool = MeanPoolLayer()
+        self.triple_cache = TripleEncodingCache(triple_cache_size) if triple_cache_size > 0 else None
+
+    def train(self, mode=True):
+        if self.triple_cache is not None:
+            self.triple_cache.clear()
+        return super().train(mode)
+
+    def _encode_triples(self, triples):
+        """
+        encode every distinct (head, relation, tail) once
+
+        triples: (n_triple, 3)
+        returns: (n_triple, h_dim)
+        """
+        h, r, t = triples.unbind(1)
+        keys = (h * self.relation_num + r) * self.concept_num + t
+        uniq_keys, inverse = torch.unique(keys, sorted=True, return_inverse=True)
+        uniq_triples = torch.stack((uniq_keys // (self.relation_num * self.concept_num),
+                                    uniq_keys // self.concept_num % self.relation_num,
+                                    uniq_keys % self.concept_num), 1)
+        use_cache = self.triple_cache is not None and not self.training and not torch.is_grad_enabled()
+        if use_cache and uniq_keys.size(0) <= self.triple_cache.capacity:
+            def encode_misses(miss):
+                return self.triple_encoder(uniq_triples[torch.from_numpy(np.flatnonzero(miss)).to(uniq_triples.device)])
+            uniq_repr = self.triple_cache.lookup(uniq_keys.cpu().numpy(), encode_misses)
+        else:
+            uniq_repr = self.triple_encoder(uniq_triples)
+        return uniq_repr[inverse]
 
     def forward(self, t, t_num, s, s_mask):
         """
@@ -57,7 +148,10 @@ class KVM(nn.Module):
             s_mask = torch.arange(s_sl, device=t.device) >= s_mask  # (nbz, 1)
 
         mask = s_mask.unsqueeze(2) | t_mask.unsqueeze(1)  # (nbz, s_sl, t_sl)
-        t_repr = self.triple_encoder(t.view(bz * t_sl, 3)).view(bz, t_sl, -1)  # (nbz, t_sl, h_dim)
+        # padded triples get all-zero representations, they have zero attention weights
+        valid_idx = (~t_mask).view(-1).nonzero().squeeze(1)
+        valid_repr = self._encode_triples(t.view(bz * t_sl, 3).index_select(0, valid_idx))
+        t_repr = valid_repr.new_zeros((bz * t_sl, valid_repr.size(1))).index_copy(0, valid_idx, valid_repr).view(bz, t_sl, -1)  # (nbz, t_sl, h_dim)
         if self.s_dim != self.hidden_dim:
             s = self.transform(s)
 
@@ -65,7 +159,7 @@ class KVM(nn.Module):
 
         s2t = masked_softmax(attn, mask, dim=-1)  # (nbz, s_sl, t_sl)
 
-        beta = (s2t.unsqueeze(3) * t_repr.unsqueeze(1)).sum(2)  # (nbz, s_sl, h_dim), unsqueeze dim of t, sum over dim of t
+        beta = torch.bmm(s2t, t_repr)  # (nbz, s_sl, h_dim), sum over dim of t
         # if self.s_dim != self.hidden_dim:
         #     beta = self.transform(beta)
 
@@ -78,7 +172,7 @@ class KVM(nn.Module):
 class LMKVM(nn.Module):
     def __init__(self, model_name, concept_num, concept_dim, concept_in_dim, freeze_ent_emb, concept_emb, relation_num,
                  decoder_num_layers, decoder_bidirectional, decoder_input_p, decoder_output_p, decoder_emb_p, decoder_hidden_p,
-                 decoder_mlp_p, gamma, encoder_config={}):
+                 decoder_mlp_p, gamma, encoder_config={}, triple_cache_size=0):
         super().__init__()
         self.model_name = model_name
         mask_with_s_len = model_name in ('lstm',)
@@ -88,7 +182,8 @@ class LMKVM(nn.Module):
                            relation_num=relation_num,
                            s_dim=self.encoder.sent_dim, num_layers=decoder_num_layers, bidirectional=decoder_bidirectional,
                            input_p=decoder_input_p, output_p=decoder_output_p, emb_p=decoder_emb_p, hidden_p=decoder_hidden_p,
-                           dropoutm=decoder_mlp_p, gamma=gamma, mask_with_s_len=mask_with_s_len)
+                           dropoutm=decoder_mlp_p, gamma=gamma, mask_with_s_len=mask_with_s_len,
+                           triple_cache_size=triple_cache_size)
 
     def forward(self, *inputs, layer_id=-1):
         bs, nc = inputs[0].size(0), inputs[0].size(1)
@@ -169,6 +264,10 @@ class KVMDataLoader(object):
         self.concept2id = {w: i for i, w in enumerate(id2concept)}
 
     def _load_triples(self, triple_path):
+        if is_triple_store(triple_path):  # memory-mapped, rows are padded when a batch is indexed
+            store = TripleStore(triple_path)
+            triple_num = torch.from_numpy(np.minimum(store.num_triples(), self.max_triple_num)).view(-1, self.num_choice)
+            return PaddedTriples(store, self.num_choice, self.max_triple_num), triple_num
         with open(triple_path, 'rb') as fin:
             triples, mc_triple_num = pickle.load(fin)
         t = torch.full((len(triples), self.max_triple_num * 3), 0, dtype=torch.int64)
@@ -5,12 +5,18 @@ from utils.layers import *
 
 class RGCNLayer(nn.Module):
 
-    def __init__(self, n_head, n_basis, input_size, output_size, dropout=0.1, diag_decompose=False):
+    def __init__(self, n_head, n_basis, input_size, output_size, dropout=0.1, diag_decompose=False, basis_aggregate=False):
+        """
+        basis_aggregate: bool (optional, default False) if True and n_basis > 0, nodes are projected onto the n_basis
+                         basis weights and aggregated with relation adjacencies mixed by the basis coefficients,
+                         so the full (input_size, output_size * n_head) weight is never built
+        """
         super().__init__()
         self.n_head = n_head
         self.n_basis = n_basis
         self.output_size = output_size
         self.diag_decompose = diag_decompose
+        self.basis_aggregate = basis_aggregate and n_basis > 0
 
         assert input_size == output_size
 
@@ -37,11 +43,18 @@ class RGCNLayer(nn.Module):
         inputs: tensor of shape (b_sz, n_node, d)
         normalized_adj_t: tensor of shape (b_sz*n_head, n_node, n_node)
             normalized_adj_t[:, j, i] ==  1/n indicates a directed edge i --> j and in_degree(j) == n
+            or a SparseAdj whose last relation (self loops) is implicit
         """
 
         o_size, n_head, n_basis = self.output_size, self.n_head, self.n_basis
         bs, n_node, _ = inputs.size()
 
+        if self.basis_aggregate:
+            output = self._basis_aggregate(inputs, normalized_adj_t)
+            output = self.activation(output)
+            output = self.dropout(output)
+            return output
+
         if self.diag_decompose:
             output = (inputs.unsqueeze(-1) * self.w_vs).view(bs, n_node, o_size, n_head)  # b_sz x n_node x n_head x o_size
         elif n_basis == 0:
@@ -51,26 +64,69 @@ class RGCNLayer(nn.Module):
             w_vs = self.w_vs.matmul(self.w_vs_co).view(-1, o_size * n_head)
             output = inputs.matmul(w_vs).view(bs, n_node, o_size, n_head)  # b_sz x n_node x n_head x o_size
 
-        output = output.permute(0, 3, 1, 2).contiguous().view(bs * n_head, n_node, o_size)  # (b_sz*n_head) x n_node x o_size
-        output = normalized_adj_t.bmm(output).view(bs, n_head, n_node, o_size).sum(1)  # b_sz x n_node x dv
+        if isinstance(normalized_adj_t, SparseAdj):
+            output = output.view(bs * n_node, o_size, n_head)
+            src, dst = normalized_adj_t.edge_index
+            messages = output[src, :, normalized_adj_t.edge_type] * normalized_adj_t.edge_norm.unsqueeze(1)  # n_edge x o_size
+            output = output[:, :, -1].index_add(0, dst, messages).view(bs, n_node, o_size)  # b_sz x n_node x dv
+        else:
+            output = output.permute(0, 3, 1, 2).contiguous().view(bs * n_head, n_node, o_size)  # (b_sz*n_head) x n_node x o_size
+            output = normalized_adj_t.bmm(output).view(bs, n_head, n_node, o_size).sum(1)  # b_sz x n_node x dv
         output = self.activation(output)
         output = self.dropout(output)
         return output
 
+    def _basis_aggregate(self, inputs, normalized_adj_t):
+        """
+        sum_h A_h X W_h with W_h = sum_k co[k, h] V_k is computed as sum_k (sum_h co[k, h] A_h) X V_k
+
+        returns: tensor of shape (b_sz, n_node, o_size), before activation and dropout
+        """
+        o_size, n_head, n_basis = self.output_size, self.n_head, self.n_basis
+        bs, n_node, i_size = inputs.size()
+
+        if isinstance(normalized_adj_t, SparseAdj):
+            # aggregate the inputs into (b_sz*n_node*n_basis) rows with a single sparse matmul, then project once
+            src, dst = normalized_adj_t.edge_index
+            coef = self.w_vs_co.t()[normalized_adj_t.edge_type] * normalized_adj_t.edge_norm.unsqueeze(1)  # n_edge x n_basis
+            rows = (dst.unsqueeze(1) * n_basis + torch.arange(n_basis, device=dst.device)).view(-1)
+            mixed_adj = torch.sparse_coo_tensor(torch.stack((rows, src.repeat_interleave(n_basis)), 0), coef.view(-1),
+                                                (bs * n_node * n_basis, bs * n_node))
+            inputs = inputs.view(bs * n_node, i_size)
+            output = torch.sparse.mm(mixed_adj, inputs).view(bs * n_node, n_basis * i_size)
+            output = output.matmul(self.w_vs.permute(2, 0, 1).reshape(n_basis * i_size, o_size))
+            output = output + inputs.matmul(self.w_vs.matmul(self.w_vs_co[:, -1]))  # self loops
+            return output.view(bs, n_node, o_size)
+
+        output = inputs.matmul(self.w_vs.view(-1, o_size * n_basis))  # b_sz x n_node x (o_size*n_basis)
+        output = output.view(bs, n_node, o_size, n_basis).permute(0, 3, 1, 2).contiguous().view(bs * n_basis, n_node, o_size)
+        # RGCN passes a transposed view, mixing commutes with the transpose and is cheaper on the contiguous layout
+        adj = normalized_adj_t.view(bs, n_head, n_node, n_node).transpose(2, 3).reshape(bs, n_head, n_node * n_node)
+        adj_basis = self.w_vs_co.matmul(adj).view(bs * n_basis, n_node, n_node).transpose(1, 2)  # (b_sz*n_basis) x n_node x n_node
+        output = adj_basis.bmm(output)  # (b_sz*n_basis) x n_node x o_size
+        return output.view(bs, n_basis, n_node, o_size).sum(1)
+
 
 class RGCN(nn.Module):
 
-    def __init__(self, input_size, num_heads, num_basis, num_layers, dropout, diag_decompose):
+    def __init__(self, input_size, num_heads, num_basis, num_layers, dropout, diag_decompose, basis_aggregate=False):
         super().__init__()
-        self.layers = nn.ModuleList([RGCNLayer(num_heads, num_basis, input_size, input_size,
-                                               dropout, diag_decompose=diag_decompose) for l in range(num_layers + 1)])
+        self.layers = nn.ModuleList([RGCNLayer(num_heads, num_basis, input_size, input_size, dropout,
+                                               diag_decompose=diag_decompose, basis_aggregate=basis_aggregate) for l in range(num_layers + 1)])
 
     def forward(self, inputs, adj):
         """
         inputs: tensor of shape (b_sz, n_node, d)
         adj: tensor of shape (b_sz, n_head, n_node, n_node)
             we assume the identity matrix representating self loops are already added to adj
+            or a SparseAdj, which already carries the normalization
         """
+        if isinstance(adj, SparseAdj):
+            output = inputs
+            for layer in self.layers:
+                output = layer(output, adj)
+            return output
+
         bs, n_head, n_node, _ = adj.size()
 
         in_degree = torch.max(adj.sum(2), adj.new_ones(()))
@@ -88,14 +144,14 @@ class RGCNNet(nn.Module):
 
     def __init__(self, num_concepts, num_relations, num_basis, sent_dim, concept_dim, concept_in_dim, freeze_ent_emb,
                  num_gnn_layers, num_attention_heads, fc_dim, num_fc_layers, p_gnn, p_fc,
-                 pretrained_concept_emb=None, diag_decompose=False, ablation=None):
+                 pretrained_concept_emb=None, diag_decompose=False, ablation=None, basis_aggregate=False):
         super().__init__()
         self.ablation = ablation
 
         self.concept_emb = CustomizedEmbedding(concept_num=num_concepts, concept_out_dim=concept_dim, concept_in_dim=concept_in_dim,
                                                pretrained_concept_emb=pretrained_concept_emb, freeze_ent_emb=freeze_ent_emb, use_contextualized=False)
         gnn_dim = concept_dim
-        self.rgcn = RGCN(gnn_dim, num_relations, num_basis, num_gnn_layers, p_gnn, diag_decompose)
+        self.rgcn = RGCN(gnn_dim, num_relations, num_basis, num_gnn_layers, p_gnn, diag_decompose, basis_aggregate=basis_aggregate)
         self.pool_layer = MultiheadAttPoolLayer(num_attention_heads, sent_dim, gnn_dim)
         self.fc = MLP(gnn_dim + sent_dim, fc_dim, 1, num_fc_layers, p_fc, True)
 
@@ -115,7 +171,7 @@ class RGCNNet(nn.Module):
         gnn_output = self.rgcn(gnn_input, adj)
 
         adj_lengths = torch.max(adj_lengths, adj_lengths.new_ones(()))  # a temporary solution to avoid zero node
-        mask = torch.arange(concepts.size(1), device=adj.device).unsqueeze(0) >= adj_lengths.unsqueeze(1)
+        mask = torch.arange(concepts.size(1), device=concepts.device).unsqueeze(0) >= adj_lengths.unsqueeze(1)
         pooled, pool_attn = self.pool_layer(sent_vecs, gnn_output, mask)
         # pooled = sent_vecs.new_zeros((sent_vecs.size(0), self.hid2out.weight.size(1) - sent_vecs.size(1)))
         logits = self.fc(torch.cat((pooled, sent_vecs), 1))
@@ -125,14 +181,15 @@ class RGCNNet(nn.Module):
 class LMRGCN(nn.Module):
     def __init__(self, model_name, num_concepts, num_relations, num_basis, concept_dim, concept_in_dim, freeze_ent_emb,
                  num_gnn_layers, num_attention_heads, fc_dim, num_fc_layers, p_gnn, p_fc,
-                 pretrained_concept_emb=None, diag_decompose=False, ablation=None, encoder_config={}):
+                 pretrained_concept_emb=None, diag_decompose=False, ablation=None, encoder_config={}, basis_aggregate=False):
         super().__init__()
         self.ablation = ablation
         self.model_name = model_name
         self.encoder = TextEncoder(model_name, **encoder_config)
         self.decoder = RGCNNet(num_concepts, num_relations, num_basis, self.encoder.sent_dim, concept_dim, concept_in_dim, freeze_ent_emb,
                                num_gnn_layers, num_attention_heads, fc_dim, num_fc_layers, p_gnn, p_fc,
-                               pretrained_concept_emb=pretrained_concept_emb, diag_decompose=diag_decompose, ablation=ablation)
+                               pretrained_concept_emb=pretrained_concept_emb, diag_decompose=diag_decompose, ablation=ablation,
+                               basis_aggregate=basis_aggregate)
 
     def forward(self, *inputs, layer_id=-1):
         """
@@ -145,9 +202,12 @@ class LMRGCN(nn.Module):
         returns: (batch_size, 1)
         """
         bs, nc = inputs[0].size(0), inputs[0].size(1)
+        *inputs, adj = inputs
         inputs = [x.view(x.size(0) * x.size(1), *x.size()[2:]) for x in inputs]  # merge the batch dimension and the num_choice dimension
+        if not isinstance(adj, SparseAdj):  # node ids of a SparseAdj are already numbered over both dimensions
+            adj = adj.view(bs * nc, *adj.size()[2:])
 
-        *lm_inputs, concept_ids, node_type_ids, adj_lengths, adj = inputs
+        *lm_inputs, concept_ids, node_type_ids, adj_lengths = inputs
         if 'no_lm' not in self.ablation:
             sent_vecs, _ = self.encoder(*lm_inputs, layer_id=layer_id)
         else:
@@ -163,12 +223,14 @@ class LMRGCNDataLoader(object):
                  dev_statement_path, dev_adj_path,
                  test_statement_path, test_adj_path,
                  batch_size, eval_batch_size, device, model_name, max_node_num=200, max_seq_length=128,
-                 is_inhouse=False, inhouse_train_qids_path=None, format=[]):
+                 is_inhouse=False, inhouse_train_qids_path=None, format=[], sparse_adj=False):
         super().__init__()
         self.batch_size = batch_size
         self.eval_batch_size = eval_batch_size
         self.device = device
         self.is_inhouse = is_inhouse
+        self.max_node_num = max_node_num
+        self.sparse_adj = sparse_adj
 
         model_type = MODEL_NAME_TO_CLASS[model_name]
         self.train_qids, self.train_labels, *self.train_data = load_input_tensors(train_statement_path, model_type, model_name, max_seq_length, format=format)
@@ -185,9 +247,11 @@ class LMRGCNDataLoader(object):
         assert all(len(self.train_qids) == len(self.train_adj_data) == x.size(0) for x in [self.train_labels] + self.train_data)
         assert all(len(self.dev_qids) == len(self.dev_adj_data) == x.size(0) for x in [self.dev_labels] + self.dev_data)
 
-        # pre-allocate an empty batch adj matrix
-        self.adj_empty = torch.zeros((self.batch_size, self.num_choice, n_rel, max_node_num, max_node_num), dtype=torch.float32, device=device)
-        self.eval_adj_empty = torch.zeros((self.eval_batch_size, self.num_choice, n_rel, max_node_num, max_node_num), dtype=torch.float32, device=device)
+        self.n_rel = n_rel
+        if not sparse_adj:
+            # pre-allocate an empty batch adj matrix
+            self.adj_empty = torch.zeros((self.batch_size, self.num_choice, n_rel, max_node_num, max_node_num), dtype=torch.float32, device=device)
+            self.eval_adj_empty = torch.zeros((self.eval_batch_size, self.num_choice, n_rel, max_node_num, max_node_num), dtype=torch.float32, device=device)
 
         if test_statement_path is not None:
             *test_extra_data, self.test_adj_data, n_rel = load_adj_data(test_adj_path, max_node_num, self.num_choice)
@@ -200,6 +264,14 @@ class LMRGCNDataLoader(object):
             self.inhouse_train_indexes = torch.tensor([i for i, qid in enumerate(self.train_qids) if qid in inhouse_qids])
             self.inhouse_test_indexes = torch.tensor([i for i, qid in enumerate(self.train_qids) if qid not in inhouse_qids])
 
+    def _batch_generator(self, indexes, qids, labels, tensors, adj_data, train=False):
+        batch_size = self.batch_size if train else self.eval_batch_size
+        if self.sparse_adj:
+            return SparseAdjDataBatchGenerator(self.device, batch_size, indexes, qids, labels, tensors=tensors, adj_data=adj_data,
+                                               n_rel=self.n_rel, max_node_num=self.max_node_num)
+        adj_empty = self.adj_empty if train else self.eval_adj_empty
+        return AdjDataBatchGenerator(self.device, batch_size, indexes, qids, labels, tensors=tensors, adj_empty=adj_empty, adj_data=adj_data)
+
     def train_size(self):
         return self.inhouse_train_indexes.size(0) if self.is_inhouse else len(self.train_qids)
 
@@ -218,21 +290,20 @@ class LMRGCNDataLoader(object):
             train_indexes = self.inhouse_train_indexes[torch.randperm(n_train)]
         else:
             train_indexes = torch.randperm(len(self.train_qids))
-        return AdjDataBatchGenerator(self.device, self.batch_size, train_indexes, self.train_qids, self.train_labels,
-                                     tensors=self.train_data, adj_empty=self.adj_empty, adj_data=self.train_adj_data)
+        return self._batch_generator(train_indexes, self.train_qids, self.train_labels, self.train_data, self.train_adj_data, train=True)
 
     def train_eval(self):
-        return AdjDataBatchGenerator(self.device, self.eval_batch_size, torch.arange(len(self.train_qids)), self.train_qids, self.train_labels,
-                                     tensors=self.train_data, adj_empty=self.eval_adj_empty, adj_data=self.train_adj_data)
+        return self._batch_generator(torch.arange(len(self.train_qids)), self.train_qids, self.train_labels,
+                                     self.train_data, self.train_adj_data)
 
     def dev(self):
-        return AdjDataBatchGenerator(self.device, self.eval_batch_size, torch.arange(len(self.dev_qids)), self.dev_qids, self.dev_labels,
-                                     tensors=self.dev_data, adj_empty=self.eval_adj_empty, adj_data=self.dev_adj_data)
+        return self._batch_generator(torch.arange(len(self.dev_qids)), self.dev_qids, self.dev_labels,
+                                     self.dev_data, self.dev_adj_data)
 
     def test(self):
         if self.is_inhouse:
-            return AdjDataBatchGenerator(self.device, self.eval_batch_size, self.inhouse_test_indexes, self.train_qids, self.train_labels,
-                                         tensors=self.train_data, adj_empty=self.eval_adj_empty, adj_data=self.train_adj_data)
+            return self._batch_generator(self.inhouse_test_indexes, self.train_qids, self.train_labels,
+                                         self.train_data, self.train_adj_data)
         else:
-            return AdjDataBatchGenerator(self.device, self.eval_batch_size, torch.arange(len(self.test_qids)), self.test_qids, self.test_labels,
-                                         tensors=self.test_data, adj_empty=self.eval_adj_empty, adj_data=self.test_adj_data)
+            return self._batch_generator(torch.arange(len(self.test_qids)), self.test_qids, self.test_labels,
+                                         self.test_data, self.test_adj_data)
@@ -8,12 +8,18 @@ class RelationNet(nn.Module):
     def __init__(self, concept_num, concept_dim, relation_num, relation_dim, sent_dim, concept_in_dim,
                  hidden_size, num_hidden_layers, num_attention_heads, fc_size, num_fc_layers, dropout,
                  pretrained_concept_emb=None, pretrained_relation_emb=None, freeze_ent_emb=True,
-                 init_range=0, ablation=None, use_contextualized=False, emb_scale=1.0):
+                 init_range=0, ablation=None, use_contextualized=False, emb_scale=1.0, precompute_2hop_rel=False):
+        """
+        precompute_2hop_rel: bool (optional, default False) build the embeddings of all relations (1-hop and
+                             composed 2-hop) as one table and gather from it, the table is cached in eval mode
+        """
 
         super().__init__()
         self.init_range = init_range
         self.relation_num = relation_num
         self.ablation = ablation
+        self.precompute_2hop_rel = precompute_2hop_rel
+        self._rel_table_cache = None
 
         self.rel_emb = nn.Embedding(relation_num, relation_dim)
         self.concept_emb = CustomizedEmbedding(concept_num=concept_num, concept_out_dim=concept_dim,
@@ -42,7 +48,7 @@ class RelationNet(nn.Module):
         if pretrained_relation_emb is not None and ablation not in ('randomrel',):
             self.rel_emb.weight.data.copy_(pretrained_relation_emb)
 
-        if pretrained_concept_emb is not None and not use_contextualized:
+        if pretrained_concept_emb is not None and not use_contextualized and not isinstance(pretrained_concept_emb, MmapEmbedding):
             self.concept_emb.emb.weight.data.copy_(pretrained_concept_emb)
 
     def _init_weights(self, module):
@@ -54,6 +60,28 @@ class RelationNet(nn.Module):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
+    def train(self, mode=True):
+        self._rel_table_cache = None  # the weights may have been updated through .data, which the key does not see
+        return super().train(mode)
+
+    def _relation_table(self):
+        """
+        returns: tensor of shape (relation_num, relation_dim), row n_1hop_rel + r1 * n_1hop_rel + r2 is the
+                 product of the embeddings of r1 and r2
+        """
+        weight = self.rel_emb.weight
+        use_cache = not self.training and not torch.is_grad_enabled()
+        key = (weight.data_ptr(), weight._version)
+        if use_cache and self._rel_table_cache is not None and self._rel_table_cache[0] == key:
+            return self._rel_table_cache[1]
+        n_1hop_rel = int(np.sqrt(self.relation_num))
+        assert n_1hop_rel * (n_1hop_rel + 1) == self.relation_num
+        onehop = weight[:n_1hop_rel]
+        twohop = (onehop.unsqueeze(1) * onehop.unsqueeze(0)).view(n_1hop_rel * n_1hop_rel, -1)
+        table = torch.cat((onehop, twohop), 0)
+        self._rel_table_cache = (key, table) if use_cache else None
+        return table
+
     def forward(self, sent_vecs, qa_ids, rel_ids, num_tuples, emb_data=None):
         """
         sent_vecs: tensor of shape (batch_size, d_sent)
@@ -73,9 +101,13 @@ class RelationNet(nn.Module):
         mask[mask.all(1), 0] = 0  # a temporary solution for instances that have no qar-pairs
 
         qa_emb = self.concept_emb(qa_ids.view(bs, -1), emb_data).view(bs, sl, -1)
-        rel_embed = self.rel_emb(rel_ids)
 
-        if self.ablation not in ('no_factor_mul',):
+        if self.ablation in ('no_factor_mul',):
+            rel_embed = self.rel_emb(rel_ids)
+        elif self.precompute_2hop_rel:
+            rel_embed = F.embedding(rel_ids, self._relation_table())
+        else:
+            rel_embed = self.rel_emb(rel_ids)
             n_1hop_rel = int(np.sqrt(self.relation_num))
             assert n_1hop_rel * (n_1hop_rel + 1) == self.relation_num
             rel_ids = rel_ids.view(bs * sl)
@@ -118,7 +150,7 @@ class LMRelationNet(nn.Module):
                  concept_num, concept_dim, relation_num, relation_dim, concept_in_dim, hidden_size, num_hidden_layers,
                  num_attention_heads, fc_size, num_fc_layers, dropout, pretrained_concept_emb=None,
                  pretrained_relation_emb=None, freeze_ent_emb=True, init_range=0, ablation=None,
-                 use_contextualized=False, emb_scale=1.0, encoder_config={}):
+                 use_contextualized=False, emb_scale=1.0, encoder_config={}, precompute_2hop_rel=False):
         super().__init__()
         self.use_contextualized = use_contextualized
         self.encoder = TextEncoder(model_name, **encoder_config)
@@ -126,7 +158,8 @@ class LMRelationNet(nn.Module):
                                    hidden_size, num_hidden_layers, num_attention_heads,
                                    fc_size, num_fc_layers, dropout, pretrained_concept_emb, pretrained_relation_emb,
                                    freeze_ent_emb=freeze_ent_emb, init_range=init_range, ablation=ablation,
-                                   use_contextualized=use_contextualized, emb_scale=emb_scale)
+                                   use_contextualized=use_contextualized, emb_scale=emb_scale,
+                                   precompute_2hop_rel=precompute_2hop_rel)
 
     def forward(self, *inputs, layer_id=-1):
         bs, nc = inputs[0].size(0), inputs[0].size(1)
@@ -6,11 +6,11 @@ from utils.convert_scitail import convert_to_scitail_statement
 from utils.convert_phys import convert_to_phys_statement
 from utils.convert_socialiqa import convert_to_socialiqa_statement
 from utils.convert_obqa import convert_to_obqa_statement
-from utils.tokenization_utils import tokenize_statement_file, make_word_vocab
+from utils.tokenization_utils import tokenize_statement_file, make_word_vocab, EXTRA_TOKS
 from utils.conceptnet import extract_english, construct_graph
 from utils.embedding import glove2npy, load_pretrained_embeddings
 from utils.grounding import create_matcher_patterns, ground
-from utils.paths import find_paths, score_paths, prune_paths, find_relational_paths_from_paths, generate_path_and_graph_from_adj
+from utils.paths import find_paths, score_paths, prune_paths, find_and_prune_paths, find_relational_paths_from_paths, generate_path_and_graph_from_adj
 from utils.graph import generate_graph, generate_adj_data_from_grounded_concepts, coo_to_normalized
 from utils.triples import generate_triples_from_adj
 
@@ -47,6 +47,7 @@ output_paths = {
         'patterns': './data/cpnet/matcher_patterns.json',
         'unpruned-graph': './data/cpnet/conceptnet.en.unpruned.graph',
         'pruned-graph': './data/cpnet/conceptnet.en.pruned.graph',
+        'path-cache': './data/cpnet/paths.cache.db',
     },
     'glove': {
         'npy': './data/glove/glove.6B.300d.npy',
@@ -164,18 +165,40 @@ output_paths = {
 }
 
 
+def stream_path_routines(dataset_routines, dataset, args, path_cache):
+    """
+    replace the find_paths -> score_paths -> prune_paths routines of a dataset with find_and_prune_paths
+    """
+    staged = (find_paths, score_paths, prune_paths)
+    first = min(i for i, rt_dic in enumerate(dataset_routines) if rt_dic['func'] in staged)
+    fused = [{'func': find_and_prune_paths, 'args': (output_paths[dataset]['grounded'][split], output_paths['cpnet']['vocab'], output_paths['cpnet']['pruned-graph'],
+                                                     input_paths['transe']['ent'], input_paths['transe']['rel'], output_paths[dataset]['paths'][f'pruned-{split}'],
+                                                     args.path_prune_threshold, args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths,
+                                                     path_cache, 1000, output_paths[dataset]['paths'][f'pruned-{split}'] + '.hist.npz')}
+             for split in ('train', 'dev', 'test')]
+    rest = [rt_dic for rt_dic in dataset_routines if rt_dic['func'] not in staged]
+    return rest[:first] + fused + rest[first:]
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--run', default=['common', 'csqa'], choices=['common', 'csqa', 'hswag', 'anli', 'exp', 'scitail', 'phys', 'socialiqa', 'obqa', 'make_word_vocab'], nargs='+')
     parser.add_argument('--path_prune_threshold', type=float, default=0.12, help='threshold for pruning paths')
     parser.add_argument('--max_node_num', type=int, default=200, help='maximum number of nodes per graph')
     parser.add_argument('-p', '--nprocs', type=int, default=cpu_count(), help='number of processes to use')
+    parser.add_argument('--spacy_batch_size', type=int, default=1000, help='batch size of the spaCy pipe used to create matcher patterns')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
     parser.add_argument('--debug', action='store_true', help='enable debug mode')
     parser.add_argument('--kb', type=str, default="conceptnet", help='Name of the knowledge base')
     parser.add_argument('--min_path_length', type=int, default=2, help="The minimum length of a path")
     parser.add_argument('--max_path_length', type=int, default=5, help="The maximum length of a path")
     parser.add_argument('--max_num_paths', type=int, default=100, help="The maximum number of paths to consider")
+    parser.add_argument('--no_path_cache', action='store_true', help='do not read or write the (qc, ac) path cache')
+    parser.add_argument('--path_format', default='jsonl', choices=['jsonl', 'binary'], help='format of the raw/pruned/adj path files')
+    parser.add_argument('--graph_format', default='jsonl', choices=['jsonl', 'binary'], help='format of the schema graph files')
+    parser.add_argument('--adj_format', default='pickle', choices=['pickle', 'binary'], help='format of the adjacency matrix files')
+    parser.add_argument('--triple_format', default='pickle', choices=['pickle', 'binary'], help='format of the triple files')
+    parser.add_argument('--stream_paths', action='store_true', help='find, score and prune paths in a single pass without writing raw paths and scores')
 
     args = parser.parse_args()
     if args.debug:
@@ -204,16 +227,26 @@ def main():
             elif type(value) == str:
                 current[key] = value.replace("/cpnet/", "/" + args.kb + "/").replace("/csqa/", "/csqa_" + args.kb + "/").replace("/obqa/", "/obqa_" + args.kb + "/")\
                         .replace("/paths/", "/paths" + name_location + "/").replace("/graph/", "/graph" + name_location + "/").replace("/triples/", "/triples" + name_location + "/")
+                if args.path_format == 'binary' and '.paths.' in current[key] and not key.startswith('scores-'):
+                    current[key] = current[key].replace('.jsonl', '.bin')  # raw/pruned/adj paths as PathStore
+                if args.graph_format == 'binary' and '.graph.' in current[key] and current[key].endswith('.jsonl'):
+                    current[key] = current[key].replace('.jsonl', '.bin')  # schema graphs as GraphStore
+                if args.adj_format == 'binary' and current[key].endswith('.adj.pk'):
+                    current[key] = current[key].replace('.adj.pk', '.adj.coo.bin')  # adjacency matrices as AdjStore
+                if args.triple_format == 'binary' and current[key].endswith('.triples.pk'):
+                    current[key] = current[key].replace('.triples.pk', '.triples.bin')  # triples as TripleStore
                 directory = "/".join(current[key].split("/")[:-1])
                 try:
                     os.makedirs(directory)
                 except FileExistsError:
                     pass
 
+    path_cache = None if args.no_path_cache else output_paths['cpnet']['path-cache']
+
     routines = {
         'common': [
-            {'func': glove2npy, 'args': (input_paths['glove']['txt'], output_paths['glove']['npy'], output_paths['glove']['vocab'])},
-            {'func': glove2npy, 'args': (input_paths['numberbatch']['txt'], output_paths['numberbatch']['npy'], output_paths['numberbatch']['vocab'], True)},
+            {'func': glove2npy, 'args': (input_paths['glove']['txt'], output_paths['glove']['npy'], output_paths['glove']['vocab'], False, EXTRA_TOKS, 0, args.nprocs)},
+            {'func': glove2npy, 'args': (input_paths['numberbatch']['txt'], output_paths['numberbatch']['npy'], output_paths['numberbatch']['vocab'], True, EXTRA_TOKS, 0, args.nprocs)},
             {'func': extract_english, 'args': (input_paths['cpnet']['csv'], output_paths['cpnet']['csv'], output_paths['cpnet']['vocab'])},
             {'func': load_pretrained_embeddings,
              'args': (output_paths['numberbatch']['npy'], output_paths['numberbatch']['vocab'], output_paths['cpnet']['vocab'], False, output_paths['numberbatch']['concept_npy'])},
@@ -221,7 +254,7 @@ def main():
                                                output_paths['cpnet']['unpruned-graph'], False)},
             {'func': construct_graph, 'args': (output_paths['cpnet']['csv'], output_paths['cpnet']['vocab'],
                                                output_paths['cpnet']['pruned-graph'], True)},
-            {'func': create_matcher_patterns, 'args': (output_paths['cpnet']['vocab'], output_paths['cpnet']['patterns'])},
+            {'func': create_matcher_patterns, 'args': (output_paths['cpnet']['vocab'], output_paths['cpnet']['patterns'], args.nprocs, args.spacy_batch_size)},
         ],
         'csqa': [
              {'func': convert_to_entailment, 'args': (input_paths['csqa']['train'], output_paths['csqa']['statement']['train'])},
@@ -238,11 +271,11 @@ def main():
              {'func': ground, 'args': (output_paths['csqa']['statement']['test'], output_paths['cpnet']['vocab'],
                                        output_paths['cpnet']['patterns'], output_paths['csqa']['grounded']['test'], args.nprocs)},
              {'func': find_paths, 'args': (output_paths['csqa']['grounded']['train'], output_paths['cpnet']['vocab'],
-                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-train'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-train'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
              {'func': find_paths, 'args': (output_paths['csqa']['grounded']['dev'], output_paths['cpnet']['vocab'],
-                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-dev'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-dev'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
              {'func': find_paths, 'args': (output_paths['csqa']['grounded']['test'], output_paths['cpnet']['vocab'],
-                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-test'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                           output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['raw-test'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
              {'func': score_paths, 'args': (output_paths['csqa']['paths']['raw-train'], input_paths['transe']['ent'], input_paths['transe']['rel'],
                                             output_paths['cpnet']['vocab'], output_paths['csqa']['paths']['scores-train'], args.nprocs)},
              {'func': score_paths, 'args': (output_paths['csqa']['paths']['raw-dev'], input_paths['transe']['ent'], input_paths['transe']['rel'],
@@ -250,11 +283,14 @@ def main():
              {'func': score_paths, 'args': (output_paths['csqa']['paths']['raw-test'], input_paths['transe']['ent'], input_paths['transe']['rel'],
                                             output_paths['cpnet']['vocab'], output_paths['csqa']['paths']['scores-test'], args.nprocs)},
              {'func': prune_paths, 'args': (output_paths['csqa']['paths']['raw-train'], output_paths['csqa']['paths']['scores-train'],
-                                            output_paths['csqa']['paths']['pruned-train'], args.path_prune_threshold)},
+                                            output_paths['csqa']['paths']['pruned-train'], args.path_prune_threshold,
+                                            output_paths['cpnet']['vocab'])},
              {'func': prune_paths, 'args': (output_paths['csqa']['paths']['raw-dev'], output_paths['csqa']['paths']['scores-dev'],
-                                            output_paths['csqa']['paths']['pruned-dev'], args.path_prune_threshold)},
+                                            output_paths['csqa']['paths']['pruned-dev'], args.path_prune_threshold,
+                                            output_paths['cpnet']['vocab'])},
              {'func': prune_paths, 'args': (output_paths['csqa']['paths']['raw-test'], output_paths['csqa']['paths']['scores-test'],
-                                            output_paths['csqa']['paths']['pruned-test'], args.path_prune_threshold)},
+                                            output_paths['csqa']['paths']['pruned-test'], args.path_prune_threshold,
+                                            output_paths['cpnet']['vocab'])},
              {'func': generate_graph, 'args': (output_paths['csqa']['grounded']['train'], output_paths['csqa']['paths']['pruned-train'],
                                                output_paths['cpnet']['vocab'], output_paths['cpnet']['pruned-graph'],
                                                output_paths['csqa']['graph']['train'])},
@@ -271,11 +307,11 @@ def main():
              {'func': generate_adj_data_from_grounded_concepts, 'args': (output_paths['csqa']['grounded']['test'], output_paths['cpnet']['pruned-graph'],
                                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['graph']['adj-test'], args.nprocs)},
              {'func': generate_triples_from_adj, 'args': (output_paths['csqa']['graph']['adj-train'], output_paths['csqa']['grounded']['train'],
-                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['train'])},
+                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['train'], args.nprocs)},
              {'func': generate_triples_from_adj, 'args': (output_paths['csqa']['graph']['adj-dev'], output_paths['csqa']['grounded']['dev'],
-                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['dev'])},
+                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['dev'], args.nprocs)},
              {'func': generate_triples_from_adj, 'args': (output_paths['csqa']['graph']['adj-test'], output_paths['csqa']['grounded']['test'],
-                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['test'])},
+                                                          output_paths['cpnet']['vocab'], output_paths['csqa']['triple']['test'], args.nprocs)},
              {'func': generate_path_and_graph_from_adj, 'args': (output_paths['csqa']['graph']['adj-train'], output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['adj-train'], output_paths['csqa']['graph']['nxg-from-adj-train'], args.nprocs)},
             {'func': generate_path_and_graph_from_adj, 'args': (output_paths['csqa']['graph']['adj-dev'], output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['adj-dev'], output_paths['csqa']['graph']['nxg-from-adj-dev'], args.nprocs)},
             {'func': generate_path_and_graph_from_adj, 'args': (output_paths['csqa']['graph']['adj-test'], output_paths['cpnet']['pruned-graph'], output_paths['csqa']['paths']['adj-test'], output_paths['csqa']['graph']['nxg-from-adj-test'], args.nprocs)},
@@ -295,11 +331,11 @@ def main():
             {'func': ground, 'args': (output_paths['obqa']['statement']['test'], output_paths['cpnet']['vocab'],
                                       output_paths['cpnet']['patterns'], output_paths['obqa']['grounded']['test'], args.nprocs)},
             {'func': find_paths, 'args': (output_paths['obqa']['grounded']['train'], output_paths['cpnet']['vocab'],
-                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-train'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-train'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
             {'func': find_paths, 'args': (output_paths['obqa']['grounded']['dev'], output_paths['cpnet']['vocab'],
-                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-dev'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-dev'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
             {'func': find_paths, 'args': (output_paths['obqa']['grounded']['test'], output_paths['cpnet']['vocab'],
-                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-test'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths)},
+                                          output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['raw-test'], args.nprocs, args.seed, args.min_path_length, args.max_path_length, args.max_num_paths, path_cache)},
             {'func': score_paths, 'args': (output_paths['obqa']['paths']['raw-train'], input_paths['transe']['ent'], input_paths['transe']['rel'],
                                            output_paths['cpnet']['vocab'], output_paths['obqa']['paths']['scores-train'], args.nprocs)},
             {'func': score_paths, 'args': (output_paths['obqa']['paths']['raw-dev'], input_paths['transe']['ent'], input_paths['transe']['rel'],
@@ -307,11 +343,14 @@ def main():
             {'func': score_paths, 'args': (output_paths['obqa']['paths']['raw-test'], input_paths['transe']['ent'], input_paths['transe']['rel'],
                                            output_paths['cpnet']['vocab'], output_paths['obqa']['paths']['scores-test'], args.nprocs)},
             {'func': prune_paths, 'args': (output_paths['obqa']['paths']['raw-train'], output_paths['obqa']['paths']['scores-train'],
-                                           output_paths['obqa']['paths']['pruned-train'], args.path_prune_threshold)},
+                                           output_paths['obqa']['paths']['pruned-train'], args.path_prune_threshold,
+                                           output_paths['cpnet']['vocab'])},
             {'func': prune_paths, 'args': (output_paths['obqa']['paths']['raw-dev'], output_paths['obqa']['paths']['scores-dev'],
-                                           output_paths['obqa']['paths']['pruned-dev'], args.path_prune_threshold)},
+                                           output_paths['obqa']['paths']['pruned-dev'], args.path_prune_threshold,
+                                           output_paths['cpnet']['vocab'])},
             {'func': prune_paths, 'args': (output_paths['obqa']['paths']['raw-test'], output_paths['obqa']['paths']['scores-test'],
-                                           output_paths['obqa']['paths']['pruned-test'], args.path_prune_threshold)},
+                                           output_paths['obqa']['paths']['pruned-test'], args.path_prune_threshold,
+                                           output_paths['cpnet']['vocab'])},
             {'func': generate_graph, 'args': (output_paths['obqa']['grounded']['train'], output_paths['obqa']['paths']['pruned-train'],
                                               output_paths['cpnet']['vocab'], output_paths['cpnet']['pruned-graph'],
                                               output_paths['obqa']['graph']['train'])},
@@ -328,17 +367,21 @@ def main():
             {'func': generate_adj_data_from_grounded_concepts, 'args': (output_paths['obqa']['grounded']['test'], output_paths['cpnet']['pruned-graph'],
                                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['graph']['adj-test'], args.nprocs)},
             {'func': generate_triples_from_adj, 'args': (output_paths['obqa']['graph']['adj-train'], output_paths['obqa']['grounded']['train'],
-                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['train'])},
+                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['train'], args.nprocs)},
             {'func': generate_triples_from_adj, 'args': (output_paths['obqa']['graph']['adj-dev'], output_paths['obqa']['grounded']['dev'],
-                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['dev'])},
+                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['dev'], args.nprocs)},
             {'func': generate_triples_from_adj, 'args': (output_paths['obqa']['graph']['adj-test'], output_paths['obqa']['grounded']['test'],
-                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['test'])},
+                                                         output_paths['cpnet']['vocab'], output_paths['obqa']['triple']['test'], args.nprocs)},
             {'func': generate_path_and_graph_from_adj, 'args': (output_paths['obqa']['graph']['adj-train'], output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['adj-train'], output_paths['obqa']['graph']['nxg-from-adj-train'], args.nprocs)},
             {'func': generate_path_and_graph_from_adj, 'args': (output_paths['obqa']['graph']['adj-dev'], output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['adj-dev'], output_paths['obqa']['graph']['nxg-from-adj-dev'], args.nprocs)},
             {'func': generate_path_and_graph_from_adj, 'args': (output_paths['obqa']['graph']['adj-test'], output_paths['cpnet']['pruned-graph'], output_paths['obqa']['paths']['adj-test'], output_paths['obqa']['graph']['nxg-from-adj-test'], args.nprocs)},
         ],
     }
 
+    if args.stream_paths:
+        for dataset in ('csqa', 'obqa'):
+            routines[dataset] = stream_path_routines(routines[dataset], dataset, args, path_cache)
+
     for rt in args.run:
         for rt_dic in routines[rt]:
             rt_dic['func'](*rt_dic['args'])
@@ -38,12 +38,14 @@ def main():
     parser.add_argument('--ablation', default=[], choices=['no_node_type_emb', 'no_lm'], help='run ablation test')
     parser.add_argument('--diag_decompose', default=False, type=bool_flag, nargs='?', const=True, help='use diagonal decomposition')
     parser.add_argument('--num_basis', default=8, type=int, help='number of basis (0 to disable basis decomposition)')
+    parser.add_argument('--basis_aggregate', default=False, type=bool_flag, nargs='?', const=True, help='aggregate in basis space instead of building per-relation weights')
     parser.add_argument('--freeze_ent_emb', default=True, type=bool_flag, nargs='?', const=True, help='freeze entity embedding layer')
     parser.add_argument('--att_head_num', default=2, type=int, help='number of attention heads')
     parser.add_argument('--gnn_layer_num', default=2, type=int, help='number of GNN layers')
     parser.add_argument('--fc_dim', default=200, type=int, help='hidden dim of the fully-connected layers')
     parser.add_argument('--fc_layer_num', default=0, type=int, help='number of the fully-connected layers')
     parser.add_argument('--max_node_num', default=200, type=int)
+    parser.add_argument('--sparse_adj', default=False, type=bool_flag, nargs='?', const=True, help='feed the GNN relation-typed edge lists instead of dense adjacency tensors')
     parser.add_argument('--dropoutg', type=float, default=0.1, help='dropout for GNN layers')
     parser.add_argument('--dropoutf', type=float, default=0.3, help='dropout for fully-connected layers')
     parser.add_argument('--cpt_out_dim', type=int, default=100, help='num of dimension for concepts in processing')
@@ -93,8 +95,7 @@ def train(args):
     #   Load data                                                                                     #
     ###################################################################################################
 
-    cp_emb = [np.load(path) for path in args.ent_emb_paths]
-    cp_emb = torch.tensor(np.concatenate(cp_emb, axis=1))
+    cp_emb = load_concept_embeddings(args.ent_emb_paths, mmap=args.ent_emb_mmap and args.freeze_ent_emb, dtype=args.ent_emb_dtype)
 
     concept_num, concept_dim = cp_emb.size(0), cp_emb.size(1)
     print('num_concepts: {}, concept_dim: {}'.format(concept_num, concept_dim))
@@ -106,7 +107,8 @@ def train(args):
                                    test_statement_path=args.test_statements, test_adj_path=args.test_adj,
                                    batch_size=args.batch_size, eval_batch_size=args.eval_batch_size, device=device,
                                    model_name=args.encoder, max_node_num=args.max_node_num, max_seq_length=args.max_seq_len,
-                                   is_inhouse=args.inhouse, inhouse_train_qids_path=args.inhouse_train_qids, format=args.format)
+                                   is_inhouse=args.inhouse, inhouse_train_qids_path=args.inhouse_train_qids, format=args.format,
+                                   sparse_adj=args.sparse_adj)
 
         ###################################################################################################
         #   Build model                                                                                   #
@@ -117,7 +119,8 @@ def train(args):
                        concept_dim=args.cpt_out_dim, concept_in_dim=concept_dim, num_gnn_layers=args.gnn_layer_num,
                        num_attention_heads=args.att_head_num, fc_dim=args.fc_dim, num_fc_layers=args.fc_layer_num,
                        p_gnn=args.dropoutg, p_fc=args.dropoutf, freeze_ent_emb=args.freeze_ent_emb,
-                       pretrained_concept_emb=cp_emb, diag_decompose=args.diag_decompose, ablation=args.ablation, encoder_config=lstm_config)
+                       pretrained_concept_emb=cp_emb, diag_decompose=args.diag_decompose, ablation=args.ablation, encoder_config=lstm_config,
+                       basis_aggregate=args.basis_aggregate)
         if args.freeze_ent_emb:
             freeze_net(model.decoder.concept_emb)
         model.to(device)
@@ -72,6 +72,7 @@ def main():
     parser.add_argument('--freeze_ent_emb', default=True, type=bool_flag, nargs='?', const=True, help='freeze entity embedding layer')
     parser.add_argument('--init_range', default=0.02, type=float, help='stddev when initializing with normal distribution')
     parser.add_argument('--emb_scale', default=1.0, type=float, help='scale pretrained embeddings')
+    parser.add_argument('--precompute_2hop_rel', default=False, type=bool_flag, nargs='?', const=True, help='gather 2-hop relation embeddings from a precomputed table')
 
     # regularization
     parser.add_argument('--dropoutm', type=float, default=0.3, help='dropout for mlp hidden units (0 = no dropout')
@@ -134,8 +135,7 @@ def train(args):
         use_contextualized, cp_emb = True, None
     else:
         use_contextualized = False
-    cp_emb = [np.load(path) for path in args.ent_emb_paths]
-    cp_emb = torch.tensor(np.concatenate(cp_emb, 1))
+    cp_emb = load_concept_embeddings(args.ent_emb_paths, mmap=args.ent_emb_mmap and args.freeze_ent_emb, dtype=args.ent_emb_dtype)
 
     concept_num, concept_dim = cp_emb.size(0), cp_emb.size(1)
 
@@ -173,7 +173,7 @@ def train(args):
                           fc_size=args.fc_dim, num_fc_layers=args.fc_layer_num, dropout=args.dropoutm,
                           pretrained_concept_emb=cp_emb, pretrained_relation_emb=rel_emb, freeze_ent_emb=args.freeze_ent_emb,
                           init_range=args.init_range, ablation=args.ablation, use_contextualized=use_contextualized,
-                          emb_scale=args.emb_scale, encoder_config=lstm_config)
+                          emb_scale=args.emb_scale, encoder_config=lstm_config, precompute_2hop_rel=args.precompute_2hop_rel)
 
     try:
         model.to(device)
@@ -0,0 +1,154 @@
+import pickle
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+try:
+    from .packed_utils import PackedWriter, load_packed
+except ImportError:
+    from packed_utils import PackedWriter, load_packed
+
+__all__ = ['AdjStoreWriter', 'AdjStore', 'open_adj_writer', 'load_adj_concept_pairs', 'is_adj_store']
+
+ADJ_STORE_EXT = '.bin'
+
+
+def is_adj_store(path):
+    return path.endswith(ADJ_STORE_EXT)
+
+
+class AdjStoreWriter(object):
+    """
+    streaming binary replacement for the pickled lists of (adj, concepts, qmask, amask) tuples
+
+    adj is a (n_rel * n_node, n_node) coo matrix of ones, its entries are stored as relation, head and tail.
+    The store keeps
+        node_offsets, concepts, qmask, amask, edge_offsets, rel, src, dst
+    and every instance is appended to disk as soon as it is written.
+    """
+
+    def __init__(self, path, n_rel, with_masks=True):
+        """
+        n_rel: int, number of relations of the adjacency matrices
+        with_masks: bool, if False instances are (adj, concepts) pairs
+        """
+        self.n_rel = n_rel
+        self.with_masks = with_masks
+        self.writer = PackedWriter(path, {'node_offsets': np.int64, 'concepts': np.int32, 'qmask': np.bool_, 'amask': np.bool_,
+                                          'edge_offsets': np.int64, 'rel': np.int16, 'src': np.int32, 'dst': np.int32},
+                                   meta={'format': 'adj', 'version': 1, 'n_rel': n_rel, 'with_masks': with_masks})
+        self.n_node, self.n_edge = 0, 0
+        self.writer.append('node_offsets', [0])
+        self.writer.append('edge_offsets', [0])
+
+    def write(self, adj, concepts, qmask=None, amask=None):
+        n_node = len(concepts)
+        if n_node > 0 and adj.shape != (self.n_rel * n_node, n_node):
+            raise ValueError(f'expected an adjacency matrix of shape {(self.n_rel * n_node, n_node)}, got {adj.shape}')
+        rows = adj.row.astype(np.int64)
+        self.writer.append('concepts', concepts)
+        self.writer.append('qmask', qmask if self.with_masks else [])
+        self.writer.append('amask', amask if self.with_masks else [])
+        self.writer.append('rel', rows // max(n_node, 1))
+        self.writer.append('src', rows % max(n_node, 1))
+        self.writer.append('dst', adj.col)
+        self.n_node += n_node
+        self.n_edge += rows.shape[0]
+        self.writer.append('node_offsets', [self.n_node])
+        self.writer.append('edge_offsets', [self.n_edge])
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+
+class AdjStore(object):
+    """
+    memory-mapped reader of a file written by AdjStoreWriter, indexing returns the same tuples as the pickled lists
+    """
+
+    def __init__(self, path, mmap=True):
+        arrays, self.meta = load_packed(path, mmap=mmap)
+        if self.meta.get('format') != 'adj':
+            raise ValueError(f'{path} is not an adjacency store')
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.n_rel = self.meta['n_rel']
+
+    def __len__(self):
+        return self.node_offsets.shape[0] - 1
+
+    def edges(self, idx):
+        """
+        returns: (rel, src, dst) of instance idx without building the coo matrix
+        """
+        e_start, e_end = self.edge_offsets[idx:idx + 2].tolist()
+        return np.array(self.rel[e_start:e_end]), np.array(self.src[e_start:e_end]), np.array(self.dst[e_start:e_end])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        n_start, n_end = self.node_offsets[idx:idx + 2].tolist()
+        n_node = n_end - n_start
+        rel, src, dst = self.edges(idx)
+        if n_node == 0:
+            adj = coo_matrix((0, 0))
+        else:
+            adj = coo_matrix((np.ones(rel.shape[0], dtype=np.uint8), (rel.astype(np.int64) * n_node + src, dst)), shape=(self.n_rel * n_node, n_node))
+        concepts = np.array(self.concepts[n_start:n_end])
+        if not self.meta['with_masks']:
+            return adj, concepts
+        return adj, concepts, np.array(self.qmask[n_start:n_end]), np.array(self.amask[n_start:n_end])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class PickleAdjWriter(object):
+
+    def __init__(self, path, with_masks=True):
+        self.path = path
+        self.with_masks = with_masks
+        self.res = []
+
+    def write(self, adj, concepts, qmask=None, amask=None):
+        self.res.append((adj, concepts, qmask, amask) if self.with_masks else (adj, concepts))
+
+    def close(self):
+        with open(self.path, 'wb') as fout:
+            pickle.dump(self.res, fout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def open_adj_writer(path, n_rel, with_masks=True):
+    """
+    returns: an AdjStoreWriter if path ends with .bin, otherwise a writer of the pickled list format
+    """
+    if is_adj_store(path):
+        return AdjStoreWriter(path, n_rel, with_masks)
+    return PickleAdjWriter(path, with_masks)
+
+
+def load_adj_concept_pairs(path):
+    """
+    returns: a sequence of (adj, concepts, qmask, amask), an AdjStore for .bin files and a list otherwise
+    """
+    if is_adj_store(path):
+        return AdjStore(path)
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
@@ -232,27 +232,18 @@ def glove_init(input, output, concept_file):
     output_dir = '/'.join(output.split('/')[:-1])
     output_prefix = output.split('/')[-1]
 
-    words = []
-    vectors = []
+    # imported here so that loading this module does not require transformers (needed by utils.embedding)
+    if __package__:
+        from .embedding import load_vectors
+    else:
+        from embedding import load_vectors
+
     vocab_exist = check_file(vocabulary_file)
     print("loading embedding")
     with open(input, 'rb') as f:
-        for line in f:
-            fields = line.split()
-            if len(fields) <= 2:
-                continue
-            if not vocab_exist:
-                word = fields[0].decode('utf-8')
-                words.append(word)
-            vector = np.fromiter((float(x) for x in fields[1:]),
-                                 dtype=np.float)
-
-            vectors.append(vector)
-        dim = vector.shape[0]
-    print("converting")
-    matrix = np.array(vectors, dtype="float32")
-    print("writing")
-    np.save(embeddings_file, matrix)
+        has_head = len(f.readline().split()) <= 2
+    words, matrix = load_vectors(input, skip_head=has_head, output_npy_path=embeddings_file, lower=False)
+    dim = matrix.shape[1]
     text = '\n'.join(words)
     if not vocab_exist:
         with open(vocabulary_file, 'wb') as f:
@@ -265,9 +256,7 @@ def glove_init(input, output, concept_file):
 
         assert (len(vectors) == len(vocab))
 
-        glove_embeddings = {}
-        for i in range(0, len(vectors)):
-            glove_embeddings[vocab[i]] = vectors[i]
+        glove_embeddings = dict(zip(vocab, vectors))
         print("Read " + str(len(glove_embeddings)) + " glove vectors.")
         return glove_embeddings
 
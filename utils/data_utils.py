@@ -1,3 +1,4 @@
+import hashlib
 import pickle
 
 import dgl
@@ -6,6 +7,9 @@ import torch
 from transformers import (OpenAIGPTTokenizer, BertTokenizer, XLNetTokenizer, RobertaTokenizer)
 
 from utils.tokenization_utils import *
+from utils.adj_store import load_adj_concept_pairs
+from utils.packed_utils import save_packed, load_packed, gather_ranges
+from utils.triple_store import TripleStore, is_triple_store
 
 
 GPT_SPECIAL_TOKENS = ['_start_', '_delimiter_', '_classify_']
@@ -125,6 +129,100 @@ class AdjDataBatchGenerator(object):
             return obj.to(self.device)
 
 
+class SparseAdj(object):
+    """
+    relation-typed edge lists of a batch of schema graphs, replacing the dense (batch_size, num_choice, n_rel, n_node, n_node)
+    adjacency; memory scales with the number of edges, slicing along the batch dimension and .to() work like on a tensor
+
+    edge_index: LongTensor of shape (2, n_edge), head and tail of every edge; nodes are numbered
+                (batch_id * num_choice + choice_id) * n_node + node_id
+    edge_type: LongTensor of shape (n_edge,), relation of every edge, the last relation (self-loops) is implicit
+    edge_norm: FloatTensor of shape (n_edge,), 1 / (number of edges of the same relation into the tail)
+    edge_ptr: LongTensor of shape (batch_size + 1,), edges of batch entry i are edge_ptr[i]:edge_ptr[i + 1]
+    """
+
+    def __init__(self, edge_index, edge_type, edge_norm, edge_ptr, shape):
+        self.edge_index = edge_index
+        self.edge_type = edge_type
+        self.edge_norm = edge_norm
+        self.edge_ptr = edge_ptr
+        self.shape = torch.Size(shape)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError('SparseAdj only supports contiguous slices')
+        a, b, _ = item.indices(self.shape[0])
+        b = max(a, b)
+        e_a, e_b = self.edge_ptr[a].item(), self.edge_ptr[b].item()
+        nodes_per_entry = self.shape[1] * self.shape[3]
+        return SparseAdj(self.edge_index[:, e_a:e_b] - a * nodes_per_entry, self.edge_type[e_a:e_b], self.edge_norm[e_a:e_b],
+                         self.edge_ptr[a:b + 1] - e_a, (b - a, *self.shape[1:]))
+
+    def to(self, device):
+        return SparseAdj(self.edge_index.to(device), self.edge_type.to(device), self.edge_norm.to(device), self.edge_ptr, self.shape)
+
+
+class SparseAdjDataBatchGenerator(object):
+    """
+    same batches as AdjDataBatchGenerator, with the adjacency given as a SparseAdj whose in-degree normalization is precomputed
+    """
+
+    def __init__(self, device, batch_size, indexes, qids, labels, tensors=[], lists=[], adj_data=None, n_rel=None, max_node_num=None):
+        self.device = device
+        self.batch_size = batch_size
+        self.indexes = indexes
+        self.qids = qids
+        self.labels = labels
+        self.tensors = tensors
+        self.lists = lists
+        self.adj_data = adj_data
+        self.n_rel = n_rel
+        self.max_node_num = max_node_num
+
+    def __len__(self):
+        return (self.indexes.size(0) - 1) // self.batch_size + 1
+
+    def __iter__(self):
+        bs = self.batch_size
+        n = self.indexes.size(0)
+        for a in range(0, n, bs):
+            b = min(n, a + bs)
+            batch_indexes = self.indexes[a:b]
+            batch_qids = [self.qids[idx] for idx in batch_indexes]
+            batch_labels = self._to_device(self.labels[batch_indexes])
+            batch_tensors = [self._to_device(x[batch_indexes]) for x in self.tensors]
+            batch_lists = [self._to_device([x[i] for i in batch_indexes]) for x in self.lists]
+            batch_adj = self._build_sparse_adj([self.adj_data[global_id] for global_id in batch_indexes]).to(self.device)
+            yield tuple([batch_qids, batch_labels, *batch_tensors, *batch_lists, batch_adj])
+
+    def _build_sparse_adj(self, batch_adj_data):
+        n_node, n_rel = self.max_node_num, self.n_rel
+        num_choice = len(batch_adj_data[0])
+        graphs = [ijk for choices in batch_adj_data for ijk in choices]
+        graph_ids = torch.repeat_interleave(torch.arange(len(graphs)), torch.tensor([i.size(0) for i, _, _ in graphs], dtype=torch.long))
+        i, j, k = [torch.cat([g[d] for g in graphs]) for d in range(3)]
+        # edge j -r-> k is kept once, as the dense adjacency does, and sorted by graph
+        keys = torch.unique(((graph_ids * n_rel + i) * n_node + j) * n_node + k)
+        tail_keys = (keys // (n_node * n_node)) * n_node + keys % n_node  # (graph, relation, tail)
+        _, tail_inverse, in_degree = torch.unique(tail_keys, return_inverse=True, return_counts=True)
+        graph_ids, i = keys // (n_rel * n_node * n_node), (keys // (n_node * n_node)) % n_rel
+        j, k = (keys // n_node) % n_node, keys % n_node
+        edge_index = torch.stack((graph_ids * n_node + j, graph_ids * n_node + k), 0)
+        edge_norm = 1.0 / in_degree[tail_inverse].float()
+        edge_ptr = torch.zeros(len(batch_adj_data) + 1, dtype=torch.long)
+        edge_ptr[1:] = torch.cumsum(torch.bincount(graph_ids // num_choice, minlength=len(batch_adj_data)), 0)
+        return SparseAdj(edge_index, i, edge_norm, edge_ptr, (len(batch_adj_data), num_choice, n_rel, n_node, n_node))
+
+    def _to_device(self, obj):
+        if isinstance(obj, (tuple, list)):
+            return [self._to_device(item) for item in obj]
+        else:
+            return obj.to(self.device)
+
+
 class MultiGPUAdjDataBatchGenerator(object):
     """
     this version DOES NOT add the identity matrix
@@ -182,11 +280,12 @@ class MultiGPUAdjDataBatchGenerator(object):
 class MultiGPUNxgDataBatchGenerator(object):
     """
     tensors0, lists0  are on device0
-    tensors1, lists1, adj, labels  are on device1
+    tensors1, lists1, graphs, labels  are on device1
+    graph_data is a GraphStore and path_data a PathTensorData, both holding num_choice consecutive entries per instance
     """
 
     def __init__(self, device0, device1, batch_size, indexes, qids, labels,
-                 tensors0=[], lists0=[], tensors1=[], lists1=[], graph_data=None):
+                 tensors0=[], lists0=[], tensors1=[], lists1=[], graph_data=None, path_data=None):
         self.device0 = device0
         self.device1 = device1
         self.batch_size = batch_size
@@ -198,6 +297,7 @@ class MultiGPUNxgDataBatchGenerator(object):
         self.tensors1 = tensors1
         self.lists1 = lists1
         self.graph_data = graph_data
+        self.path_data = path_data
 
     def __len__(self):
         return (self.indexes.size(0) - 1) // self.batch_size + 1
@@ -213,22 +313,53 @@ class MultiGPUNxgDataBatchGenerator(object):
             batch_tensors0 = [self._to_device(x[batch_indexes], self.device0) for x in self.tensors0]
             batch_tensors1 = [self._to_device(x[batch_indexes], self.device1) for x in self.tensors1]
             batch_lists0 = [self._to_device([x[i] for i in batch_indexes], self.device0) for x in self.lists0]
-            # qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data
             batch_lists1 = [self._to_device([x[i] for i in batch_indexes], self.device1) for x in self.lists1]
+            # qa_pair_data, cpt_path_data, rel_path_data, qa_path_num_data, path_len_data, qa_num_data of all statements
+            statement_ids = self._statement_ids(batch_indexes, len(self.graph_data))
+            batch_path_data = [] if self.path_data is None else self.path_data.gather(statement_ids)
+
+            batched_graph, node_keys, node_ids = self._batch_graphs(statement_ids)
+            if self.path_data is not None:
+                qa_pairs, cpt_paths, _, qa_path_num, _, qa_num = batch_path_data
+                qa_statement = np.repeat(np.arange(statement_ids.size(0)), qa_num.numpy())
+                path_statement = np.repeat(qa_statement, qa_path_num.numpy())
+                n_node = batched_graph.number_of_nodes()
+                concept_mapping = [torch.from_numpy(_lookup_nodes(node_keys, node_ids, n_node, statement, x.numpy())).to(self.device1)
+                                   for statement, x in ((qa_statement, qa_pairs), (path_statement, cpt_paths))]
+                batch_path_data = [x.to(self.device1) for x in batch_path_data]
+            else:
+                concept_mapping = None
+
+            yield tuple([batch_qids, batch_labels, *batch_tensors0, *batch_tensors1, *batch_lists0, *batch_lists1, *batch_path_data,
+                         batched_graph, concept_mapping])
+
+    def _statement_ids(self, batch_indexes, n_statement):
+        """
+        returns: LongTensor of shape (batch_size * num_choice,), ids of the statements of all choices of the batch
+        """
+        num_choice = n_statement // len(self.qids)
+        return (torch.as_tensor(batch_indexes, dtype=torch.long).unsqueeze(1) * num_choice + torch.arange(num_choice)).view(-1)
 
-            flat_graph_data = sum(self.graph_data, [])
-            concept_mapping_dicts = []
-            acc_start = 0
-            for g in flat_graph_data:
-                concept_mapping_dict = {}
-                for index, cncpt_id in enumerate(g.ndata['cncpt_ids']):
-                    concept_mapping_dict[int(cncpt_id)] = acc_start + index
-                acc_start += len(g.nodes())
-                concept_mapping_dicts.append(concept_mapping_dict)
-            batched_graph = dgl.batch(flat_graph_data)
-            batched_graph.ndata['cncpt_ids'] = batched_graph.ndata['cncpt_ids'].to(self.device1)
+    def _batch_graphs(self, statement_ids):
+        """
+        build one DGLGraph holding the schema graphs of the given statements
 
-            yield tuple([batch_qids, batch_labels, *batch_tensors0, *batch_tensors1, *batch_lists0, *batch_lists1, batched_graph, concept_mapping_dicts])
+        returns: (batched_graph, node_keys, node_ids) where node_keys are the sorted (statement << 32 | concept id)
+                 of all nodes and node_ids their ids in batched_graph, the lookup table used by _lookup_nodes
+        """
+        cids, src, dst, node_offsets = self.graph_data.gather(statement_ids.numpy())
+        loop = src == dst  # both directions of every undirected edge, as DGLGraph.from_networkx would add them
+        batched_graph = dgl.DGLGraph(multigraph=True)
+        batched_graph.add_nodes(cids.shape[0])
+        batched_graph.add_edges(torch.from_numpy(np.concatenate((src, dst[~loop]))), torch.from_numpy(np.concatenate((dst, src[~loop]))))
+        batched_graph.ndata['cncpt_ids'] = torch.from_numpy(cids.astype(np.int64)).to(self.device1)
+
+        node_statement = np.repeat(np.arange(statement_ids.size(0), dtype=np.int64), np.diff(node_offsets))
+        node_keys = (node_statement << 32) | cids
+        node_ids = np.argsort(node_keys, kind='stable')
+        node_keys = node_keys[node_ids]
+        last = np.append(node_keys[1:] != node_keys[:-1], True)  # a concept occurring twice in a graph maps to its last node
+        return batched_graph, node_keys[last], node_ids[last]
 
     def _to_device(self, obj, device):
         if isinstance(obj, (tuple, list)):
@@ -237,6 +368,108 @@ class MultiGPUNxgDataBatchGenerator(object):
             return obj.to(device)
 
 
+def _lookup_nodes(node_keys, node_ids, n_node, statement, cids):
+    """
+    n_node: int, number of nodes of the batched graph
+    statement: np.ndarray of shape (n,)
+    cids: np.ndarray of shape (n, ...), concept ids of statement[i] in cids[i]
+
+    returns: np.ndarray of the shape of cids, node id of every concept in the batched graph, or n_node
+             (a padding index) if the concept is not in the graph of its statement
+    """
+    keys = (statement.reshape((-1,) + (1,) * (cids.ndim - 1)) << 32) | cids
+    if node_keys.shape[0] == 0:
+        return np.full_like(keys, n_node)
+    pos = np.minimum(np.searchsorted(node_keys, keys), node_keys.shape[0] - 1)
+    return np.where(node_keys[pos] == keys, node_ids[pos], n_node)
+
+
+class PathTensorData(object):
+    """
+    padded concept/relation paths of all statements as flat tensors with offsets
+
+    qa_pairs: (n_qa, 2), qa_path_num: (n_qa,)
+    cpt_paths, rel_paths: (n_path, max_path_len), path_len: (n_path,)
+    the qa pairs of statement i are qa_offsets[i]:qa_offsets[i + 1] and its paths path_offsets[i]:path_offsets[i + 1]
+    """
+
+    fields = ('qa_offsets', 'qa_pairs', 'qa_path_num', 'path_offsets', 'cpt_paths', 'rel_paths', 'path_len')
+
+    def __init__(self, qa_offsets, qa_pairs, qa_path_num, path_offsets, cpt_paths, rel_paths, path_len):
+        self.qa_offsets = qa_offsets
+        self.qa_pairs = qa_pairs
+        self.qa_path_num = qa_path_num
+        self.path_offsets = path_offsets
+        self.cpt_paths = cpt_paths
+        self.rel_paths = rel_paths
+        self.path_len = path_len
+
+    def __len__(self):
+        return self.qa_offsets.size(0) - 1
+
+    def save(self, path):
+        save_packed(path, meta={'format': 'path_tensors', 'version': 1, 'max_path_len': self.cpt_paths.size(1)},
+                    **{name: getattr(self, name).numpy() for name in self.fields})
+
+    @classmethod
+    def load(cls, path):
+        """
+        returns: (PathTensorData backed by a copy-on-write memory map of path, max_path_len it was built with)
+        """
+        arrays, meta = load_packed(path, mode='c')
+        if meta.get('format') != 'path_tensors':
+            raise ValueError(f'{path} is not a path tensor file')
+        return cls(*[torch.from_numpy(arrays[name]) for name in cls.fields]), meta['max_path_len']
+
+    def gather(self, statement_ids, device=None):
+        """
+        statement_ids: LongTensor of shape (n,)
+        device: the gathered tensors are moved to device
+
+        returns: [qa_pairs, cpt_paths, rel_paths, qa_path_num, path_len, qa_num], the fields of the n statements gathered
+                 with index_select and qa_num, the number of qa pairs of every statement
+        """
+        statement_ids = statement_ids.cpu().numpy()
+        qa_index, qa_offsets = gather_ranges(self.qa_offsets.numpy(), statement_ids)
+        path_index, _ = gather_ranges(self.path_offsets.numpy(), statement_ids)
+        qa_index, path_index, qa_num = torch.from_numpy(qa_index), torch.from_numpy(path_index), torch.from_numpy(np.diff(qa_offsets))
+        return [self.qa_pairs.index_select(0, qa_index).to(device),
+                self.cpt_paths.index_select(0, path_index).to(device),
+                self.rel_paths.index_select(0, path_index).to(device),
+                self.qa_path_num.index_select(0, qa_index).to(device),
+                self.path_len.index_select(0, path_index).to(device),
+                qa_num.to(device)]
+
+
+class PaddedTriples(object):
+    """
+    tensor-like view of a TripleStore with shape (n_question, num_choice, max_triple_num * 3)
+
+    indexing with question indices builds the padded int64 (head, rel, tail) rows of those questions only
+    """
+
+    def __init__(self, store, num_choice, max_triple_num, questions=None):
+        self.store = store
+        self.num_choice = num_choice
+        self.max_triple_num = max_triple_num
+        self.questions = np.arange(len(store) // num_choice) if questions is None else questions
+
+    def size(self, dim=None):
+        size = torch.Size((self.questions.shape[0], self.num_choice, self.max_triple_num * 3))
+        return size if dim is None else size[dim]
+
+    def __len__(self):
+        return self.questions.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PaddedTriples(self.store, self.num_choice, self.max_triple_num, self.questions[index])
+        questions = self.questions[np.asarray(index, dtype=np.int64)]
+        samples = (questions[:, None] * self.num_choice + np.arange(self.num_choice)).reshape(-1)
+        triples, _ = self.store.padded(samples, self.max_triple_num)
+        return torch.from_numpy(triples).view(questions.shape[0], self.num_choice, -1)
+
+
 def load_2hop_relational_paths_old(input_jsonl_path, max_tuple_num, num_choice=None):
     with open(input_jsonl_path, 'r') as fin:
         rpath_data = [json.loads(line) for line in fin]
@@ -270,72 +503,131 @@ def load_2hop_relational_paths_old(input_jsonl_path, max_tuple_num, num_choice=N
     return qa_data, rel_data, num_tuples
 
 
-def load_2hop_relational_paths(rpath_jsonl_path, cpt_jsonl_path=None, emb_pk_path=None,
-                               max_tuple_num=200, num_choice=None, node_feature_type=None):
-    with open(rpath_jsonl_path, 'r') as fin:
-        rpath_data = [json.loads(line) for line in fin]
+RPATH_CACHE_VERSION = 1  # bump when the tensors built by load_2hop_relational_paths change
 
-    with open(cpt_jsonl_path, 'rb') as fin:
-        adj_data = pickle.load(fin)  # (adj, concepts, qm, am)
 
-    n_samples = len(rpath_data)
-    qa_data = torch.zeros((n_samples, max_tuple_num, 2), dtype=torch.long)
-    rel_data = torch.zeros((n_samples, max_tuple_num), dtype=torch.long)
-    num_tuples = torch.zeros((n_samples,), dtype=torch.long)
+def _input_fingerprint(*paths, **params):
+    """
+    returns: a short hash of the size and modification time of every (existing) input file and of params
+    """
+    h = hashlib.sha1(str(RPATH_CACHE_VERSION).encode())
+    for path in paths:
+        if path is not None:
+            st = os.stat(path)
+            h.update(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:16]
 
-    all_masks = []
-    for i, (data, adj) in enumerate(tqdm(zip(rpath_data, adj_data), total=n_samples, desc='loading QA pairs')):
-        concept_ids = adj[1]
-        ori_cpt2idx = {c: i for (i, c) in enumerate(concept_ids)}
-        qa_mask = np.zeros(len(concept_ids), dtype=np.bool)
 
-        cur_qa = []
-        cur_rel = []
-        for dic in data['paths']:
-            if len(dic['rel']) == 1:
-                cur_qa.append([dic['qc'], dic['ac']])
-                cur_rel.append(dic['rel'][0])
-            elif len(dic['rel']) == 2:
-                cur_qa.append([dic['qc'], dic['ac']])
-                cur_rel.append(34 + dic['rel'][0] * 34 + dic['rel'][1])
-            else:
-                raise ValueError('Invalid path length')
-            qa_mask[ori_cpt2idx[dic['qc']]] = True
-            qa_mask[ori_cpt2idx[dic['ac']]] = True
-            if len(cur_qa) >= max_tuple_num:
-                break
-        assert len(cur_qa) == len(cur_rel)
-        all_masks.append(qa_mask)
+def _load_2hop_relational_tuples(rpath_jsonl_path, max_tuple_num):
+    """
+    returns: (qc, ac, rel, sample_ids, n_samples) of the first max_tuple_num tuples of every sample,
+             rel is encoded as r1 for 1-hop tuples and 34 + r1 * 34 + r2 for 2-hop tuples
+    """
+    qcs, acs, r1s, r2s, n_paths = [], [], [], [], []
+    with open(rpath_jsonl_path, 'r') as fin:
+        for line in tqdm(fin, desc='loading QA pairs'):
+            paths = json.loads(line)['paths'][:max_tuple_num]
+            n_paths.append(len(paths))
+            for dic in paths:
+                qcs.append(dic['qc'])
+                acs.append(dic['ac'])
+                rel = dic['rel']
+                if len(rel) == 1:
+                    r1s.append(rel[0])
+                    r2s.append(-1)
+                elif len(rel) == 2:
+                    r1s.append(rel[0])
+                    r2s.append(rel[1])
+                else:
+                    raise ValueError('Invalid path length')
+    r1, r2 = np.array(r1s, dtype=np.int64), np.array(r2s, dtype=np.int64)
+    rel = np.where(r2 < 0, r1, 34 + r1 * 34 + r2)
+    sample_ids = np.repeat(np.arange(len(n_paths)), n_paths)
+    return np.array(qcs, dtype=np.int64), np.array(acs, dtype=np.int64), rel, sample_ids, len(n_paths)
 
-        if len(cur_qa) > 0:
-            qa_data[i][:len(cur_qa)] = torch.tensor(cur_qa)
-            rel_data[i][:len(cur_rel)] = torch.tensor(cur_rel)
-            num_tuples[i] = (len(cur_qa) + len(cur_rel)) // 2  # code style suggested by kiwisher
 
-    if emb_pk_path is not None:  # use contexualized node features
-        with open(emb_pk_path, 'rb') as fin:
-            all_embs = pickle.load(fin)
-        assert len(all_embs) == len(all_masks) == n_samples
-        max_cpt_num = max(mask.sum() for mask in all_masks)
-        if node_feature_type in ('cls', 'mention'):
-            emb_dim = all_embs[0].shape[1] // 2
-        else:
-            emb_dim = all_embs[0].shape[1]
-        emb_data = torch.zeros((n_samples, max_cpt_num, emb_dim), dtype=torch.float)
-        for idx, (mask, embs) in enumerate(zip(all_masks, all_embs)):
-            assert not any(mask[embs.shape[0]:])
-            masked_concept_ids = adj_data[idx][1][mask]
-            masked_embs = embs[mask[:embs.shape[0]]]
-            cpt2idx = {c: i for (i, c) in enumerate(masked_concept_ids)}
-            for tuple_idx in range(num_tuples[idx].item()):
-                qa_data[idx, tuple_idx, 0] = cpt2idx[qa_data[idx, tuple_idx, 0].item()]
-                qa_data[idx, tuple_idx, 1] = cpt2idx[qa_data[idx, tuple_idx, 1].item()]
-            if node_feature_type in ('cls',):
-                masked_embs = masked_embs[:, :emb_dim]
-            elif node_feature_type in ('mention',):
-                masked_embs = masked_embs[:, emb_dim:]
-            emb_data[idx, :masked_embs.shape[0]] = torch.tensor(masked_embs)
-            assert (qa_data[idx, :num_tuples[idx]] < masked_embs.shape[0]).all()
+def _local_concept_index(adj_data, sample_ids, cids):
+    """
+    returns: (position of every cids[i] in the concept list of sample sample_ids[i], concept offsets of all samples)
+    """
+    if hasattr(adj_data, 'node_offsets'):  # AdjStore, the concepts are already flat
+        concepts, offsets = np.asarray(adj_data.concepts, dtype=np.int64), np.asarray(adj_data.node_offsets)
+    else:
+        concept_lists = [adj[1] for adj in adj_data]
+        offsets = np.zeros(len(concept_lists) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in concept_lists], out=offsets[1:])
+        concepts = np.concatenate(concept_lists).astype(np.int64) if concept_lists else np.zeros(0, dtype=np.int64)
+    concept_samples = np.repeat(np.arange(offsets.shape[0] - 1), np.diff(offsets))
+    keys = (concept_samples << 32) | concepts
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    query = (sample_ids << 32) | cids
+    pos = np.searchsorted(keys, query, side='right') - 1  # the last occurrence of a repeated concept
+    if query.shape[0] > 0 and ((pos < 0).any() or (keys[pos] != query).any()):
+        raise KeyError('a concept of a QA pair is not in the concept list of its sample')
+    return order[pos] - offsets[sample_ids], offsets
+
+
+def load_2hop_relational_paths(rpath_jsonl_path, cpt_jsonl_path=None, emb_pk_path=None,
+                               max_tuple_num=200, num_choice=None, node_feature_type=None, use_cache=True):
+    """
+    the tensors are cached in a packed file next to rpath_jsonl_path, keyed by a fingerprint of the inputs
+
+    cpt_jsonl_path: adjacency data of the samples, only read for contextualized node features (emb_pk_path)
+    """
+    fingerprint = _input_fingerprint(rpath_jsonl_path, cpt_jsonl_path if emb_pk_path is not None else None, emb_pk_path,
+                                     max_tuple_num=max_tuple_num, node_feature_type=node_feature_type)
+    cache_path = f'{rpath_jsonl_path}.{fingerprint}.tuples.bin'
+    if use_cache and os.path.exists(cache_path):
+        print(f'using cached QA pairs from {cache_path}')
+        arrays, _ = load_packed(cache_path, mode='c')
+        qa_data, rel_data, num_tuples = [torch.from_numpy(arrays[name]) for name in ('qa_data', 'rel_data', 'num_tuples')]
+        if emb_pk_path is not None:
+            emb_data = torch.from_numpy(arrays['emb_data'])
+    else:
+        qc, ac, rel, sample_ids, n_samples = _load_2hop_relational_tuples(rpath_jsonl_path, max_tuple_num)
+        num_tuples = np.bincount(sample_ids, minlength=n_samples)
+        tuple_offsets = np.cumsum(num_tuples) - num_tuples
+        tuple_idx = np.arange(sample_ids.shape[0]) - tuple_offsets[sample_ids]
+
+        if emb_pk_path is not None:  # use contexualized node features, qa ids index the concepts of the tuples
+            adj_data = load_adj_concept_pairs(cpt_jsonl_path)  # (adj, concepts, qm, am)
+            with open(emb_pk_path, 'rb') as fin:
+                all_embs = pickle.load(fin)
+            assert len(all_embs) == len(adj_data) == n_samples
+            q_pos, concept_offsets = _local_concept_index(adj_data, sample_ids, qc)
+            a_pos, _ = _local_concept_index(adj_data, sample_ids, ac)
+            mask = np.zeros(concept_offsets[-1], dtype=np.bool_)
+            mask[concept_offsets[sample_ids] + q_pos] = True
+            mask[concept_offsets[sample_ids] + a_pos] = True
+            masked_before = np.zeros(mask.shape[0] + 1, dtype=np.int64)  # number of masked concepts before every concept
+            np.cumsum(mask, out=masked_before[1:])
+            qc = masked_before[concept_offsets[sample_ids] + q_pos] - masked_before[concept_offsets[sample_ids]]
+            ac = masked_before[concept_offsets[sample_ids] + a_pos] - masked_before[concept_offsets[sample_ids]]
+            num_masked = np.diff(masked_before[concept_offsets])
+
+            emb_dim = all_embs[0].shape[1] // 2 if node_feature_type in ('cls', 'mention') else all_embs[0].shape[1]
+            emb_slice = slice(emb_dim, None) if node_feature_type in ('mention',) else slice(0, emb_dim)
+            emb_data = np.zeros((n_samples, num_masked.max() if n_samples > 0 else 0, emb_dim), dtype=np.float32)
+            for idx, embs in enumerate(all_embs):
+                sample_mask = mask[concept_offsets[idx]:concept_offsets[idx + 1]]
+                assert not any(sample_mask[embs.shape[0]:])
+                emb_data[idx, :num_masked[idx]] = embs[sample_mask[:embs.shape[0]], emb_slice]
+
+        qa_data = np.zeros((n_samples, max_tuple_num, 2), dtype=np.int64)
+        rel_data = np.zeros((n_samples, max_tuple_num), dtype=np.int64)
+        qa_data[sample_ids, tuple_idx, 0] = qc
+        qa_data[sample_ids, tuple_idx, 1] = ac
+        rel_data[sample_ids, tuple_idx] = rel
+        arrays = {'qa_data': qa_data, 'rel_data': rel_data, 'num_tuples': num_tuples.astype(np.int64)}
+        if emb_pk_path is not None:
+            arrays['emb_data'] = emb_data
+        save_packed(cache_path, meta={'format': 'rpath_tensors', 'version': RPATH_CACHE_VERSION}, **arrays)
+        print(f'QA pair tensors saved to {cache_path}')
+        qa_data, rel_data, num_tuples = torch.from_numpy(qa_data), torch.from_numpy(rel_data), torch.from_numpy(arrays['num_tuples'])
+        if emb_pk_path is not None:
+            emb_data = torch.from_numpy(emb_data)
 
     if num_choice is not None:
         qa_data = qa_data.view(-1, num_choice, max_tuple_num, 2)
@@ -378,8 +670,7 @@ def load_tokenized_statements(tokenized_path, num_choice, max_seq_len, freq_cuto
 
 
 def load_adj_data(adj_pk_path, max_node_num, num_choice, emb_pk_path=None):
-    with open(adj_pk_path, 'rb') as fin:
-        adj_concept_pairs = pickle.load(fin)
+    adj_concept_pairs = load_adj_concept_pairs(adj_pk_path)
 
     n_samples = len(adj_concept_pairs)
     adj_data = []
@@ -1,46 +1,121 @@
+import os
+import time
+from multiprocessing import Pool
+
 import numpy as np
 from tqdm import tqdm
-from utils.tokenization_utils import EXTRA_TOKS
 
-__all__ = ['glove2npy', 'load_vectors_from_npy_with_vocab', ]
+if __package__:
+    from .tokenization_utils import EXTRA_TOKS
+else:
+    from tokenization_utils import EXTRA_TOKS
 
+__all__ = ['glove2npy', 'load_vectors', 'load_vectors_from_npy_with_vocab', ]
 
-def load_vectors(path, skip_head=False, add_special_tokens=None, random_state=0):
-    vocab = []
-    vectors = None
-    nrow = sum(1 for line in open(path, 'r', encoding='utf-8'))
-    with open(path, "r", encoding="utf8") as fin:
+
+def split_lines(data):
+    """
+    returns: the non-empty lines of a chunk of bytes
+    """
+    return [line for line in data.split(b'\n') if line.strip()]
+
+
+def read_chunk(path, byte_range):
+    start, end = byte_range
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        return fin.read(end - start)
+
+
+def count_vector_lines(data):
+    path, byte_range = data
+    return len(split_lines(read_chunk(path, byte_range)))
+
+
+def parse_vector_lines(data):
+    """
+    data: (path, (start, end), dim, lower)
+    returns: (words, float32 vectors of shape (n_line, dim)) of the lines in bytes start:end of a text vector file
+    """
+    path, byte_range, dim, lower = data
+    words, values = [], []
+    for line in split_lines(read_chunk(path, byte_range)):
+        word, vec = line.rstrip().split(b' ', 1)
+        words.append(word)
+        values.append(vec)
+    vectors = np.fromstring(b' '.join(values), dtype=np.float32, sep=' ')
+    if vectors.shape[0] != len(words) * dim:
+        raise ValueError(f'expected {dim}-dimensional vectors in bytes {byte_range[0]}-{byte_range[1]} of {path}')
+    words = [w.decode('utf-8') for w in words]
+    return [w.lower() for w in words] if lower else words, vectors.reshape(len(words), dim)
+
+
+def line_aligned_ranges(path, start, chunk_bytes):
+    """
+    returns: list of (start, end) byte ranges of about chunk_bytes bytes that cover path from start and end at line ends
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as fin:
+        while start < size:
+            fin.seek(min(start + chunk_bytes, size))
+            end = min(fin.tell() + len(fin.readline()), size) if start + chunk_bytes < size else size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def load_vectors(path, skip_head=False, add_special_tokens=None, random_state=0, output_npy_path=None,
+                 num_processes=1, chunk_bytes=1 << 24, lower=True):
+    """
+    parse a GloVe / Numberbatch style text file (a word and its vector per line) in chunks of lines with a pool of workers
+
+    output_npy_path: str (optional, default None) if given, the vectors are written into a memory-mapped .npy file
+                     that is preallocated with the final shape, so the matrix is never held in memory
+    returns: (vocab, float32 vectors), the vectors of add_special_tokens are appended after the vectors of the file
+    """
+    with open(path, 'rb') as fin:
         if skip_head:
             fin.readline()
-        for i, line in tqdm(enumerate(fin), total=nrow):
-            elements = line.strip().split(" ")
-            word = elements[0].lower()
-            vec = np.array(elements[1:], dtype=float)
-            vocab.append(word)
-            if vectors is None:
-                vectors = np.zeros((nrow, len(vec)), dtype=np.float64)
-            vectors[i] = vec
+        data_start = fin.tell()
+        dim = len(fin.readline().rstrip().split(b' ')) - 1
+    ranges = line_aligned_ranges(path, data_start, chunk_bytes)
+    n_special = 0 if add_special_tokens is None else len(add_special_tokens)
+
+    with Pool(num_processes) as p:
+        counts = p.map(count_vector_lines, [(path, r) for r in ranges])
+        nrow = sum(counts)
+        if output_npy_path is not None:
+            vectors = np.lib.format.open_memmap(output_npy_path, mode='w+', dtype=np.float32, shape=(nrow + n_special, dim))
+        else:
+            vectors = np.zeros((nrow + n_special, dim), dtype=np.float32)
+        vocab = []
+        for words, vecs in tqdm(p.imap(parse_vector_lines, [(path, r, dim, lower) for r in ranges]), total=len(ranges)):
+            vectors[len(vocab):len(vocab) + len(words)] = vecs
+            vocab += words
 
     np.random.seed(random_state)
-    n_special = 0 if add_special_tokens is None else len(add_special_tokens)
-    add_vectors = np.random.normal(np.mean(vectors), np.std(vectors), size=(n_special, vectors.shape[1]))
-    vectors = np.concatenate((vectors, add_vectors), 0)
-    vocab += add_special_tokens
+    if n_special > 0:
+        mean, std = np.mean(vectors[:nrow], dtype=np.float64), np.std(vectors[:nrow], dtype=np.float64)
+        vectors[nrow:] = np.random.normal(mean, std, size=(n_special, dim))
+        vocab += add_special_tokens
+    if output_npy_path is not None:
+        vectors.flush()
     return vocab, vectors
 
 
 def glove2npy(glove_path, output_npy_path, output_vocab_path, skip_head=False,
-              add_special_tokens=EXTRA_TOKS, random_state=0):
+              add_special_tokens=EXTRA_TOKS, random_state=0, num_processes=1):
     print('binarizing GloVe embeddings...')
 
-    vocab, vectors = load_vectors(glove_path, skip_head=skip_head,
-                                  add_special_tokens=add_special_tokens, random_state=random_state)
-    np.save(output_npy_path, vectors)
+    start_time = time.time()
+    vocab, vectors = load_vectors(glove_path, skip_head=skip_head, add_special_tokens=add_special_tokens,
+                                  random_state=random_state, output_npy_path=output_npy_path, num_processes=num_processes)
     with open(output_vocab_path, "w", encoding='utf-8') as fout:
         for word in vocab:
             fout.write(word + '\n')
 
-    print(f'Binarized GloVe embeddings saved to {output_npy_path}')
+    print(f'Binarized GloVe embeddings saved to {output_npy_path} ({vectors.shape[0]} x {vectors.shape[1]}, {time.time() - start_time:.2f}s)')
     print(f'GloVe vocab saved to {output_vocab_path}')
     print()
 
@@ -48,14 +123,12 @@ def glove2npy(glove_path, output_npy_path, output_vocab_path, skip_head=False,
 def load_vectors_from_npy_with_vocab(glove_npy_path, glove_vocab_path, vocab, verbose=True, save_path=None):
     with open(glove_vocab_path, 'r') as fin:
         glove_w2idx = {line.strip(): i for i, line in enumerate(fin)}
-    glove_emb = np.load(glove_npy_path)
-    vectors = np.zeros((len(vocab), glove_emb.shape[1]), dtype=float)
-    oov_cnt = 0
-    for i, word in enumerate(vocab):
-        if word in glove_w2idx:
-            vectors[i] = glove_emb[glove_w2idx[word]]
-        else:
-            oov_cnt += 1
+    glove_emb = np.load(glove_npy_path, mmap_mode='r')
+    glove_idx = np.array([glove_w2idx.get(word, -1) for word in vocab], dtype=np.int64)
+    found = glove_idx >= 0
+    vectors = np.zeros((len(vocab), glove_emb.shape[1]), dtype=glove_emb.dtype)
+    vectors[found] = glove_emb[glove_idx[found]]
+    oov_cnt = len(vocab) - int(found.sum())
     if verbose:
         print(len(vocab))
         print('embedding oov rate: {:.4f}'.format(oov_cnt / len(vocab)))
@@ -10,6 +10,10 @@ try:
     from .utils import check_path
 except:
     from utils import check_path
+try:
+    from .adj_store import load_adj_concept_pairs
+except ImportError:
+    from adj_store import load_adj_concept_pairs
 
 id2concept = None
 
@@ -63,8 +67,7 @@ def extract_bert_node_features_from_adj(cpnet_vocab_path, statement_path, adj_pa
         print('Loaded')
     else:
 
-        with open(adj_path, 'rb') as fin:
-            adj_data = pickle.load(fin)
+        adj_data = list(load_adj_concept_pairs(adj_path))
 
         offsets = [0]
         all_input_ids, all_input_mask, all_segment_ids, all_span = [], [], [], []
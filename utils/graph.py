@@ -5,11 +5,13 @@ import json
 from tqdm import tqdm
 from .conceptnet import merged_relations
 import numpy as np
-from scipy import sparse
-import pickle
+import time
 from scipy.sparse import csr_matrix, coo_matrix
 from multiprocessing import Pool
 from .maths import *
+from .path_store import load_path_statements
+from .graph_store import open_graph_writer, load_graphs
+from .adj_store import open_adj_writer, load_adj_concept_pairs
 
 __all__ = ['generate_graph']
 
@@ -21,10 +23,14 @@ id2relation = None
 cpnet = None
 cpnet_all = None
 cpnet_simple = None
+cpnet_simple_keys = None  # sorted u * n_node + v of both directions of every cpnet_simple edge
+cpnet_rel_index = None  # (indptr, indices, relmask) of cpnet, see build_relation_index
+cpnet_all_rel_index = None  # the same index of cpnet_all
 
 
 RELATED_TO = merged_relations.index("relatedto")
 INV_RELATED_TO = RELATED_TO + len(merged_relations)
+CPNET_KEY_BASE = 1 << 31  # larger than any concept id
 
 
 def load_resources(cpnet_vocab_path):
@@ -39,7 +45,7 @@ def load_resources(cpnet_vocab_path):
 
 
 def load_cpnet(cpnet_graph_path):
-    global cpnet, cpnet_simple
+    global cpnet, cpnet_simple, cpnet_simple_keys, cpnet_rel_index
     cpnet = nx.read_gpickle(cpnet_graph_path)
     cpnet_simple = nx.Graph()
     for u, v, data in cpnet.edges(data=True):
@@ -48,86 +54,143 @@ def load_cpnet(cpnet_graph_path):
             cpnet_simple[u][v]['weight'] += w
         else:
             cpnet_simple.add_edge(u, v, weight=w)
+    edges = np.array(list(cpnet_simple.edges()), dtype=np.int64).reshape(-1, 2)
+    cpnet_simple_keys = np.unique(np.concatenate((edges[:, 0] * CPNET_KEY_BASE + edges[:, 1], edges[:, 1] * CPNET_KEY_BASE + edges[:, 0])))
+    cpnet_rel_index = build_relation_index(cpnet, len(merged_relations))
 
 
-def relational_graph_generation(qcs, acs, paths, rels):
-    raise NotImplementedError()  # TODO
+def build_relation_index(graph, n_rel):
+    """
+    relation-typed sparse index of a cpnet MultiDiGraph
 
+    returns: (indptr, indices, relmask), the out-neighbours of concept u are indices[indptr[u]:indptr[u + 1]] and
+             bit r of relmask is set for every edge u -> v with relation r < n_rel
+    """
+    edges = np.array([(u, v, r) for u, v, r in graph.edges(data='rel')], dtype=np.int64).reshape(-1, 3)
+    edges = edges[(edges[:, 2] >= 0) & (edges[:, 2] < n_rel)]
+    n_node = max(graph.nodes()) + 1 if graph.number_of_nodes() > 0 else 0
+    triples = np.unique((edges[:, 0] * n_node + edges[:, 1]) * n_rel + edges[:, 2])
+    pair_keys, inverse = np.unique(triples // n_rel, return_inverse=True)
+    relmask = np.zeros(pair_keys.shape[0], dtype=np.int64)
+    np.add.at(relmask, inverse.reshape(-1), np.left_shift(1, triples % n_rel))  # distinct bits, so add == or
+    indptr = np.zeros(n_node + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pair_keys // n_node, minlength=n_node), out=indptr[1:])
+    return indptr, (pair_keys % n_node).astype(np.int32), relmask
+
+
+def induced_adj(cids, n_rel, rel_index):
+    """
+    adjacency of the subgraph induced by the concepts cids, read from a relation index in one sparse slice
 
-# plain graph generation
-def plain_graph_generation(qcs, acs, paths, rels):
-    global cpnet, concept2id, relation2id, id2relation, id2concept, cpnet_simple
+    rel_index: (indptr, indices, relmask) of a graph as returned by build_relation_index
+    returns: (n_rel * n_node, n_node) coo matrix with entry [r * n_node + s, t] = 1 for every edge cids[s] -r-> cids[t],
+             the same matrix as the dense loop over all node pairs
+    """
+    indptr, indices, relmask = rel_index
+    cids = np.asarray(cids, dtype=np.int64)
+    n_node = cids.shape[0]
 
-    graph = nx.Graph()
-    for p in paths:
-        for c_index in range(len(p) - 1):
-            h = p[c_index]
-            t = p[c_index + 1]
-            # TODO: the weight can computed by concept embeddings and relation embeddings of TransE
-            graph.add_edge(h, t, weight=1.0)
+    # out-edges of every node of the subgraph
+    heads = np.nonzero((cids >= 0) & (cids < indptr.shape[0] - 1))[0]
+    starts, ends = indptr[cids[heads]], indptr[cids[heads] + 1]
+    lens = ends - starts
+    pos = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    src, tail_cids, masks = np.repeat(heads, lens), indices[pos], relmask[pos]
 
-    for qc1, qc2 in list(itertools.combinations(qcs, 2)):
-        if cpnet_simple.has_edge(qc1, qc2):
-            graph.add_edge(qc1, qc2, weight=1.0)
+    # keep the edges whose tail is in the subgraph as well (every local copy of a repeated concept)
+    order = np.argsort(cids, kind='stable')
+    lo, hi = np.searchsorted(cids[order], tail_cids, 'left'), np.searchsorted(cids[order], tail_cids, 'right')
+    n_match = hi - lo
+    src, masks = np.repeat(src, n_match), np.repeat(masks, n_match)
+    dst = order[np.repeat(lo - np.cumsum(n_match) + n_match, n_match) + np.arange(n_match.sum())]
 
-    for ac1, ac2 in list(itertools.combinations(acs, 2)):
-        if cpnet_simple.has_edge(ac1, ac2):
-            graph.add_edge(ac1, ac2, weight=1.0)
+    edge_idx, rel = np.nonzero((masks[:, None] >> np.arange(n_rel)) & 1)
+    rows, cols = rel * n_node + src[edge_idx], dst[edge_idx]
+    order = np.lexsort((cols, rows))
+    return coo_matrix((np.ones(rows.shape[0], dtype=np.uint8), (rows[order], cols[order])), shape=(n_rel * n_node, n_node))
 
-    if len(qcs) == 0:
-        qcs.append(-1)
 
-    if len(acs) == 0:
-        acs.append(-1)
+def has_edges(u, v):
+    """
+    vectorized cpnet_simple.has_edge
 
-    if len(paths) == 0:
-        for qc in qcs:
-            for ac in acs:
-                graph.add_edge(qc, ac, rel=-1, weight=0.1)
+    u, v: int arrays of the same shape
+    returns: bool array
+    """
+    u, v = np.asarray(u, dtype=np.int64), np.asarray(v, dtype=np.int64)
+    if cpnet_simple_keys.shape[0] == 0:
+        return np.zeros(u.shape, dtype=bool)
+    keys = u * CPNET_KEY_BASE + v
+    pos = np.minimum(np.searchsorted(cpnet_simple_keys, keys), cpnet_simple_keys.shape[0] - 1)
+    return (u >= 0) & (v >= 0) & (cpnet_simple_keys[pos] == keys)
+
+
+def relational_graph_generation(qcs, acs, paths, rels):
+    raise NotImplementedError()  # TODO
 
-    g = nx.convert_node_labels_to_integers(graph, label_attribute='cid')  # re-index
-    return nx.node_link_data(g)
 
+# plain graph generation
+def plain_graph_generation(qcs, acs, paths, rels):
+    """
+    build the undirected schema graph of a statement from its paths with numpy
 
-def generate_adj_matrix_per_inst(nxg_str):
-    global id2relation
+    returns: (cids, src, dst), nodes are numbered in order of first appearance (as nx.convert_node_labels_to_integers
+             does for the nx.Graph built edge by edge) and every edge is kept once, in the orientation it first appears
+    """
+    global cpnet_simple_keys
+
+    path_lens = np.array([len(p) for p in paths], dtype=np.int64)
+    nodes = np.fromiter(itertools.chain.from_iterable(paths), dtype=np.int64, count=int(path_lens.sum()))
+    hop_start = np.ones(nodes.shape[0], dtype=bool)
+    hop_start[np.cumsum(path_lens) - 1] = False  # the last concept of a path starts no hop
+    hop_idx = np.nonzero(hop_start)[0]
+    heads, tails = [nodes[hop_idx]], [nodes[hop_idx + 1]]
+
+    for cs in (np.array(qcs, dtype=np.int64), np.array(acs, dtype=np.int64)):
+        i, j = np.triu_indices(cs.shape[0], 1)  # same order as itertools.combinations
+        linked = has_edges(cs[i], cs[j])
+        heads.append(cs[i][linked])
+        tails.append(cs[j][linked])
+
+    if len(paths) == 0:
+        qcs = np.array(qcs if len(qcs) > 0 else [-1], dtype=np.int64)
+        acs = np.array(acs if len(acs) > 0 else [-1], dtype=np.int64)
+        heads.append(np.repeat(qcs, acs.shape[0]))
+        tails.append(np.tile(acs, qcs.shape[0]))
+
+    heads, tails = np.concatenate(heads), np.concatenate(tails)
+    ends = np.stack((heads, tails), 1).reshape(-1)
+    uniq, first, inverse = np.unique(ends, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0])
+    local = rank[inverse.reshape(-1)].reshape(-1, 2)
+    edge_keys = np.minimum(local[:, 0], local[:, 1]) * max(uniq.shape[0], 1) + np.maximum(local[:, 0], local[:, 1])
+    first_edges = np.sort(np.unique(edge_keys, return_index=True)[1])
+    return uniq[order].astype(np.int32), local[first_edges, 0].astype(np.int32), local[first_edges, 1].astype(np.int32)
+
+
+def generate_adj_matrix_per_inst(graph):
+    """
+    graph: (cids, src, dst) of a schema graph as returned by load_graphs, only its nodes are used
+    """
+    global id2relation, cpnet_all_rel_index
     n_rel = len(id2relation)
 
-    nxg = nx.node_link_graph(json.loads(nxg_str))
-    n_node = len(nxg.nodes)
-    cids = np.zeros(n_node, dtype=np.int32)
-    for node_id, node_attr in nxg.nodes(data=True):
-        cids[node_id] = node_attr['cid']
-
-    adj = np.zeros((n_rel, n_node, n_node), dtype=np.uint8)
-    for s in range(n_node):
-        for t in range(n_node):
-            s_c, t_c = cids[s], cids[t]
-            if cpnet_all.has_edge(s_c, t_c):
-                for e_attr in cpnet_all[s_c][t_c].values():
-                    if e_attr['rel'] >= 0 and e_attr['rel'] < n_rel:
-                        adj[e_attr['rel']][s][t] = 1
+    cids = np.array(graph[0], dtype=np.int32)
+    adj = induced_adj(cids, n_rel, cpnet_all_rel_index)
     cids += 1
-    adj = coo_matrix(adj.reshape(-1, n_node))
     return (adj, cids)
 
 
 def concepts2adj(node_ids):
-    global id2relation
+    global id2relation, cpnet_rel_index
     cids = np.array(node_ids, dtype=np.int32)
     n_rel = len(id2relation)
     n_node = cids.shape[0]
-    adj = np.zeros((n_rel, n_node, n_node), dtype=np.uint8)
-    for s in range(n_node):
-        for t in range(n_node):
-            s_c, t_c = cids[s], cids[t]
-            if cpnet.has_edge(s_c, t_c):
-                for e_attr in cpnet[s_c][t_c].values():
-                    if e_attr['rel'] >= 0 and e_attr['rel'] < n_rel:
-                        adj[e_attr['rel']][s][t] = 1
     # cids += 1  # note!!! index 0 is reserved for padding
     if n_node != 0:
-        adj = coo_matrix(adj.reshape(-1, n_node))
+        adj = induced_adj(cids, n_rel, cpnet_rel_index)
     else:
         adj = coo_matrix((0, 0))
     return adj, cids
@@ -267,13 +330,12 @@ def generate_graph(grounded_path, pruned_paths_path, cpnet_vocab_path, cpnet_gra
     if cpnet is None or cpnet_simple is None:
         load_cpnet(cpnet_graph_path)
 
-    nrow = sum(1 for _ in open(grounded_path, 'r'))
+    nrow, path_data = load_path_statements(pruned_paths_path)
+    start_time = time.time()
     with open(grounded_path, 'r') as fin_gr, \
-            open(pruned_paths_path, 'r') as fin_pf, \
-            open(output_path, 'w') as fout:
-        for line_gr, line_pf in tqdm(zip(fin_gr, fin_pf), total=nrow):
+            open_graph_writer(output_path) as fout:
+        for line_gr, qa_pairs in tqdm(zip(fin_gr, path_data), total=nrow):
             mcp = json.loads(line_gr)
-            qa_pairs = json.loads(line_pf)
 
             statement_paths = []
             statement_rel_list = []
@@ -290,12 +352,12 @@ def generate_graph(grounded_path, pruned_paths_path, cpnet_vocab_path, cpnet_gra
             qcs = [concept2id[c] for c in mcp["qc"]]
             acs = [concept2id[c] for c in mcp["ac"]]
 
-            gobj = plain_graph_generation(qcs=qcs, acs=acs,
-                                          paths=statement_paths,
-                                          rels=statement_rel_list)
-            fout.write(json.dumps(gobj) + '\n')
+            cids, src, dst = plain_graph_generation(qcs=qcs, acs=acs,
+                                                    paths=statement_paths,
+                                                    rels=statement_rel_list)
+            fout.write(cids, src, dst)
 
-    print(f'schema graphs saved to {output_path}')
+    print(f'schema graphs saved to {output_path} ({time.time() - start_time:.2f}s)')
     print()
 
 
@@ -306,23 +368,22 @@ def generate_adj_matrices(ori_schema_graph_path, cpnet_graph_path, cpnet_vocab_p
     if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
         load_resources(cpnet_vocab_path)
 
-    global cpnet_all
+    global cpnet_all, cpnet_all_rel_index
     if cpnet_all is None:
         cpnet_all = nx.read_gpickle(cpnet_graph_path)
+        cpnet_all_rel_index = build_relation_index(cpnet_all, len(id2relation))
 
-    with open(ori_schema_graph_path, 'r') as fin:
-        nxg_strs = [line for line in fin]
+    nrow, graphs = load_graphs(ori_schema_graph_path)
 
     if debug:
-        nxgs = nxgs[:1]
-
-    with Pool(num_processes) as p:
-        res = list(tqdm(p.imap(generate_adj_matrix_per_inst, nxg_strs), total=len(nxg_strs)))
+        nrow, graphs = 1, itertools.islice(graphs, 1)
 
-    with open(output_path, 'wb') as fout:
-        pickle.dump(res, fout)
+    start_time = time.time()
+    with Pool(num_processes) as p, open_adj_writer(output_path, len(id2relation), with_masks=False) as fout:
+        for adj, cids in tqdm(p.imap(generate_adj_matrix_per_inst, graphs, chunksize=32), total=nrow):
+            fout.write(adj, cids)
 
-    print(f'adjacency matrices saved to {output_path}')
+    print(f'adjacency matrices saved to {output_path} ({time.time() - start_time:.2f}s)')
     print()
 
 
@@ -333,7 +394,7 @@ def generate_adj_data_from_grounded_concepts(grounded_path, cpnet_graph_path, cp
         (2) concepts ids
         (3) qmask that specifices whether a node is a question concept
         (4) amask that specifices whether a node is a answer concept
-    to the output path in python pickle format
+    to the output path in python pickle format (or as an AdjStore if output_path ends with .bin)
 
     grounded_path: str
     cpnet_graph_path: str
@@ -358,72 +419,100 @@ def generate_adj_data_from_grounded_concepts(grounded_path, cpnet_graph_path, cp
             q_ids = q_ids - a_ids
             qa_data.append((q_ids, a_ids))
 
-    with Pool(num_processes) as p:
-        res = list(tqdm(p.imap(concepts_to_adj_matrices_2hop_all_pair, qa_data), total=len(qa_data)))
-
-    # res is a list of tuples, each tuple consists of four elements (adj, concepts, qmask, amask)
-    with open(output_path, 'wb') as fout:
-        pickle.dump(res, fout)
+    # every instance is a tuple of four elements (adj, concepts, qmask, amask), written as soon as it is ready
+    start_time = time.time()
+    with Pool(num_processes) as p, open_adj_writer(output_path, len(id2relation)) as fout:
+        for adj, concepts, qmask, amask in tqdm(p.imap(concepts_to_adj_matrices_2hop_all_pair, qa_data, chunksize=32), total=len(qa_data)):
+            fout.write(adj, concepts, qmask, amask)
 
-    print(f'adj data saved to {output_path}')
+    print(f'adj data saved to {output_path} ({time.time() - start_time:.2f}s)')
     print()
 
 
 #################### adj to sparse ####################
 
-def coo_to_normalized_per_inst(data):
-    adj, concepts, qm, am, max_node_num = data
-    ori_adj_len = len(concepts)
-    concepts = torch.tensor(concepts[:min(len(concepts), max_node_num)])
-    adj_len = len(concepts)
-    qm = torch.tensor(qm[:adj_len], dtype=torch.uint8)
-    am = torch.tensor(am[:adj_len], dtype=torch.uint8)
-    ij = adj.row
-    k = adj.col
-    n_node = adj.shape[1]
-    n_rel = 2 * adj.shape[0] // n_node
+def coo_to_normalized_shard(data):
+    """
+    normalize the adjacency matrices of a shard of instances with one degree computation over their concatenated edges
+
+    data: (list of (adj, concepts, qm, am), max_node_num, n_rel) where n_rel counts the inverse relations
+    returns: (ori_adj_lengths, adj_lengths, concepts, indices, values, counts)
+             indices (2, nnz) and values (nnz,) hold the (row, col) entries and values of all n_rel transposed,
+             row-normalized relation matrices plus an identity matrix of every instance, ordered by instance, relation,
+             row and column; counts (n_inst * (n_rel + 1),) is the number of entries of every matrix
+    """
+    adj_data, max_node_num, n_rel = data
+    n_inst = len(adj_data)
+    n_mat = n_rel + 1
+    ori_adj_lengths = np.array([len(concepts) for _, concepts, _, _ in adj_data], dtype=np.int64)
+    adj_lengths = np.minimum(ori_adj_lengths, max_node_num)
+    concepts = np.zeros((n_inst, max_node_num), dtype=np.int64)
+    for idx, (_, cs, _, _) in enumerate(adj_data):
+        concepts[idx, :adj_lengths[idx]] = cs[:max_node_num]
+
+    nnz = np.array([adj.nnz for adj, _, _, _ in adj_data], dtype=np.int64)
+    inst = np.repeat(np.arange(n_inst), nnz)
+    ij = np.concatenate([adj.row for adj, _, _, _ in adj_data] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    k = np.concatenate([adj.col for adj, _, _, _ in adj_data] + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    n_node = np.maximum(ori_adj_lengths[inst], 1)
     i, j = ij // n_node, ij % n_node
     mask = (j < max_node_num) & (k < max_node_num)
-    i, j, k = i[mask], j[mask], k[mask]
-    i, j, k = np.concatenate((i, i + n_rel // 2), 0), np.concatenate((j, k), 0), np.concatenate((k, j), 0)  # add inverse relations
-    adj_list = []
-    for r in range(n_rel):
-        mask = i == r
-        ones = np.ones(mask.sum(), dtype=np.float32)
-        A = sparse.csr_matrix((ones, (k[mask], j[mask])), shape=(max_node_num, max_node_num))  # A is transposed by exchanging the order of j and k
-        adj_list.append(normalize_sparse_adj(A, 'coo'))
-    adj_list.append(sparse.identity(max_node_num, dtype=np.float32, format='coo'))
-    return ori_adj_len, adj_len, concepts, adj_list, qm, am
-
-
-def coo_to_normalized(adj_path, output_path, max_node_num, num_processes):
-    print(f'converting {adj_path} to normalized adj')
+    inst, i, j, k = inst[mask], i[mask], j[mask], k[mask]
+    # add inverse relations and one identity matrix per instance, the relation matrices are transposed (row k, col j)
+    eye = np.tile(np.arange(max_node_num), n_inst)
+    inst = np.concatenate((inst, inst, np.repeat(np.arange(n_inst), max_node_num)))
+    rel = np.concatenate((i, i + n_rel // 2, np.full(eye.shape[0], n_rel)))
+    rows, cols = np.concatenate((k, j, eye)), np.concatenate((j, k, eye))
+
+    # duplicate entries are summed and every row is divided by its in-degree, as normalize_sparse_adj does
+    keys, dup = np.unique(((inst * n_mat + rel) * max_node_num + rows) * max_node_num + cols, return_counts=True)
+    row_keys = keys // max_node_num
+    row_start = np.concatenate(([0], np.nonzero(np.diff(row_keys))[0] + 1))
+    in_degree = np.add.reduceat(dup, row_start) if keys.shape[0] > 0 else dup
+    in_degree = np.repeat(in_degree, np.diff(np.append(row_start, keys.shape[0])))
+    values = (1 / in_degree.astype(np.float32)) * dup.astype(np.float32)
+    indices = np.stack((row_keys % max_node_num, keys % max_node_num), 0)
+    counts = np.bincount(row_keys // max_node_num, minlength=n_inst * n_mat)
+    return ori_adj_lengths, adj_lengths, concepts, indices, values, counts
+
+
+def get_normalized_adj(adj_data, idx):
+    """
+    adj_data: the packed dict saved by coo_to_normalized
+    returns: list of (LongTensor of shape (2, nnz), FloatTensor of shape (nnz,)), one per relation plus the identity
+    """
+    n_mat = adj_data['n_rel'] + 1
+    offsets = adj_data['offsets'][idx * n_mat:(idx + 1) * n_mat + 1].tolist()
+    return [(adj_data['indices'][:, a:b], adj_data['values'][a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+
 
-    with open(adj_path, 'rb') as fin:
-        adj_data = pickle.load(fin)
-    data = [(adj, concepts, qmask, amask, max_node_num) for adj, concepts, qmask, amask in adj_data]
+def coo_to_normalized(adj_path, output_path, max_node_num, num_processes, shard_size=1000):
+    """
+    saves (ori_adj_lengths, adj_lengths, concepts_ids, adj_data) with torch.save, where adj_data is a dict of packed
+    tensors {'indices', 'values', 'offsets', 'n_rel'}: the entries of matrix m of instance i (relations first, then the
+    identity) are indices[:, offsets[i * (n_rel + 1) + m]:offsets[i * (n_rel + 1) + m + 1]], see get_normalized_adj
+    """
+    print(f'converting {adj_path} to normalized adj')
 
-    ori_adj_lengths = torch.zeros((len(data),), dtype=torch.int64)
-    adj_lengths = torch.zeros((len(data),), dtype=torch.int64)
-    concepts_ids = torch.zeros((len(data), max_node_num), dtype=torch.int64)
-    qmask = torch.zeros((len(data), max_node_num), dtype=torch.uint8)
-    amask = torch.zeros((len(data), max_node_num), dtype=torch.uint8)
+    adj_data = load_adj_concept_pairs(adj_path)
+    n_samples = len(adj_data)
+    n_rel = next((2 * adj.shape[0] // adj.shape[1] for adj, _, _, _ in adj_data if adj.shape[1] > 0), 2 * len(merged_relations))
+    shards = [(adj_data[start:start + shard_size], max_node_num, n_rel) for start in range(0, n_samples, shard_size)]
 
-    adj_data = []
+    start_time = time.time()
     with Pool(num_processes) as p:
-        for i, (ori_adj_len, adj_len, concepts, adj_list, qm, am) in tqdm(enumerate(p.imap(coo_to_normalized_per_inst, data)), total=len(data)):
-            ori_adj_lengths[i] = ori_adj_len
-            adj_lengths[i] = adj_len
-            concepts_ids[i][:adj_len] = concepts
-            qmask[i][:adj_len] = qm
-            amask[i][:adj_len] = am
-            adj_list = [(torch.LongTensor(np.stack((adj.row, adj.col), 0)),
-                         torch.FloatTensor(adj.data)) for adj in adj_list]
-            adj_data.append(adj_list)
-
-    torch.save((ori_adj_lengths, adj_lengths, concepts_ids, adj_data), output_path)
-
-    print(f'normalized adj saved to {output_path}')
+        results = list(tqdm(p.imap(coo_to_normalized_shard, shards), total=len(shards)))
+    ori_adj_lengths, adj_lengths, concepts_ids, indices, values, counts = zip(*results)
+    ori_adj_lengths, adj_lengths, concepts_ids = np.concatenate(ori_adj_lengths), np.concatenate(adj_lengths), np.concatenate(concepts_ids)
+    indices, values, counts = np.concatenate(indices, 1), np.concatenate(values), np.concatenate(counts)
+    offsets = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    adj_data = {'indices': torch.from_numpy(indices.astype(np.int64)), 'values': torch.from_numpy(values),
+                'offsets': torch.from_numpy(offsets), 'n_rel': n_rel}
+    torch.save((torch.from_numpy(ori_adj_lengths), torch.from_numpy(adj_lengths), torch.from_numpy(concepts_ids), adj_data), output_path)
+
+    print(f'normalized adj saved to {output_path} ({time.time() - start_time:.2f}s)')
     print()
 
 # if __name__ == '__main__':
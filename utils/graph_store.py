@@ -0,0 +1,196 @@
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from .packed_utils import PackedWriter, load_packed, gather_ranges
+except ImportError:
+    from packed_utils import PackedWriter, load_packed, gather_ranges
+
+__all__ = ['GraphStoreWriter', 'GraphStore', 'open_graph_writer', 'load_graphs', 'is_graph_store',
+           'graph_to_node_link', 'node_link_to_graph', 'jsonl_to_graph_store', 'graph_store_to_jsonl']
+
+GRAPH_STORE_EXT = '.bin'
+
+
+def is_graph_store(path):
+    return path.endswith(GRAPH_STORE_EXT)
+
+
+def graph_to_node_link(cids, src, dst):
+    """
+    returns: the nx.node_link_data dict of the undirected schema graph given as edge arrays
+    """
+    return {"directed": False, "multigraph": False, "graph": {},
+            "nodes": [{"cid": c, "id": i} for i, c in enumerate(np.asarray(cids).tolist())],
+            "links": [{"weight": 1.0, "source": u, "target": v} for u, v in zip(np.asarray(src).tolist(), np.asarray(dst).tolist())]}
+
+
+def node_link_to_graph(gobj):
+    """
+    parse a node-link dict without going through networkx
+
+    returns: (cids, src, dst), int32 arrays; src and dst index into cids
+    """
+    links = gobj['links'] if 'links' in gobj else gobj['edges']  # networkx >= 3.4 names them edges
+    node_ids = [n['id'] for n in gobj['nodes']]
+    cids = np.array([n['cid'] for n in gobj['nodes']], dtype=np.int32)
+    if node_ids != list(range(len(node_ids))):  # not relabelled by convert_node_labels_to_integers
+        id2idx = {n: i for i, n in enumerate(node_ids)}
+        src = np.array([id2idx[l['source']] for l in links], dtype=np.int32)
+        dst = np.array([id2idx[l['target']] for l in links], dtype=np.int32)
+    else:
+        src = np.array([l['source'] for l in links], dtype=np.int32)
+        dst = np.array([l['target'] for l in links], dtype=np.int32)
+    return cids, src, dst
+
+
+class GraphStoreWriter(object):
+    """
+    streaming binary replacement for the *.graph.*.jsonl files
+
+    Every schema graph is an undirected graph given as concept ids of its nodes and one (src, dst) pair of
+    local node indices per edge. The store keeps them as
+        node_offsets, cids, edge_offsets, src, dst
+    where graph g has nodes cids[node_offsets[g]:node_offsets[g + 1]] and edges src/dst[edge_offsets[g]:edge_offsets[g + 1]].
+    Every graph is appended to disk as soon as it is written.
+    """
+
+    def __init__(self, path):
+        self.writer = PackedWriter(path, {'node_offsets': np.int64, 'cids': np.int32, 'edge_offsets': np.int64, 'src': np.int32, 'dst': np.int32},
+                                   meta={'format': 'graphs', 'version': 1})
+        self.n_node, self.n_edge = 0, 0
+        self.writer.append('node_offsets', [0])
+        self.writer.append('edge_offsets', [0])
+
+    def write(self, cids, src, dst):
+        self.writer.append('cids', cids)
+        self.writer.append('src', src)
+        self.writer.append('dst', dst)
+        self.n_node += len(cids)
+        self.n_edge += len(src)
+        self.writer.append('node_offsets', [self.n_node])
+        self.writer.append('edge_offsets', [self.n_edge])
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+
+class GraphStore(object):
+    """
+    zero-copy reader of a file written by GraphStoreWriter, indexing returns (cids, src, dst)
+    """
+
+    def __init__(self, path, mmap=True):
+        arrays, self.meta = load_packed(path, mmap=mmap)
+        if self.meta.get('format') != 'graphs':
+            raise ValueError(f'{path} is not a graph store')
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+
+    def __len__(self):
+        return self.node_offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        n_start, n_end = self.node_offsets[idx:idx + 2].tolist()
+        e_start, e_end = self.edge_offsets[idx:idx + 2].tolist()
+        return np.array(self.cids[n_start:n_end]), np.array(self.src[e_start:e_end]), np.array(self.dst[e_start:e_end])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def num_nodes(self):
+        return np.diff(self.node_offsets)
+
+    def gather(self, indices):
+        """
+        concatenate several graphs into one disjoint graph without a python loop over graphs or nodes
+
+        indices: array-like of graph indices
+        returns: (cids, src, dst, node_offsets) where src and dst index into cids and the nodes of the i-th
+                 requested graph are cids[node_offsets[i]:node_offsets[i + 1]]
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        node_pos, node_offsets = gather_ranges(self.node_offsets, indices)
+        edge_pos, edge_offsets = gather_ranges(self.edge_offsets, indices)
+        node_base = np.repeat(node_offsets[:-1], np.diff(edge_offsets))
+        cids = np.asarray(self.cids[node_pos])
+        src = np.asarray(self.src[edge_pos]) + node_base
+        dst = np.asarray(self.dst[edge_pos]) + node_base
+        return cids, src, dst, node_offsets
+
+    def num_edges(self):
+        return np.diff(self.edge_offsets)
+
+
+class JsonlGraphWriter(object):
+
+    def __init__(self, path):
+        self.fout = open(path, 'w')
+
+    def write(self, cids, src, dst):
+        self.fout.write(json.dumps(graph_to_node_link(cids, src, dst)) + '\n')
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fout.close()
+
+
+def open_graph_writer(path):
+    """
+    returns: a GraphStoreWriter if path ends with .bin, otherwise a writer of the node-link jsonl format
+    """
+    if is_graph_store(path):
+        return GraphStoreWriter(path)
+    return JsonlGraphWriter(path)
+
+
+def load_graphs(path):
+    """
+    returns: (number of graphs, iterator over (cids, src, dst)) for both the jsonl and the binary format
+    """
+    if is_graph_store(path):
+        store = GraphStore(path)
+        return len(store), iter(store)
+    nrow = sum(1 for _ in open(path, 'r'))
+
+    def jsonl_iter():
+        with open(path, 'r') as fin:
+            for line in fin:
+                yield node_link_to_graph(json.loads(line))
+    return nrow, jsonl_iter()
+
+
+def jsonl_to_graph_store(jsonl_path, output_path):
+    nrow, graphs = load_graphs(jsonl_path)
+    with GraphStoreWriter(output_path) as writer:
+        for cids, src, dst in tqdm(graphs, total=nrow, desc='converting graphs'):
+            writer.write(cids, src, dst)
+    print(f'graph store saved to {output_path}')
+
+
+def graph_store_to_jsonl(store_path, output_path):
+    nrow, graphs = load_graphs(store_path)
+    with JsonlGraphWriter(output_path) as writer:
+        for cids, src, dst in tqdm(graphs, total=nrow, desc='converting graphs'):
+            writer.write(cids, src, dst)
+    print(f'graphs saved to {output_path}')
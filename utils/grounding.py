@@ -5,6 +5,9 @@ from tqdm import tqdm
 import nltk
 import json
 import string
+import os
+import time
+import numpy as np
 
 
 __all__ = ['create_matcher_patterns', 'ground']
@@ -53,10 +56,74 @@ def create_pattern(nlp, doc, debug=False):
     return pattern
 
 
-def create_matcher_patterns(cpnet_vocab_path, output_path, debug=False):
+def get_binary_pattern_path(pattern_path):
+    """
+    the binary patterns are stored next to the json file, e.g. matcher_patterns.json -> matcher_patterns.npz
+    """
+    return os.path.splitext(pattern_path)[0] + '.npz'
+
+
+def encode_strings(strings):
+    """
+    returns: (uint8 array of the concatenated utf-8 strings, int64 offsets of every string in it)
+    """
+    encoded = [x.encode('utf-8') for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    blob = data.tobytes()
+    offsets = offsets.tolist()
+    return [blob[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def save_binary_patterns(all_patterns, output_path):
+    """
+    save patterns as a lemma table plus flat int32 lemma ids with per-concept offsets, concept names and
+    lemmas are stored as utf-8 byte blobs with offsets
+
+    all_patterns: dict[str, list[dict]]
+    output_path: str
+    """
+    lemma2id = {}
+    lemma_ids = []
+    offsets = [0]
+    for pattern in all_patterns.values():
+        for token in pattern:
+            lemma_ids.append(lemma2id.setdefault(token["LEMMA"], len(lemma2id)))
+        offsets.append(len(lemma_ids))
+    concept_bytes, concept_offsets = encode_strings(all_patterns.keys())
+    lemma_bytes, lemma_offsets = encode_strings(lemma2id.keys())
+    np.savez(output_path,
+             concept_bytes=concept_bytes, concept_offsets=concept_offsets,
+             lemma_bytes=lemma_bytes, lemma_offsets=lemma_offsets,
+             lemma_ids=np.array(lemma_ids, dtype=np.int32),
+             offsets=np.array(offsets, dtype=np.int64))
+
+
+def load_binary_patterns(pattern_path):
+    """
+    returns: an iterator over (concept, pattern) pairs
+    """
+    with np.load(pattern_path) as data:
+        concepts = decode_strings(data['concept_bytes'], data['concept_offsets'])
+        lemmas = decode_strings(data['lemma_bytes'], data['lemma_offsets'])
+        lemma_ids, offsets = data['lemma_ids'].tolist(), data['offsets'].tolist()
+    for i, concept in enumerate(concepts):
+        yield concept, [{"LEMMA": lemmas[idx]} for idx in lemma_ids[offsets[i]:offsets[i + 1]]]
+
+
+def create_matcher_patterns(cpnet_vocab_path, output_path, num_processes=1, batch_size=1000, debug=False):
+    """
+    lemmatize the ConceptNet vocabulary with a (multi-process) spaCy pipe and save the matcher patterns
+    both as json and in the binary format read by load_matcher
+    """
+    start = time.time()
     cpnet_vocab = load_cpnet_vocab(cpnet_vocab_path)
     nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
-    docs = nlp.pipe(cpnet_vocab)
+    docs = nlp.pipe(cpnet_vocab, n_process=num_processes, batch_size=batch_size)
     all_patterns = {}
 
     if debug:
@@ -64,21 +131,37 @@ def create_matcher_patterns(cpnet_vocab_path, output_path, debug=False):
 
     for doc in tqdm(docs, total=len(cpnet_vocab)):
 
-        pattern = create_pattern(nlp, doc, debug)
-        if debug:
-            if not pattern[0]:
-                f.write(pattern[1] + '\n')
-
+        pattern = create_pattern(nlp, doc)
         if pattern is None:
+            if debug:
+                f.write(doc.text + '\n')
             continue
         all_patterns["_".join(doc.text.split(" "))] = pattern
 
-    print("Created " + str(len(all_patterns)) + " patterns.")
+    print("Created " + str(len(all_patterns)) + " patterns in {:.2f}s.".format(time.time() - start))
     with open(output_path, "w", encoding="utf8") as fout:
         json.dump(all_patterns, fout)
+    binary_path = get_binary_pattern_path(output_path)
+    save_binary_patterns(all_patterns, binary_path)
     if debug:
         f.close()
 
+    print(f'matcher patterns saved to {output_path} and {binary_path}')
+    print()
+
+
+def benchmark_matcher_patterns(cpnet_vocab_path, num_processes_list=(1, 2, 4, 8), batch_size_list=(100, 1000, 5000)):
+    """
+    time the pattern creation over the full vocabulary for different (num_processes, batch_size) settings
+    """
+    cpnet_vocab = load_cpnet_vocab(cpnet_vocab_path)
+    nlp = spacy.load('en_core_web_sm', disable=['parser', 'ner', 'textcat'])
+    for num_processes in num_processes_list:
+        for batch_size in batch_size_list:
+            start = time.time()
+            n_patterns = sum(create_pattern(nlp, doc) is not None for doc in nlp.pipe(cpnet_vocab, n_process=num_processes, batch_size=batch_size))
+            print('n_process: {:2d}   batch_size: {:5d}   patterns: {}   time: {:.2f}s'.format(num_processes, batch_size, n_patterns, time.time() - start))
+
 
 def lemmatize(nlp, concept):
 
@@ -98,11 +181,18 @@ def lemmatize(nlp, concept):
 
 
 def load_matcher(nlp, pattern_path):
-    with open(pattern_path, "r", encoding="utf8") as fin:
-        all_patterns = json.load(fin)
+    """
+    the binary patterns are used unless the json file is newer (e.g. regenerated or edited by hand)
+    """
+    binary_path = get_binary_pattern_path(pattern_path)
+    if os.path.exists(binary_path) and (not os.path.exists(pattern_path) or os.path.getmtime(binary_path) >= os.path.getmtime(pattern_path)):
+        all_patterns = load_binary_patterns(binary_path)
+    else:
+        with open(pattern_path, "r", encoding="utf8") as fin:
+            all_patterns = json.load(fin).items()
 
     matcher = Matcher(nlp.vocab)
-    for concept, pattern in all_patterns.items():
+    for concept, pattern in all_patterns:
         matcher.add(concept, None, pattern)
     return matcher
 
@@ -337,7 +427,8 @@ def ground(statement_path, cpnet_vocab_path, pattern_path, output_path, num_proc
 
 
 if __name__ == "__main__":
-    create_matcher_patterns("../data/cpnet/concept.txt", "./matcher_res.txt", True)
+    create_matcher_patterns("../data/cpnet/concept.txt", "./matcher_res.txt", debug=True)
+    # benchmark_matcher_patterns("../data/cpnet/concept.txt")
     # ground("../data/statement/dev.statement.jsonl", "../data/cpnet/concept.txt", "../data/cpnet/matcher_patterns.json", "./ground_res.jsonl", 10, True)
 
     # s = "a revolving door is convenient for two direction travel, but it also serves as a security measure at a bank."
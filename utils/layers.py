@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
 import math
+import os
 from utils.utils import freeze_net
 
 
@@ -486,6 +487,24 @@ def masked_softmax(vector: torch.Tensor,
     return result
 
 
+def segment_softmax(src: torch.Tensor, index: torch.Tensor, num_segments: int, mask_fill_value: float = -1e32) -> torch.Tensor:
+    """
+    softmax over the entries of ``src`` that share the same value of ``index``, computed for all segments at once
+    by scattering ``src`` into a padded (num_segments, max_segment_len) matrix
+
+    src: tensor of shape (n,)
+    index: LongTensor of shape (n,), segment of every entry; entries of a segment must be contiguous
+    returns: tensor of shape (n,)
+    """
+    if src.size(0) == 0:
+        return src
+    counts = torch.bincount(index, minlength=num_segments)
+    pos = torch.arange(src.size(0), device=src.device) - (torch.cumsum(counts, 0) - counts)[index]
+    padded = src.new_full((num_segments, int(counts.max())), mask_fill_value)
+    padded[index, pos] = src
+    return nn.functional.softmax(padded, dim=1)[index, pos]
+
+
 class DiffTopK(torch.autograd.Function):
 
     @staticmethod
@@ -556,6 +575,11 @@ class MatrixAttention(nn.Module):
         self._similarity_function = similarity_function or DotProductSimilarity()
 
     def forward(self, matrix_1: torch.Tensor, matrix_2: torch.Tensor) -> torch.Tensor:
+        if type(self._similarity_function) is DotProductSimilarity:  # avoid the (batch_size, len_1, len_2, dim) tiled tensors
+            result = torch.bmm(matrix_1, matrix_2.transpose(1, 2))
+            if self._similarity_function._scale_output:
+                result *= math.sqrt(matrix_1.size(-1))
+            return result
         tiled_matrix_1 = matrix_1.unsqueeze(2).expand(matrix_1.size()[0],
                                                       matrix_1.size()[1],
                                                       matrix_2.size()[1],
@@ -568,13 +592,109 @@ class MatrixAttention(nn.Module):
         return self._similarity_function(tiled_matrix_1, tiled_matrix_2)
 
 
+class MmapEmbedding(nn.Module):
+    """
+    frozen embedding table that stays memory-mapped on disk, forward gathers only the rows used by the batch
+
+    The table is never materialized as a tensor, so a process only holds the pages of the rows it touched.
+    Pickling keeps the paths of the .npy files rather than their content.
+    """
+
+    def __init__(self, paths):
+        """
+        paths: list of .npy files of shape (num_embeddings, dim_i) (float32 or float16), concatenated along the last dimension
+        """
+        super().__init__()
+        self.paths = list(paths)
+        self._open()
+        self.register_buffer('_device_anchor', torch.zeros(0), persistent=False)  # follows module.to(device)
+
+    def _open(self):
+        self.tables = [np.load(path, mmap_mode='r') for path in self.paths]
+        if len(set(t.shape[0] for t in self.tables)) != 1:
+            raise ValueError(f'embedding tables {self.paths} have different numbers of rows')
+        self.num_embeddings = self.tables[0].shape[0]
+        self.embedding_dim = sum(t.shape[1] for t in self.tables)
+
+    def size(self, dim=None):
+        size = torch.Size((self.num_embeddings, self.embedding_dim))
+        return size if dim is None else size[dim]
+
+    def forward(self, index):
+        """
+        index: long tensor of any shape
+        returns: float tensor of shape index.size() + (embedding_dim,)
+        """
+        rows = index.reshape(-1).cpu().numpy()
+        vectors = np.concatenate([np.asarray(t[rows], dtype=np.float32) for t in self.tables], 1)
+        return torch.from_numpy(vectors).to(self._device_anchor.device).view(*index.size(), self.embedding_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # checkpoints of the dense nn.Embedding carry the frozen table as weight, which is read from the mapped files here
+        state_dict.pop(prefix + 'weight', None)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['tables']
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._open()
+
+    def extra_repr(self):
+        return '{}, {}, paths={}'.format(self.num_embeddings, self.embedding_dim, self.paths)
+
+
+def load_concept_embeddings(paths, mmap=False, dtype='float32'):
+    """
+    mmap: bool (optional, default False) return a MmapEmbedding instead of loading the concatenated table into memory
+    dtype: str (optional, default 'float32') on-disk precision of the memory-mapped table, a float16 copy of every
+           file is written next to it as {name}.fp16.npy the first time it is needed
+
+    returns: a float tensor of shape (num_concepts, dim) or a MmapEmbedding, both accepted by CustomizedEmbedding
+    """
+    if not mmap:
+        return torch.tensor(np.concatenate([np.load(path) for path in paths], 1), dtype=torch.float)
+    if dtype == 'float16':
+        paths = [half_precision_copy(path) for path in paths]
+    return MmapEmbedding(paths)
+
+
+def half_precision_copy(path, chunk_rows=1 << 16):
+    """
+    returns: the path of a float16 copy of the .npy file path, written in chunks if it does not exist yet
+    """
+    table = np.load(path, mmap_mode='r')
+    if table.dtype == np.float16:
+        return path
+    fp16_path = path[:-len('.npy')] + '.fp16.npy' if path.endswith('.npy') else path + '.fp16.npy'
+    if not os.path.isfile(fp16_path) or os.path.getmtime(fp16_path) < os.path.getmtime(path):
+        tmp_path = fp16_path + '.tmp.npy'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=table.shape)
+        for start in range(0, table.shape[0], chunk_rows):
+            out[start:start + chunk_rows] = table[start:start + chunk_rows]
+        out.flush()
+        del out
+        os.replace(tmp_path, fp16_path)
+        print(f'float16 copy of {path} saved to {fp16_path}')
+    return fp16_path
+
+
 class CustomizedEmbedding(nn.Module):
     def __init__(self, concept_num, concept_in_dim, concept_out_dim, use_contextualized,
                  pretrained_concept_emb=None, freeze_ent_emb=True, scale=1.0, init_range=0.02):
         super().__init__()
         self.scale = scale
         self.use_contextualized = use_contextualized
-        if not use_contextualized:
+        if not use_contextualized and isinstance(pretrained_concept_emb, MmapEmbedding):
+            if not freeze_ent_emb:
+                raise ValueError('a memory-mapped concept embedding table can only be used with freeze_ent_emb')
+            if pretrained_concept_emb.size() != (concept_num, concept_in_dim):
+                raise ValueError(f'expected a concept embedding table of size {(concept_num, concept_in_dim)}, got {tuple(pretrained_concept_emb.size())}')
+            self.emb = pretrained_concept_emb
+        elif not use_contextualized:
             self.emb = nn.Embedding(concept_num, concept_in_dim)
             if pretrained_concept_emb is not None:
                 self.emb.weight.data.copy_(pretrained_concept_emb)
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+__all__ = ['save_packed', 'load_packed', 'PackedWriter', 'gather_ranges']
+
+PACKED_MAGIC = b'KRQAPACK'
+PACKED_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // PACKED_ALIGN) * PACKED_ALIGN
+
+
+def _write_header(fout, meta, specs):
+    """
+    specs: list of (name, dtype, shape)
+    """
+    header = {'meta': meta or {}, 'arrays': {}}
+    offset = 0
+    for name, dtype, shape in specs:
+        header['arrays'][name] = {'dtype': np.dtype(dtype).str, 'shape': list(shape), 'offset': offset}
+        offset += _aligned(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(PACKED_MAGIC) + 8 + len(header_bytes))
+    header_bytes += b' ' * (data_start - len(PACKED_MAGIC) - 8 - len(header_bytes))
+    fout.write(PACKED_MAGIC)
+    fout.write(np.uint64(len(header_bytes)).tobytes())
+    fout.write(header_bytes)
+
+
+def save_packed(path, meta=None, **arrays):
+    """
+    save named numpy arrays into a single binary file that load_packed can memory-map
+
+    layout: magic | header length (uint64) | json header | 64-byte aligned raw arrays
+
+    path: str
+    meta: dict (optional, default None) json-serializable metadata stored in the header
+    arrays: np.ndarray
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    with open(path, 'wb') as fout:
+        _write_header(fout, meta, [(name, arr.dtype, arr.shape) for name, arr in arrays.items()])
+        for arr in arrays.values():
+            fout.write(arr.tobytes())
+            fout.write(b'\0' * (_aligned(arr.nbytes) - arr.nbytes))
+
+
+class PackedWriter(object):
+    """
+    append-only writer of 1-d arrays in the format of save_packed
+
+    Every array is spooled to a temporary file next to `path` while it grows, so memory use does not depend
+    on the amount of data written; close() assembles the packed file.
+    """
+
+    def __init__(self, path, dtypes, meta=None):
+        """
+        dtypes: dict mapping array names to numpy dtypes, in the order they are stored
+        """
+        self.path = path
+        self.meta = meta
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in dtypes.items()}
+        self.counts = {name: 0 for name in dtypes}
+        tmp_dir = os.path.dirname(os.path.abspath(path))
+        self.spools = {name: tempfile.TemporaryFile(dir=tmp_dir) for name in dtypes}
+
+    def append(self, name, values):
+        arr = np.ascontiguousarray(values, dtype=self.dtypes[name]).reshape(-1)
+        self.spools[name].write(arr.tobytes())
+        self.counts[name] += arr.shape[0]
+
+    def close(self):
+        with open(self.path, 'wb') as fout:
+            _write_header(fout, self.meta, [(name, dtype, (self.counts[name],)) for name, dtype in self.dtypes.items()])
+            for name, spool in self.spools.items():
+                nbytes = self.counts[name] * self.dtypes[name].itemsize
+                spool.seek(0)
+                shutil.copyfileobj(spool, fout, 1 << 24)
+                fout.write(b'\0' * (_aligned(nbytes) - nbytes))
+                spool.close()
+
+    def abort(self):
+        for spool in self.spools.values():
+            spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def load_packed(path, mmap=True, mode='r'):
+    """
+    mode: str (optional, default 'r') np.memmap mode, 'c' maps the arrays copy-on-write so that they are writable
+          (e.g. for torch.from_numpy) while the file is never modified
+
+    returns: (arrays, meta) where arrays is a dict of np.memmap (or np.ndarray if mmap is False)
+    """
+    with open(path, 'rb') as fin:
+        if fin.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+            raise ValueError(f'{path} is not a packed array file')
+        header_len = int(np.frombuffer(fin.read(8), dtype=np.uint64)[0])
+        header = json.loads(fin.read(header_len).decode('utf-8'))
+        data_start = len(PACKED_MAGIC) + 8 + header_len
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            count = int(np.prod(shape))
+            if count == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mode, offset=data_start + info['offset'], shape=shape)
+            else:
+                fin.seek(data_start + info['offset'])
+                arrays[name] = np.fromfile(fin, dtype=dtype, count=count).reshape(shape)
+    return arrays, header['meta']
+
+
+def gather_ranges(offsets, indices):
+    """
+    returns: (positions of the items of ranges offsets[i]:offsets[i + 1] for i in indices, offsets of the gathered ranges)
+    """
+    starts, ends = offsets[indices], offsets[indices + 1]
+    counts = ends - starts
+    new_offsets = np.zeros(indices.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1], dtype=np.int64) + np.repeat(starts - new_offsets[:-1], counts)
+    return positions, new_offsets
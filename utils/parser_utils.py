@@ -49,6 +49,8 @@ def add_data_arguments(parser):
     parser.add_argument('--ent_emb', default=['tzw'], choices=['transe', 'numberbatch', 'lm', 'tzw'], nargs='+', help='sources for entity embeddings')
     parser.add_argument('--ent_emb_paths', default=['./data/transe/glove.transe.sgd.ent.npy'], nargs='+', help='paths to entity embedding file(s)')
     parser.add_argument('--rel_emb_path', default='./data/transe/glove.transe.sgd.rel.npy', help='paths to relation embedding file')
+    parser.add_argument('--ent_emb_mmap', default=False, type=bool_flag, nargs='?', const=True, help='keep frozen entity embeddings memory-mapped and gather the rows of every batch')
+    parser.add_argument('--ent_emb_dtype', default='float32', choices=['float32', 'float16'], help='on-disk precision of memory-mapped entity embeddings')
     # dataset specific
     parser.add_argument('-ds', '--dataset', default='csqa', choices=DATASET_LIST, help='dataset name')
     parser.add_argument('-ih', '--inhouse', default=True, type=bool_flag, nargs='?', const=True, help='run in-house setting')
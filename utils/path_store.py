@@ -0,0 +1,219 @@
+import json
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from .packed_utils import PackedWriter, load_packed
+except ImportError:
+    from packed_utils import PackedWriter, load_packed
+
+__all__ = ['PathStoreWriter', 'PathStore', 'open_path_writer', 'load_path_statements', 'is_path_store',
+           'jsonl_to_path_store', 'path_store_to_jsonl']
+
+PATH_STORE_EXT = '.bin'
+
+
+def is_path_store(path):
+    return path.endswith(PATH_STORE_EXT)
+
+
+class PathStoreWriter(object):
+    """
+    streaming columnar binary replacement for the *.paths.*.jsonl files
+
+    Every line of a path jsonl file (a statement) is a list of {"qc", "ac", "pf_res"} dicts, where pf_res is
+    None or a list of {"path": [concept ids], "rel": [[relation ids] for each hop]}. The store flattens this into
+        stmt_qa_offsets, qa_qc, qa_ac, qa_is_none, qa_path_offsets, path_node_offsets, nodes, hop_rel_offsets, rels
+    where the hops of path p are numbered path_node_offsets[p] - p ... path_node_offsets[p + 1] - p - 2.
+    Every statement is appended to disk as soon as it is written.
+    """
+
+    def __init__(self, path, concept2id=None):
+        """
+        concept2id: dict (optional, default None) used to store qc/ac given as concept names as ids
+        """
+        self.concept2id = concept2id
+        self.concept_names = False
+        self.writer = PackedWriter(path, {'stmt_qa_offsets': np.int64, 'qa_qc': np.int32, 'qa_ac': np.int32, 'qa_is_none': np.uint8,
+                                          'qa_path_offsets': np.int64, 'path_node_offsets': np.int64, 'nodes': np.int32,
+                                          'hop_rel_offsets': np.int64, 'rels': np.int32})
+        self.n_qa, self.n_path, self.n_node, self.n_rel = 0, 0, 0, 0
+        for name in ('stmt_qa_offsets', 'qa_path_offsets', 'path_node_offsets', 'hop_rel_offsets'):
+            self.writer.append(name, [0])
+
+    def _concept_id(self, c):
+        if isinstance(c, str):
+            self.concept_names = True
+            return self.concept2id[c]
+        return c
+
+    def write(self, pfr_qa):
+        qa_qc, qa_ac, qa_is_none, qa_path_offsets = [], [], [], []
+        nodes, path_node_offsets, rels, hop_rel_offsets = [], [], [], []
+        for qas in pfr_qa:
+            qa_qc.append(self._concept_id(qas["qc"]))
+            qa_ac.append(self._concept_id(qas["ac"]))
+            qa_is_none.append(qas["pf_res"] is None)
+            for item in qas["pf_res"] or []:
+                nodes.extend(item["path"])
+                path_node_offsets.append(self.n_node + len(nodes))
+                for rl in item["rel"]:
+                    rels.extend(rl)
+                    hop_rel_offsets.append(self.n_rel + len(rels))
+            qa_path_offsets.append(self.n_path + len(path_node_offsets))
+        self.n_qa += len(qa_qc)
+        self.n_path += len(path_node_offsets)
+        self.n_node += len(nodes)
+        self.n_rel += len(rels)
+        for name, values in [('qa_qc', qa_qc), ('qa_ac', qa_ac), ('qa_is_none', qa_is_none), ('qa_path_offsets', qa_path_offsets),
+                             ('nodes', nodes), ('path_node_offsets', path_node_offsets), ('rels', rels),
+                             ('hop_rel_offsets', hop_rel_offsets), ('stmt_qa_offsets', [self.n_qa])]:
+            self.writer.append(name, values)
+
+    def close(self):
+        self.writer.meta = {'format': 'paths', 'version': 1, 'concept_names': self.concept_names}
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+
+class PathStore(object):
+    """
+    zero-copy reader of a file written by PathStoreWriter; the flat arrays are exposed as attributes and
+    indexing returns a statement in the same nested format as a line of the jsonl files
+    """
+
+    def __init__(self, path, id2concept=None, mmap=True):
+        """
+        id2concept: list (optional, default None) if given and the store was written from concept names,
+                    qc/ac are decoded back to names, otherwise they are returned as ids
+        """
+        arrays, self.meta = load_packed(path, mmap=mmap)
+        if self.meta.get('format') != 'paths':
+            raise ValueError(f'{path} is not a path store')
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.id2concept = id2concept if self.meta['concept_names'] else None
+
+    def __len__(self):
+        return self.stmt_qa_offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        qa_start, qa_end = self.stmt_qa_offsets[idx:idx + 2].tolist()
+        qa_path_offsets = self.qa_path_offsets[qa_start:qa_end + 1].tolist()
+        path_start, path_end = qa_path_offsets[0], qa_path_offsets[-1]
+        path_node_offsets = self.path_node_offsets[path_start:path_end + 1].tolist()
+        node_start, node_end = path_node_offsets[0], path_node_offsets[-1]
+        nodes = self.nodes[node_start:node_end].tolist()
+        hop_rel_offsets = self.hop_rel_offsets[node_start - path_start:node_end - path_end + 1].tolist()
+        rels = self.rels[hop_rel_offsets[0]:hop_rel_offsets[-1]].tolist()
+        rel_lists = [rels[a - hop_rel_offsets[0]:b - hop_rel_offsets[0]] for a, b in zip(hop_rel_offsets[:-1], hop_rel_offsets[1:])]
+
+        qcs, acs = self.qa_qc[qa_start:qa_end].tolist(), self.qa_ac[qa_start:qa_end].tolist()
+        if self.id2concept is not None:
+            qcs, acs = [self.id2concept[c] for c in qcs], [self.id2concept[c] for c in acs]
+        is_none = self.qa_is_none[qa_start:qa_end].tolist()
+
+        pfr_qa = []
+        for j in range(qa_end - qa_start):
+            if is_none[j]:
+                pf_res = None
+            else:
+                pf_res = []
+                for p in range(qa_path_offsets[j], qa_path_offsets[j + 1]):
+                    a, b = path_node_offsets[p - path_start] - node_start, path_node_offsets[p - path_start + 1] - node_start
+                    hop_start = a - (p - path_start)
+                    pf_res.append({"path": nodes[a:b], "rel": rel_lists[hop_start:hop_start + b - a - 1]})
+            pfr_qa.append({"ac": acs[j], "qc": qcs[j], "pf_res": pf_res})
+        return pfr_qa
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def path_lengths(self):
+        """
+        returns: np.ndarray of shape (n_path,), number of concepts of every path
+        """
+        return np.diff(self.path_node_offsets)
+
+
+class JsonlPathWriter(object):
+
+    def __init__(self, path):
+        self.fout = open(path, 'w')
+
+    def write(self, pfr_qa):
+        self.fout.write(json.dumps(pfr_qa) + '\n')
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fout.close()
+
+
+def open_path_writer(path, concept2id=None):
+    """
+    returns: a PathStoreWriter if path ends with .bin, otherwise a writer of the jsonl format
+    """
+    if is_path_store(path):
+        return PathStoreWriter(path, concept2id)
+    return JsonlPathWriter(path)
+
+
+def load_path_statements(path, id2concept=None):
+    """
+    returns: (number of statements, iterator over statements) for both the jsonl and the binary format
+    """
+    if is_path_store(path):
+        store = PathStore(path, id2concept=id2concept)
+        return len(store), iter(store)
+    nrow = sum(1 for _ in open(path, 'r'))
+
+    def jsonl_iter():
+        with open(path, 'r') as fin:
+            for line in fin:
+                yield json.loads(line)
+    return nrow, jsonl_iter()
+
+
+def load_cpnet_vocab(cpnet_vocab_path):
+    with open(cpnet_vocab_path, 'r', encoding='utf8') as fin:
+        id2concept = [w.strip() for w in fin]
+    return id2concept, {w: i for i, w in enumerate(id2concept)}
+
+
+def jsonl_to_path_store(jsonl_path, output_path, cpnet_vocab_path=None):
+    """
+    cpnet_vocab_path: str (optional, default None) required if qc/ac are concept names (e.g. raw or pruned paths)
+    """
+    concept2id = load_cpnet_vocab(cpnet_vocab_path)[1] if cpnet_vocab_path is not None else None
+    nrow, statements = load_path_statements(jsonl_path)
+    with PathStoreWriter(output_path, concept2id) as writer:
+        for pfr_qa in tqdm(statements, total=nrow, desc='converting paths'):
+            writer.write(pfr_qa)
+    print(f'path store saved to {output_path}')
+
+
+def path_store_to_jsonl(store_path, output_path, cpnet_vocab_path=None):
+    id2concept = load_cpnet_vocab(cpnet_vocab_path)[0] if cpnet_vocab_path is not None else None
+    nrow, statements = load_path_statements(store_path, id2concept)
+    with open(output_path, 'w') as fout:
+        for pfr_qa in tqdm(statements, total=nrow, desc='converting paths'):
+            fout.write(json.dumps(pfr_qa) + '\n')
+    print(f'paths saved to {output_path}')
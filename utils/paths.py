@@ -6,10 +6,18 @@ from multiprocessing import Pool
 import json
 import random
 import os
+import time
+import gc
+import hashlib
+import sqlite3
 from .conceptnet import merged_relations
+from .path_store import open_path_writer, load_path_statements, is_path_store
+from .graph_store import open_graph_writer
+from .adj_store import load_adj_concept_pairs
+from .utils import sharded_imap
 import pickle
 
-__all__ = ['find_paths', 'score_paths', 'prune_paths']
+__all__ = ['find_paths', 'score_paths', 'prune_paths', 'find_and_prune_paths']
 
 concept2id = None
 id2concept = None
@@ -18,6 +26,12 @@ id2relation = None
 
 cpnet = None
 cpnet_simple = None
+cpnet_csr = None  # (indptr, indices) of cpnet_simple
+cpnet_path = None  # the file cpnet was loaded from
+
+path_cache_path = None
+path_cache_fingerprint = None
+path_cache = None
 
 concept_embs = None
 relation_embs = None
@@ -40,8 +54,9 @@ def load_resources(cpnet_vocab_path):
 
 
 def load_cpnet(cpnet_graph_path):
-    global cpnet, cpnet_simple
+    global cpnet, cpnet_simple, cpnet_csr, cpnet_path
     cpnet = nx.read_gpickle(cpnet_graph_path)
+    cpnet_path = cpnet_graph_path
     cpnet_simple = nx.Graph()
     for u, v, data in cpnet.edges(data=True):
         w = data['weight'] if 'weight' in data else 1.0
@@ -49,6 +64,94 @@ def load_cpnet(cpnet_graph_path):
             cpnet_simple[u][v]['weight'] += w
         else:
             cpnet_simple.add_edge(u, v, weight=w)
+    cpnet_csr = build_csr(cpnet_simple)
+
+
+def build_csr(graph, n_node=None):
+    """
+    convert an undirected networkx graph with integer nodes to a symmetric CSR adjacency
+
+    returns: (indptr, indices), neighbours of node v are indices[indptr[v]:indptr[v + 1]]
+    """
+    edges = np.array(list(graph.edges()), dtype=np.int64).reshape(-1, 2)
+    if n_node is None:
+        n_node = max(graph.nodes()) + 1 if graph.number_of_nodes() > 0 else 0
+    return edges_to_csr(edges[:, 0], edges[:, 1], n_node)
+
+
+def edges_to_csr(src, dst, n_node):
+    """
+    build a symmetric CSR adjacency from undirected edges, duplicate edges and self-loops are dropped
+
+    returns: (indptr, indices)
+    """
+    src, dst = np.concatenate((src, dst)).astype(np.int64), np.concatenate((dst, src)).astype(np.int64)
+    keys = np.unique(src[src != dst] * n_node + dst[src != dst])
+    src, indices = keys // n_node, (keys % n_node).astype(np.int32)
+    indptr = np.zeros(n_node + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n_node), out=indptr[1:])
+    return indptr, indices
+
+
+def gather_neighbors(indptr, indices, nodes):
+    """
+    returns: the concatenated neighbour lists of all nodes in `nodes`
+    """
+    starts = indptr[nodes]
+    lens = indptr[nodes + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lens) + lens, lens)
+    return indices[offsets + np.arange(lens.sum())]
+
+
+def bounded_bfs(indptr, indices, root, depth):
+    """
+    returns: an int8 array with the hop distance of every node within `depth` hops from root, depth + 1 for other nodes
+    """
+    dist = np.full(indptr.shape[0] - 1, depth + 1, dtype=np.int8)
+    dist[root] = 0
+    frontier = np.array([root], dtype=np.int64)
+    for d in range(1, depth + 1):
+        nbrs = gather_neighbors(indptr, indices, frontier)
+        frontier = np.unique(nbrs[dist[nbrs] > d])
+        if frontier.shape[0] == 0:
+            break
+        dist[frontier] = d
+    return dist
+
+
+def bounded_simple_paths(indptr, indices, source, target, max_len, min_len=1):
+    """
+    enumerate all simple paths between source and target with min_len <= #edges <= max_len, in nondecreasing length order
+
+    A bounded BFS from one endpoint gives exact distances within max_len // 2 hops (and a lower bound elsewhere),
+    which prunes a DFS started from the other, lower-degree endpoint so that it only extends prefixes that can
+    still reach the target within the current length budget.
+
+    yields: lists of node ids starting with source and ending with target
+    """
+    reverse = indptr[source + 1] - indptr[source] > indptr[target + 1] - indptr[target]
+    root, goal = (target, source) if reverse else (source, target)
+    dist = bounded_bfs(indptr, indices, goal, max(max_len // 2, 1))
+
+    def dfs(path, on_path, budget):
+        v = path[-1]
+        nbrs = indices[indptr[v]:indptr[v + 1]]
+        for u in nbrs[dist[nbrs] < budget].tolist():
+            if u in on_path:
+                continue
+            if u == goal:
+                if budget == 1:
+                    yield path + [u]
+                continue
+            on_path.add(u)
+            yield from dfs(path + [u], on_path, budget - 1)
+            on_path.remove(u)
+
+    if source == target:
+        return
+    for length in range(max(min_len, int(dist[root])), max_len + 1):
+        for p in dfs([root], {root}, length):
+            yield p[::-1] if reverse else p
 
 
 ##################### path finding #####################
@@ -67,7 +170,7 @@ def find_paths_qa_concept_pair(source: str, target: str, ifprint=False, min_path
     find paths for a (question concept, answer concept) pair
     source and target is text
     """
-    global cpnet, cpnet_simple, concept2id, id2concept, relation2id, id2relation
+    global cpnet, cpnet_simple, cpnet_csr, concept2id, id2concept, relation2id, id2relation
 
     s = concept2id[source]
     t = concept2id[target]
@@ -91,14 +194,11 @@ def find_paths_qa_concept_pair(source: str, target: str, ifprint=False, min_path
     # all_path.sort(key=len, reverse=False)
 
     all_path = []
-    try:
-        for p in nx.shortest_simple_paths(cpnet_simple, source=s, target=t):
-            if len(p) > max_path_length or len(all_path) >= max_num_paths:  # top 100 paths
-                break
-            if len(p) >= min_path_length:  # skip paths of length 1
-                 all_path.append(p)
-    except nx.exception.NetworkXNoPath:
-        pass
+    indptr, indices = cpnet_csr
+    for p in bounded_simple_paths(indptr, indices, s, t, max_len=max_path_length - 1, min_len=max(min_path_length - 1, 1)):
+        if len(all_path) >= max_num_paths:  # top 100 paths
+            break
+        all_path.append(p)
 
     pf_res = []
     for p in all_path:
@@ -128,62 +228,198 @@ def find_paths_qa_concept_pair(source: str, target: str, ifprint=False, min_path
 
 
 def find_paths_from_adj_per_inst(input):
+    """
+    find all paths with at most 3 hops between every (qc, ac) pair of a schema graph, working directly on
+    its (n_rel * n_node, n_node) COO adjacency
+
+    The relations of a hop (u, v) are read from the adjacency as well: r for every adj[r, u, v] and r + n_rel
+    for every adj[r, v, u], which is the relation set of cpnet[u][v] in ascending order.
+
+    returns: (pfr_qa, (cids, src, dst) of the relation-collapsed undirected schema graph, int32 array of shape
+              (n_pair, 3) with the number of paths of 2, 3 and 4 concepts of every pair)
+    """
     adj, concepts, qm, am = input
-    adj = adj.toarray()
     ij, k = adj.shape
-
+    concepts = np.asarray(concepts)
     if k != 0:
-        adj = np.any(adj.reshape(ij // k, k, k), axis=0)
+        n_rel = ij // k
+        rel, src, dst = adj.row // k, adj.row % k, adj.col
     else:
-        adj = np.zeros((0,0))
-    simple_schema_graph = nx.from_numpy_matrix(adj)
-    mapping = {i: int(c) for (i, c) in enumerate(concepts)}
-    simple_schema_graph = nx.relabel_nodes(simple_schema_graph, mapping)
-    qcs, acs = concepts[qm].tolist(), concepts[am].tolist()
+        n_rel = 0
+        rel, src, dst = [np.zeros(0, dtype=np.int64)] * 3
+
+    # relations of every directed local pair (u, v), sorted by key u * k + v and then by relation id
+    keys = np.concatenate((src * k + dst, dst * k + src)).astype(np.int64)
+    rels = np.concatenate((rel, rel + n_rel)).astype(np.int64)
+    order = np.lexsort((rels, keys))
+    keys, rels = keys[order], rels[order]
+
+    indptr, indices = edges_to_csr(src, dst, k)
+    q_idx, a_idx = np.nonzero(qm)[0].tolist(), np.nonzero(am)[0].tolist()
     pfr_qa = []
-    lengths = []
-    for ac in acs:
-        for qc in qcs:
-            if qc not in simple_schema_graph.nodes() or ac not in simple_schema_graph.nodes():
-                print('QA pair doesn\'t exist in schema graph.')
-                pf_res = None
-                lengths.append([0] * 3)
-            else:
-                all_path = []
-                try:
-                    for p in nx.shortest_simple_paths(simple_schema_graph, source=qc, target=ac):
-                        if len(p) >= 5:
-                            break
-                        if len(p) >= 2:  # skip paths of length 1
-                            all_path.append(p)
-                except nx.exception.NetworkXNoPath:
-                    pass
-
-                length = [len(x) for x in all_path]
-                lengths.append([length.count(2), length.count(3), length.count(4)])
-                pf_res = []
+    lengths = np.zeros((len(q_idx) * len(a_idx), 3), dtype=np.int32)
+    for ac in a_idx:
+        for qc in q_idx:
+            all_path = list(bounded_simple_paths(indptr, indices, qc, ac, max_len=3, min_len=1))
+            path_lens = np.array([len(p) for p in all_path], dtype=np.int64)
+            lengths[len(pfr_qa)] = np.bincount(path_lens, minlength=5)[2:5]
+            pf_res = []
+            if all_path:
+                hops = np.array([(p[i], p[i + 1]) for p in all_path for i in range(len(p) - 1)], dtype=np.int64)
+                hop_keys = hops[:, 0] * k + hops[:, 1]
+                lo, hi = np.searchsorted(keys, hop_keys, 'left').tolist(), np.searchsorted(keys, hop_keys, 'right').tolist()
+                rel_lists = rels.tolist()
+                pos = 0
                 for p in all_path:
-                    rl = []
-                    for src in range(len(p) - 1):
-                        src_concept = p[src]
-                        tgt_concept = p[src + 1]
-                        rel_list = get_edge(src_concept, tgt_concept)
-                        rl.append(rel_list)
-                    pf_res.append({"path": p, "rel": rl})
-            pfr_qa.append({"ac": ac, "qc": qc, "pf_res": pf_res})
-    g = nx.convert_node_labels_to_integers(simple_schema_graph, label_attribute='cid')
+                    rl = [rel_lists[lo[h]:hi[h]] for h in range(pos, pos + len(p) - 1)]
+                    pos += len(p) - 1
+                    pf_res.append({"path": concepts[p].tolist(), "rel": rl})
+            pfr_qa.append({"ac": int(concepts[ac]), "qc": int(concepts[qc]), "pf_res": pf_res})
+
+    links = np.unique(np.stack((np.minimum(src, dst), np.maximum(src, dst)), 1), axis=0).astype(np.int32)
+    graph = (concepts.astype(np.int32), links[:, 0], links[:, 1])
+    return pfr_qa, graph, lengths
 
-    return pfr_qa, nx.node_link_data(g), lengths
+
+##################### path cache #####################
+
+
+PATH_CACHE_VERSION = 1  # bump when the path enumeration changes so that stale entries are not reused
+
+
+def get_graph_fingerprint(*file_paths, chunk_size=1 << 24):
+    """
+    hash the content of the files that determine the paths (the graph and the concept vocabulary)
+    """
+    h = hashlib.sha1(str(PATH_CACHE_VERSION).encode())
+    for path in file_paths:
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_paths(pf_res):
+    """
+    encode the output of find_paths_qa_concept_pair as a flat int32 buffer:
+    [#paths, path lengths, #relations per hop, concept ids, relation ids]; None is encoded as b''
+    """
+    if pf_res is None:
+        return b''
+    path_lens = [len(item["path"]) for item in pf_res]
+    rel_nums = [len(rl) for item in pf_res for rl in item["rel"]]
+    concepts = [c for item in pf_res for c in item["path"]]
+    rels = [r for item in pf_res for rl in item["rel"] for r in rl]
+    return np.array([len(pf_res)] + path_lens + rel_nums + concepts + rels, dtype=np.int32).tobytes()
+
+
+def decode_paths(blob):
+    if len(blob) == 0:
+        return None
+    arr = np.frombuffer(blob, dtype=np.int32).tolist()
+    n_path = arr[0]
+    path_lens = arr[1:1 + n_path]
+    n_hop = sum(path_lens) - n_path
+    rel_nums = arr[1 + n_path:1 + n_path + n_hop]
+    concepts = arr[1 + n_path + n_hop:1 + n_path + n_hop + sum(path_lens)]
+    rels = arr[1 + n_path + n_hop + sum(path_lens):]
+    pf_res = []
+    c_pos, h_pos, r_pos = 0, 0, 0
+    for path_len in path_lens:
+        rl = []
+        for rel_num in rel_nums[h_pos:h_pos + path_len - 1]:
+            rl.append(rels[r_pos:r_pos + rel_num])
+            r_pos += rel_num
+        pf_res.append({"path": concepts[c_pos:c_pos + path_len], "rel": rl})
+        c_pos += path_len
+        h_pos += path_len - 1
+    return pf_res
+
+
+class PathCache(object):
+    """
+    sqlite-backed cache of (question concept, answer concept) paths that can be shared across datasets and splits
+    """
+
+    def __init__(self, cache_path, fingerprint):
+        self.fingerprint = fingerprint
+        self.conn = sqlite3.connect(cache_path, timeout=600)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS paths (src INTEGER, tgt INTEGER, min_len INTEGER, max_len INTEGER, max_num INTEGER, '
+                          'fingerprint TEXT, seconds REAL, value BLOB, PRIMARY KEY (src, tgt, min_len, max_len, max_num, fingerprint))')
+        self.conn.commit()
+
+    def get(self, src, tgt, min_len, max_len, max_num):
+        """
+        returns: (pf_res, seconds it took to compute) or None if the pair is not cached
+        """
+        row = self.conn.execute('SELECT value, seconds FROM paths WHERE src=? AND tgt=? AND min_len=? AND max_len=? AND max_num=? AND fingerprint=?',
+                                (src, tgt, min_len, max_len, max_num, self.fingerprint)).fetchone()
+        if row is None:
+            return None
+        return decode_paths(row[0]), row[1]
+
+    def put_many(self, entries):
+        """
+        entries: list of (src, tgt, min_len, max_len, max_num, seconds, encoded value)
+        """
+        self.conn.executemany('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              [(*e[:5], self.fingerprint, *e[5:]) for e in entries])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def init_path_cache(cache_path, cpnet_graph_path, cpnet_vocab_path):
+    """
+    point the workers to the cache and open it for writing in the main process
+
+    returns: PathCache or None if cache_path is None
+    """
+    global path_cache_path, path_cache_fingerprint, path_cache
+    if cache_path is None:
+        return None
+    if path_cache_fingerprint is None or path_cache_path != cache_path:
+        path_cache_fingerprint = get_graph_fingerprint(cpnet_graph_path, cpnet_vocab_path)
+    path_cache_path = cache_path
+    path_cache = None  # opened lazily by each worker
+    return PathCache(cache_path, path_cache_fingerprint)
+
+
+def print_path_cache_stats(n_hit, n_miss, time_saved):
+    n_total = n_hit + n_miss
+    print('path cache hits: {}/{} ({:.2%})   estimated time saved: {:.1f}s (summed over workers)'.format(
+        n_hit, n_total, n_hit / n_total if n_total > 0 else 0.0, time_saved))
 
 
 def find_paths_qa_pair(qa_pair):
+    """
+    returns: (pfr_qa, new cache entries, (#hits, #misses, seconds saved by hits))
+    """
+    global path_cache
     acs, qcs, min_path_length, max_path_length, max_num_paths = qa_pair
+    if path_cache is None and path_cache_path is not None:
+        path_cache = PathCache(path_cache_path, path_cache_fingerprint)
     pfr_qa = []
+    new_entries = []
+    n_hit, n_miss, time_saved = 0, 0, 0.0
     for ac in acs:
         for qc in qcs:
-            pf_res = find_paths_qa_concept_pair(qc, ac, min_path_length=min_path_length, max_path_length=max_path_length, max_num_paths=max_num_paths)
+            key = (concept2id[qc], concept2id[ac], min_path_length, max_path_length, max_num_paths)
+            cached = path_cache.get(*key) if path_cache is not None else None
+            if cached is not None:
+                pf_res, seconds = cached
+                n_hit += 1
+                time_saved += seconds
+            else:
+                start = time.time()
+                pf_res = find_paths_qa_concept_pair(qc, ac, min_path_length=min_path_length, max_path_length=max_path_length, max_num_paths=max_num_paths)
+                n_miss += 1
+                if path_cache is not None:
+                    new_entries.append((*key, time.time() - start, encode_paths(pf_res)))
             pfr_qa.append({"ac": ac, "qc": qc, "pf_res": pf_res})
-    return pfr_qa
+    return pfr_qa, new_entries, (n_hit, n_miss, time_saved)
 
 
 ##################### path scoring #####################
@@ -256,45 +492,230 @@ def score_triples(concept_id, relation_id, debug=False):
     return res
 
 
+def get_candidate_relations(rel_list):
+    """
+    returns: the relation ids to be scored for one hop, symmetric relations (antonym, relatedto)
+             are also scored in the opposite direction
+    """
+    rel_set = set(rel_list)
+    for r, inv_r in ((0, N_RELATIONS), (RELATED_TO, INV_RELATED_TO)):
+        if r in rel_set or inv_r in rel_set:
+            rel_set.update((r, inv_r))
+    return rel_set
+
+
 def score_qa_pairs(qa_pairs):
+    """
+    score all paths of a statement at once, equivalent to calling score_triples on every path:
+    each hop takes the best (1 + cos(r, t - h)) / 2 over its candidate relations (h and t are swapped
+    for inverse relations) and a path's score is the product over its hops
+    """
+    global relation_embs, concept_embs
+    heads, tails, path_hop_nums = [], [], []
+    cand_hops, cand_rels = [], []
+    for qas in qa_pairs:
+        if qas["pf_res"] is None:
+            continue
+        for path in qas["pf_res"]:
+            for h, t, rl in zip(path["path"][:-1], path["path"][1:], path["rel"]):
+                cand = get_candidate_relations(rl)
+                cand_hops.extend([len(heads)] * len(cand))
+                cand_rels.extend(cand)
+                heads.append(h)
+                tails.append(t)
+            path_hop_nums.append(len(path["path"]) - 1)
+
+    hop_scores = np.full(len(heads), -10.0)
+    if len(cand_hops) > 0:
+        diff = (concept_embs[tails] - concept_embs[heads]).astype(np.float64)
+        rel_embs = relation_embs.astype(np.float64)
+        cand_hops = np.array(cand_hops, dtype=np.int64)
+        cand_rels = np.array(cand_rels, dtype=np.int64)
+        sign = np.where(cand_rels >= N_RELATIONS, -1.0, 1.0)
+        cand_rels = cand_rels % N_RELATIONS
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dot = (diff @ rel_embs.T)[cand_hops, cand_rels]
+            cos = dot / (np.linalg.norm(diff, axis=1)[cand_hops] * np.linalg.norm(rel_embs, axis=1)[cand_rels])
+        scores = (1 + sign * cos) / 2
+        scores[np.isnan(scores)] = -10.0  # scipy's cosine distance is nan for zero vectors, which score_triple ignores
+        np.maximum.at(hop_scores, cand_hops, scores)
+
+    path_hop_nums = np.array(path_hop_nums, dtype=np.int64)
+    path_scores = np.ones(path_hop_nums.shape[0])
+    nonempty = path_hop_nums > 0
+    if nonempty.any():
+        starts = np.cumsum(path_hop_nums) - path_hop_nums
+        path_scores[nonempty] = np.multiply.reduceat(hop_scores, starts[nonempty])
+    path_scores = path_scores.tolist()
+
     statement_scores = []
+    pos = 0
     for qas in qa_pairs:
-        statement_paths = qas["pf_res"]
-        if statement_paths is not None:
-            path_scores = []
-            for path in statement_paths:
-                #assert len(path["path"]) > 1
-                score = score_triples(concept_id=path["path"], relation_id=path["rel"])
-                path_scores.append(score)
-            statement_scores.append(path_scores)
+        if qas["pf_res"] is not None:
+            statement_scores.append(path_scores[pos:pos + len(qas["pf_res"])])
+            pos += len(qas["pf_res"])
         else:
             statement_scores.append(None)
     return statement_scores
 
 
+##################### path pruning #####################
+
+
+def prune_qa_pairs(qa_pairs, qa_pairs_scores, threshold):
+    """
+    drop (in place) the paths whose score is below threshold
+
+    returns: (#paths before pruning, #paths after pruning)
+    """
+    ori_len = 0
+    pruned_len = 0
+    for qas, qas_scores in zip(qa_pairs, qa_pairs_scores):
+        ori_paths = qas['pf_res']
+        if ori_paths is not None:
+            pruned_paths = [p for p, s in zip(ori_paths, qas_scores) if s >= threshold]
+            ori_len += len(ori_paths)
+            pruned_len += len(pruned_paths)
+            assert len(ori_paths) >= len(pruned_paths)
+            qas['pf_res'] = pruned_paths
+    return ori_len, pruned_len
+
+
+def find_score_prune_qa_pair(qa_pair):
+    """
+    find, score and prune the paths of one statement without writing the intermediate results
+
+    returns: (pruned pfr_qa, new cache entries, cache stats, (#paths, #kept paths), scores of all found paths)
+    """
+    *find_args, threshold = qa_pair
+    pfr_qa, new_entries, cache_stats = find_paths_qa_pair(find_args)
+    qa_pairs_scores = score_qa_pairs(pfr_qa)
+    lens = prune_qa_pairs(pfr_qa, qa_pairs_scores, threshold)
+    scores = np.array([s for qas_scores in qa_pairs_scores if qas_scores is not None for s in qas_scores], dtype=np.float32)
+    return pfr_qa, new_entries, cache_stats, lens, scores
+
+
+##################### relational paths #####################
+
+
+def enumerate_relational_tuples(qc, ac, rel_offsets, rels, hop1, hop2):
+    """
+    expand candidate one-/two-hop paths into deduplicated (qc, ac, r1, r2) relational tuples
+
+    qc, ac: int arrays of shape (n_cand,), endpoints of every candidate path
+    rel_offsets, rels: ragged relation lists of the hops, hop h has relations rels[rel_offsets[h]:rel_offsets[h + 1]]
+    hop1, hop2: int arrays of shape (n_cand,), hop index of the first/second hop of every candidate (hop2 = -1 for one-hop paths)
+    returns: (qc, ac, r1, r2) int64 arrays in order of first occurrence, r2 = -1 for one-hop tuples
+    """
+    qc, ac, hop1, hop2 = [np.asarray(x, dtype=np.int64) for x in (qc, ac, hop1, hop2)]
+    rel_offsets, rels = np.asarray(rel_offsets, dtype=np.int64), np.asarray(rels, dtype=np.int64)
+    is_2hop = hop2 >= 0
+    n1 = rel_offsets[hop1 + 1] - rel_offsets[hop1]
+    n2 = np.where(is_2hop, rel_offsets[hop2 + 1] - rel_offsets[np.maximum(hop2, 0)], 1)
+    sizes = n1 * n2
+    cand = np.repeat(np.arange(qc.shape[0]), sizes)
+    within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    r1 = rels[rel_offsets[hop1[cand]] + within // n2[cand]]
+    r2 = np.where(is_2hop[cand], rels[rel_offsets[np.maximum(hop2[cand], 0)] + within % n2[cand]], -1)
+    qc, ac = qc[cand], ac[cand]
+    if qc.shape[0] == 0:
+        return qc, ac, r1, r2
+
+    # pack (qc, ac, r1, r2) into one integer key, concept ids are first mapped to their rank
+    _, q_rank = np.unique(qc, return_inverse=True)
+    _, a_rank = np.unique(ac, return_inverse=True)
+    n_r = int(rels.max()) + 2
+    keys = ((q_rank * (int(a_rank.max()) + 1) + a_rank) * n_r + r1) * n_r + (r2 + 1)
+    _, first = np.unique(keys, return_index=True)
+    first.sort()
+    return qc[first], ac[first], r1[first], r2[first]
+
+
+def relational_tuples_to_json(qc, ac, r1, r2):
+    # the cyclic gc is paused while the (acyclic) dicts are built, otherwise it dominates for large statements
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [{'qc': q, 'ac': a, 'rel': [x] if y < 0 else [x, y]} for q, a, x, y in zip(qc.tolist(), ac.tolist(), r1.tolist(), r2.tolist())]
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
 def find_relational_paths_from_paths_per_inst(path_dic):
-    qcs = set()
-    acs = set()
-    seen = set()
-    rel_list = []
+    qcs, acs = {}, {}
+    qc, ac, hop1, hop2 = [], [], [], []
+    hop_rels, rel_offsets = [], [0]
     for qa_pair_dic in path_dic:
-        qcs.add(qa_pair_dic['qc'])
-        acs.add(qa_pair_dic['ac'])
+        qcs.setdefault(qa_pair_dic['qc'])
+        acs.setdefault(qa_pair_dic['ac'])
         if qa_pair_dic['pf_res'] is None:
             continue
         for path in qa_pair_dic['pf_res']:
-            if len(path['path']) == 2:
-                for r in path['rel'][0]:
-                    if (path['path'][0], path['path'][-1], r) not in seen:
-                        rel_list.append({'qc': path['path'][0], 'ac': path['path'][-1], 'rel': [r]})
-                        seen.add((path['path'][0], path['path'][-1], r))
-            elif len(path['path']) == 3:
-                for r1 in path['rel'][0]:
-                    for r2 in path['rel'][1]:
-                        if (path['path'][0], path['path'][-1], r1, r2) not in seen:
-                            rel_list.append({'qc': path['path'][0], 'ac': path['path'][-1], 'rel': [r1, r2]})
-                            seen.add((path['path'][0], path['path'][-1], r1, r2))
-    pfr_qa = {'acs': list(acs), 'qcs': list(qcs), 'paths': rel_list}
+            if len(path['path']) not in (2, 3):
+                continue
+            qc.append(path['path'][0])
+            ac.append(path['path'][-1])
+            hop1.append(len(rel_offsets) - 1)
+            hop2.append(len(rel_offsets) if len(path['path']) == 3 else -1)
+            for rl in path['rel'][:len(path['path']) - 1]:
+                hop_rels.extend(rl)
+                rel_offsets.append(len(hop_rels))
+    tuples = enumerate_relational_tuples(qc, ac, rel_offsets, hop_rels, hop1, hop2)
+    pfr_qa = {'acs': list(acs), 'qcs': list(qcs), 'paths': relational_tuples_to_json(*tuples)}
+    return pfr_qa
+
+
+def find_relational_paths_from_adj_per_inst(input):
+    """
+    same output as find_relational_paths_from_paths_per_inst, but the one-/two-hop paths between question and
+    answer concepts are read from a (n_rel * n_node, n_node) COO schema graph
+    """
+    adj, concepts, qm, am = input
+    ij, k = adj.shape
+    concepts = np.asarray(concepts, dtype=np.int64)
+    q_idx, a_idx = np.nonzero(qm)[0], np.nonzero(am)[0]
+    pfr_qa = {'acs': concepts[a_idx].tolist(), 'qcs': concepts[q_idx].tolist(), 'paths': []}
+    if k == 0 or adj.nnz == 0:
+        return pfr_qa
+    n_rel = ij // k
+    rel, src, dst = adj.row // k, adj.row % k, adj.col
+
+    # one relation group per directed local pair (u, v): r for adj[r, u, v] and r + n_rel for adj[r, v, u]
+    keys = np.concatenate((src * k + dst, dst * k + src)).astype(np.int64)
+    rels = np.concatenate((rel, rel + n_rel)).astype(np.int64)
+    order = np.lexsort((rels, keys))
+    keys, rels = keys[order], rels[order]
+    pair_keys, rel_offsets = np.unique(keys, return_index=True)
+    rel_offsets = np.append(rel_offsets, keys.shape[0])
+    pair_u, pair_v = pair_keys // k, pair_keys % k
+    is_q, is_a = np.zeros(k, dtype=bool), np.zeros(k, dtype=bool)
+    is_q[q_idx], is_a[a_idx] = True, True
+
+    # one-hop: q -> a, two-hop: q -> m -> a joined on m
+    one_hop = np.nonzero(is_q[pair_u] & is_a[pair_v])[0]
+    first = np.nonzero(is_q[pair_u])[0]
+    second = np.nonzero(is_a[pair_v])[0]
+    second = second[np.argsort(pair_u[second], kind='stable')]
+    lo = np.searchsorted(pair_u[second], pair_v[first], 'left')
+    hi = np.searchsorted(pair_u[second], pair_v[first], 'right')
+    n_match = hi - lo
+    hop1 = np.repeat(first, n_match)
+    hop2 = second[np.repeat(lo, n_match) + np.arange(n_match.sum()) - np.repeat(np.cumsum(n_match) - n_match, n_match)]
+    valid = pair_u[hop1] != pair_v[hop2]
+    hop1, hop2 = hop1[valid], hop2[valid]
+
+    cand_hop1 = np.concatenate((one_hop, hop1))
+    cand_hop2 = np.concatenate((np.full(one_hop.shape[0], -1, dtype=np.int64), hop2))
+    cand_u = pair_u[cand_hop1]
+    cand_v = np.where(cand_hop2 >= 0, pair_v[np.maximum(cand_hop2, 0)], pair_v[cand_hop1])
+    # group the tuples by (ac, qc) pair in mask order, one-hop before two-hop paths
+    q_pos, a_pos = np.zeros(k, dtype=np.int64), np.zeros(k, dtype=np.int64)
+    q_pos[q_idx], a_pos[a_idx] = np.arange(q_idx.shape[0]), np.arange(a_idx.shape[0])
+    order = np.lexsort((cand_hop2 >= 0, q_pos[cand_u], a_pos[cand_v]))
+    cand_q, cand_a = concepts[cand_u], concepts[cand_v]
+    tuples = enumerate_relational_tuples(cand_q[order], cand_a[order], rel_offsets, rels, cand_hop1[order], cand_hop2[order])
+    pfr_qa['paths'] = relational_tuples_to_json(*tuples)
     return pfr_qa
 
 
@@ -302,7 +723,11 @@ def find_relational_paths_from_paths_per_inst(path_dic):
 #                     functions below this line will be called by preprocess.py                     #
 #####################################################################################################
 
-def find_paths(grounded_path, cpnet_vocab_path, cpnet_graph_path, output_path, num_processes=1, random_state=0, min_path_length=2, max_path_length=5, max_num_paths=100):
+def find_paths(grounded_path, cpnet_vocab_path, cpnet_graph_path, output_path, num_processes=1, random_state=0, min_path_length=2, max_path_length=5, max_num_paths=100,
+               cache_path=None, cache_flush_interval=1000):
+    """
+    cache_path: str (optional, default None) sqlite file that caches the paths of every (qc, ac) pair across calls
+    """
     print(f'generating paths for {grounded_path}...')
     random.seed(random_state)
     np.random.seed(random_state)
@@ -313,32 +738,45 @@ def find_paths(grounded_path, cpnet_vocab_path, cpnet_graph_path, output_path, n
     if cpnet is None or cpnet_simple is None:
         load_cpnet(cpnet_graph_path)
 
+    cache = init_path_cache(cache_path, cpnet_graph_path, cpnet_vocab_path)
+
     with open(grounded_path, 'r') as fin:
         data = [json.loads(line) for line in fin]
     data = [[item["ac"], item["qc"], min_path_length, max_path_length, max_num_paths] for item in data]
 
-    with Pool(num_processes) as p, open(output_path, 'w') as fout:
-        for pfr_qa in tqdm(p.imap(find_paths_qa_pair, data), total=len(data)):
-            fout.write(json.dumps(pfr_qa) + '\n')
+    n_hit, n_miss, time_saved = 0, 0, 0.0
+    pending = []
+    with Pool(num_processes) as p, open_path_writer(output_path, concept2id) as fout:
+        for pfr_qa, new_entries, (hit, miss, saved) in tqdm(p.imap(find_paths_qa_pair, data), total=len(data)):
+            fout.write(pfr_qa)
+            n_hit, n_miss, time_saved = n_hit + hit, n_miss + miss, time_saved + saved
+            pending.extend(new_entries)
+            if cache is not None and len(pending) >= cache_flush_interval:
+                cache.put_many(pending)
+                pending = []
+
+    if cache is not None:
+        cache.put_many(pending)
+        cache.close()
+        print_path_cache_stats(n_hit, n_miss, time_saved)
 
     print(f'paths saved to {output_path}')
     print()
 
 
 def generate_path_and_graph_from_adj(adj_path, cpnet_graph_path, output_path, graph_output_path, num_processes=1, random_state=0, dump_len=False):
+    """
+    cpnet_graph_path is kept for backward compatibility, paths and relations are read from the adjacency matrices
+    """
     print(f'generating paths for {adj_path}...')
-    global cpnet
-    if cpnet is None:
-        cpnet = nx.read_gpickle(cpnet_graph_path)
     random.seed(random_state)
     np.random.seed(random_state)
-    with open(adj_path, 'rb') as fin:
-        adj_concept_pairs = pickle.load(fin)  # (adj, concepts, qm, am)
+    adj_concept_pairs = load_adj_concept_pairs(adj_path)  # (adj, concepts, qm, am)
     all_len = []
-    with Pool(num_processes) as p, open(output_path, 'w') as path_output, open(graph_output_path, 'w') as graph_output:
+    with Pool(num_processes) as p, open_path_writer(output_path) as path_output, open_graph_writer(graph_output_path) as graph_output:
         for pfr_qa, graph, lengths in tqdm(p.imap(find_paths_from_adj_per_inst, adj_concept_pairs), total=len(adj_concept_pairs), desc='Searching for paths'):
-            path_output.write(json.dumps(pfr_qa) + '\n')
-            graph_output.write(json.dumps(graph) + '\n')
+            path_output.write(pfr_qa)
+            graph_output.write(*graph)
             all_len.append(lengths)
     if dump_len:
         with open(adj_path+'.len.pk', 'wb') as f:
@@ -364,38 +802,39 @@ def score_paths(raw_paths_path, concept_emb_path, rel_emb_path, cpnet_vocab_path
     if method != 'triple_cls':
         raise NotImplementedError()
 
-    all_scores = []
-    with open(raw_paths_path, 'r') as fin:
-        data = [json.loads(line) for line in fin]
+    nrow, data = load_path_statements(raw_paths_path)
 
     with Pool(num_processes) as p, open(output_path, 'w') as fout:
-        for statement_scores in tqdm(p.imap(score_qa_pairs, data), total=len(data)):
+        for statement_scores in tqdm(p.imap(score_qa_pairs, data), total=nrow):
             fout.write(json.dumps(statement_scores) + '\n')
 
     print(f'path scores saved to {output_path}')
     print()
 
 
-def prune_paths(raw_paths_path, path_scores_path, output_path, threshold, verbose=True):
+def prune_paths(raw_paths_path, path_scores_path, output_path, threshold, cpnet_vocab_path=None, verbose=True):
+    """
+    cpnet_vocab_path: str (optional, default None) needed when raw_paths_path or output_path is a path store,
+                      which keeps qc/ac as ids and maps them from/to concept names with the vocab
+    """
     print(f'pruning paths for {raw_paths_path}...')
+    global concept2id, id2concept, relation2id, id2relation
+    if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
+        if cpnet_vocab_path is not None:
+            load_resources(cpnet_vocab_path)
+        elif is_path_store(raw_paths_path) or is_path_store(output_path):
+            raise ValueError('cpnet_vocab_path is required to prune paths from or to a path store')
     ori_len = 0
     pruned_len = 0
-    nrow = sum(1 for _ in open(raw_paths_path, 'r'))
-    with open(raw_paths_path, 'r') as fin_raw, \
-            open(path_scores_path, 'r') as fin_score, \
-            open(output_path, 'w') as fout:
-        for line_raw, line_score in tqdm(zip(fin_raw, fin_score), total=nrow):
-            qa_pairs = json.loads(line_raw)
+    nrow, raw_data = load_path_statements(raw_paths_path, id2concept)
+    with open(path_scores_path, 'r') as fin_score, \
+            open_path_writer(output_path, concept2id) as fout:
+        for qa_pairs, line_score in tqdm(zip(raw_data, fin_score), total=nrow):
             qa_pairs_scores = json.loads(line_score)
-            for qas, qas_scores in zip(qa_pairs, qa_pairs_scores):
-                ori_paths = qas['pf_res']
-                if ori_paths is not None:
-                    pruned_paths = [p for p, s in zip(ori_paths, qas_scores) if s >= threshold]
-                    ori_len += len(ori_paths)
-                    pruned_len += len(pruned_paths)
-                    assert len(ori_paths) >= len(pruned_paths)
-                    qas['pf_res'] = pruned_paths
-            fout.write(json.dumps(qa_pairs) + '\n')
+            n_ori, n_pruned = prune_qa_pairs(qa_pairs, qa_pairs_scores, threshold)
+            ori_len += n_ori
+            pruned_len += n_pruned
+            fout.write(qa_pairs)
 
     if verbose:
         if ori_len != 0:
@@ -408,12 +847,139 @@ def prune_paths(raw_paths_path, path_scores_path, output_path, threshold, verbos
     print()
 
 
+def find_and_prune_paths(grounded_path, cpnet_vocab_path, cpnet_graph_path, concept_emb_path, rel_emb_path, output_path, threshold,
+                         num_processes=1, random_state=0, min_path_length=2, max_path_length=5, max_num_paths=100,
+                         cache_path=None, cache_flush_interval=1000, histogram_path=None, n_bins=100, shard_size=1000):
+    """
+    fused version of find_paths -> score_paths -> prune_paths: every statement is streamed through path finding,
+    scoring and pruning in a worker and only the pruned paths are written, so neither the raw paths nor the
+    scores are ever written to disk or held in memory for the whole split
+
+    shard_size: int (optional, default 1000) statements are handed to the pool shard by shard, so at most
+                shard_size statements and their results are in memory at any time
+
+    histogram_path: str (optional, default None) if given, save histograms (np.savez) of the scores of all found
+                    paths and of the kept paths, with scores clipped to [0, 1]
+    """
+    print(f'generating, scoring and pruning paths for {grounded_path}...')
+    random.seed(random_state)
+    np.random.seed(random_state)
+
+    global concept2id, id2concept, relation2id, id2relation, cpnet_simple, cpnet
+    if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
+        load_resources(cpnet_vocab_path)
+    if cpnet is None or cpnet_simple is None:
+        load_cpnet(cpnet_graph_path)
+
+    global concept_embs, relation_embs
+    if concept_embs is None:
+        concept_embs = np.load(concept_emb_path)
+    if relation_embs is None:
+        relation_embs = np.load(rel_emb_path)
+
+    cache = init_path_cache(cache_path, cpnet_graph_path, cpnet_vocab_path)
+
+    def data_iter(fin):
+        for line in fin:
+            item = json.loads(line)
+            yield [item["ac"], item["qc"], min_path_length, max_path_length, max_num_paths, threshold]
+
+    bin_edges = np.linspace(0, 1, n_bins + 1)
+    all_hist = np.zeros(n_bins, dtype=np.int64)
+    kept_hist = np.zeros(n_bins, dtype=np.int64)
+    n_hit, n_miss, time_saved = 0, 0, 0.0
+    ori_len, pruned_len = 0, 0
+    pending = []
+    nrow = sum(1 for _ in open(grounded_path, 'r'))
+    with Pool(num_processes) as p, open(grounded_path, 'r') as fin, open_path_writer(output_path, concept2id) as fout:
+        for pfr_qa, new_entries, (hit, miss, saved), (n_ori, n_pruned), scores in tqdm(sharded_imap(p, find_score_prune_qa_pair, data_iter(fin), shard_size), total=nrow):
+            fout.write(pfr_qa)
+            n_hit, n_miss, time_saved = n_hit + hit, n_miss + miss, time_saved + saved
+            ori_len += n_ori
+            pruned_len += n_pruned
+            if histogram_path is not None:
+                clipped = np.clip(scores, 0, 1)
+                all_hist += np.histogram(clipped, bins=bin_edges)[0]
+                kept_hist += np.histogram(clipped[scores >= threshold], bins=bin_edges)[0]
+            pending.extend(new_entries)
+            if cache is not None and len(pending) >= cache_flush_interval:
+                cache.put_many(pending)
+                pending = []
+
+    if cache is not None:
+        cache.put_many(pending)
+        cache.close()
+        print_path_cache_stats(n_hit, n_miss, time_saved)
+
+    print("ori_len: {}   pruned_len: {}   keep_rate: {:.4f}".format(ori_len, pruned_len, pruned_len / ori_len if ori_len != 0 else pruned_len))
+    if histogram_path is not None:
+        np.savez(histogram_path, bin_edges=bin_edges, all=all_hist, kept=kept_hist)
+        print(f'path score histograms saved to {histogram_path}')
+    print(f'pruned paths saved to {output_path}')
+    print()
+
+
+def find_relational_paths_from_adj(adj_path, output_path, num_processes):
+    print(f'extracting relational paths from {adj_path}...')
+    adj_concept_pairs = load_adj_concept_pairs(adj_path)  # (adj, concepts, qm, am)
+    with Pool(num_processes) as p, open(output_path, 'w') as fout:
+        for pfr_qa in tqdm(p.imap(find_relational_paths_from_adj_per_inst, adj_concept_pairs), total=len(adj_concept_pairs)):
+            fout.write(json.dumps(pfr_qa) + '\n')
+    print(f'paths saved to {output_path}')
+    print()
+
+
 def find_relational_paths_from_paths(pruned_paths_path, output_path, num_processes):
     print(f'extracting relational paths from {pruned_paths_path}...')
-    with open(pruned_paths_path, 'r') as fin:
-        path_data = [json.loads(line) for line in fin]
+    nrow, path_data = load_path_statements(pruned_paths_path)
     with Pool(num_processes) as p, open(output_path, 'w') as fout:
-        for pfr_qa in tqdm(p.imap(find_relational_paths_from_paths_per_inst, path_data), total=len(path_data)):
+        for pfr_qa in tqdm(p.imap(find_relational_paths_from_paths_per_inst, path_data), total=nrow):
             fout.write(json.dumps(pfr_qa) + '\n')
     print(f'paths saved to {output_path}')
     print()
+
+
+def run_test():
+    import copy
+    print('testing score_qa_pairs against score_triples...')
+    global concept_embs, relation_embs
+    old_embs = concept_embs, relation_embs
+    rng = np.random.RandomState(0)
+    random.seed(0)
+
+    def random_statement(n_concept):
+        qa_pairs = []
+        for _ in range(4):
+            if random.random() < 0.2:
+                qa_pairs.append({"qc": 0, "ac": 1, "pf_res": None})
+                continue
+            pf_res = []
+            for _ in range(random.randint(0, 5)):
+                path = [random.randrange(n_concept) for _ in range(random.randint(2, 5))]
+                if random.random() < 0.2:
+                    path[0], path[1] = 3, 4  # concepts 3 and 4 share an embedding: zero-length hop vector
+                rel = [random.sample(range(2 * N_RELATIONS), random.randint(1, 3)) for _ in range(len(path) - 1)]
+                for rl in rel:
+                    if random.random() < 0.3:
+                        rl[0] = random.choice((0, N_RELATIONS, RELATED_TO, INV_RELATED_TO))  # symmetric relations
+                pf_res.append({"path": path, "rel": rel})
+            qa_pairs.append({"qc": 0, "ac": 1, "pf_res": pf_res})
+        return qa_pairs
+
+    for dtype, tol in ((np.float64, 1e-10), (np.float32, 5e-5)):
+        concept_embs = rng.randn(50, 8).astype(dtype)
+        concept_embs[4] = concept_embs[3]
+        relation_embs = rng.randn(N_RELATIONS, 8).astype(dtype)
+        max_diff = 0.0
+        for _ in range(200):
+            qa_pairs = random_statement(concept_embs.shape[0])
+            for scores, qas in zip(score_qa_pairs(copy.deepcopy(qa_pairs)), qa_pairs):
+                if qas["pf_res"] is None:
+                    assert scores is None
+                    continue
+                assert len(scores) == len(qas["pf_res"])
+                for score, path in zip(scores, qas["pf_res"]):
+                    max_diff = max(max_diff, abs(score - score_triples(path["path"], copy.deepcopy(path["rel"]))))
+        print(f'{np.dtype(dtype).name} embeddings: max abs difference {max_diff:.2e}')
+        assert max_diff < tol
+    concept_embs, relation_embs = old_embs
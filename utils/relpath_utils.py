@@ -1,7 +1,8 @@
-import networkx as nx
 from multiprocessing import Pool
 from tqdm import tqdm
 from utils.conceptnet import merged_relations
+from utils import paths as path_utils
+from utils.paths import enumerate_relational_tuples, relational_tuples_to_json
 from utils.layers import *
 from utils.utils import *
 
@@ -11,64 +12,44 @@ id2relation = None
 relation2id = None
 cpnet = None
 cpnet_simple = None
+cpnet_csr = None  # (indptr, indices) of cpnet_simple
 
 
-def get_rel_paths(path):
-    if len(path) == 2:
-        rel_list = cpnet[path[0]][path[1]]
-        seen = set()
-        res = [r['rel'] for r in rel_list.values() if r['rel'] not in seen and (seen.add(r['rel']) or True)]
-        res = [(r,) for r in res]
-        return res
-    elif len(path) == 3:
-        rel_list1 = cpnet[path[0]][path[1]]
-        seen1 = set()
-        res1 = [r['rel'] for r in rel_list1.values() if r['rel'] not in seen1 and (seen1.add(r['rel']) or True)]
-        rel_list2 = cpnet[path[1]][path[2]]
-        seen2 = set()
-        res2 = [r['rel'] for r in rel_list2.values() if r['rel'] not in seen2 and (seen2.add(r['rel']) or True)]
-        res = [(r1, r2) for r1 in res1 for r2 in res2]
-        return res
-    else:
-        raise ValueError('Invalid path length')
-
-
-def find_paths_qa_concept_pair(source: str, target: str, ifprint=False):
+def find_relational_paths_qa_pair(qa_pair):
     """
-    find paths for a (question concept, answer concept) pair
-    source and target is text
+    collect the one-/two-hop paths of every (qc, ac) pair as candidates and expand them into
+    deduplicated relational paths with a single enumerate_relational_tuples call
     """
-    global cpnet, cpnet_simple, concept2id, id2concept, relation2id, id2relation
-
-    s = concept2id[source]
-    t = concept2id[target]
-
-    if s not in cpnet_simple.nodes() or t not in cpnet_simple.nodes():
-        return []
-
-    all_path = []
-    for p in nx.all_simple_paths(cpnet_simple, source=s, target=t, cutoff=2):
-        if len(p) >= 2:  # skip paths of length 1
-            all_path.append(p)
-
-    res = []
-    seen = set()
-    for p in all_path:
-        for rpath in get_rel_paths(p):
-            if rpath not in seen:
-                res.append({"qc": s, "ac": t, "rel": rpath})
-                seen.add(rpath)
-    return res
-
-
-def find_relational_paths_qa_pair(qa_pair):
     acs, qcs = qa_pair
     pfr_qa = {'acs': acs, 'qcs': qcs}
-    rel_list = []
+    indptr, indices = cpnet_csr
+    n_node = indptr.shape[0] - 1
+    cand_q, cand_a, hop1, hop2 = [], [], [], []
+    hop_rels, rel_offsets = [], [0]
+
+    def add_hop(u, v):
+        hop_rels.extend(path_utils.get_edge(u, v))
+        rel_offsets.append(len(hop_rels))
+        return len(rel_offsets) - 2
+
     for ac in acs:
         for qc in qcs:
-            rel_list += find_paths_qa_concept_pair(qc, ac)
-    pfr_qa['paths'] = rel_list
+            s, t = concept2id[qc], concept2id[ac]
+            if s == t or s >= n_node or t >= n_node:
+                continue
+            s_nbrs = indices[indptr[s]:indptr[s + 1]]
+            if np.any(s_nbrs == t):
+                cand_q.append(s)
+                cand_a.append(t)
+                hop1.append(add_hop(s, t))
+                hop2.append(-1)
+            for m in np.intersect1d(s_nbrs, indices[indptr[t]:indptr[t + 1]], assume_unique=True).tolist():
+                cand_q.append(s)
+                cand_a.append(t)
+                hop1.append(add_hop(s, m))
+                hop2.append(add_hop(m, t))
+    tuples = enumerate_relational_tuples(cand_q, cand_a, rel_offsets, hop_rels, hop1, hop2)
+    pfr_qa['paths'] = relational_tuples_to_json(*tuples)
     return pfr_qa
 
 
@@ -77,56 +58,7 @@ def find_relational_paths(cpnet_vocab_path, cpnet_graph_path, grounded_path, out
         print(f'using cached relational paths from {output_path}')
         return
 
-    def get_cpnet_simple(nx_graph):
-        cpnet_simple = nx.Graph()
-        for u, v, data in nx_graph.edges(data=True):
-            w = data['weight'] if 'weight' in data else 1.0
-            if cpnet_simple.has_edge(u, v):
-                cpnet_simple[u][v]['weight'] += w
-            else:
-                cpnet_simple.add_edge(u, v, weight=w)
-        return cpnet_simple
-
-    global concept2id, id2concept, relation2id, id2relation, cpnet_simple, cpnet
-    if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
-        with open(cpnet_vocab_path, 'r', encoding='utf-8') as fin:
-            id2concept = [w.strip() for w in fin]
-        concept2id = {w: i for i, w in enumerate(id2concept)}
-        id2relation = merged_relations.copy()
-        id2relation += ['*' + r for r in id2relation]
-        relation2id = {r: i for i, r in enumerate(id2relation)}
-    if cpnet is None or cpnet_simple is None:
-        cpnet = nx.read_gpickle(cpnet_graph_path)
-        cpnet_simple = get_cpnet_simple(cpnet)
-
-    with open(grounded_path, 'r') as fin:
-        data = [json.loads(line) for line in fin]
-    data = [[item["ac"], item["qc"]] for item in data]
-
-    with Pool(num_processes) as p, open(output_path, 'w') as fout:
-        for pfr_qa in tqdm(p.imap(find_relational_paths_qa_pair, data), total=len(data), desc='Finding relational paths'):
-            fout.write(json.dumps(pfr_qa) + '\n')
-
-    print(f'paths saved to {output_path}')
-    print()
-
-
-def find_relational_paths(cpnet_vocab_path, cpnet_graph_path, grounded_path, output_path, num_processes, use_cache):
-    if use_cache and os.path.exists(output_path):
-        print(f'using cached relational paths from {output_path}')
-        return
-
-    def get_cpnet_simple(nx_graph):
-        cpnet_simple = nx.Graph()
-        for u, v, data in nx_graph.edges(data=True):
-            w = data['weight'] if 'weight' in data else 1.0
-            if cpnet_simple.has_edge(u, v):
-                cpnet_simple[u][v]['weight'] += w
-            else:
-                cpnet_simple.add_edge(u, v, weight=w)
-        return cpnet_simple
-
-    global concept2id, id2concept, relation2id, id2relation, cpnet_simple, cpnet
+    global concept2id, id2concept, relation2id, id2relation, cpnet_simple, cpnet, cpnet_csr
     if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
         with open(cpnet_vocab_path, 'r', encoding='utf-8') as fin:
             id2concept = [w.strip() for w in fin]
@@ -134,9 +66,11 @@ def find_relational_paths(cpnet_vocab_path, cpnet_graph_path, grounded_path, out
         id2relation = merged_relations.copy()
         id2relation += ['*' + r for r in id2relation]
         relation2id = {r: i for i, r in enumerate(id2relation)}
-    if cpnet is None or cpnet_simple is None:
-        cpnet = nx.read_gpickle(cpnet_graph_path)
-        cpnet_simple = get_cpnet_simple(cpnet)
+    if cpnet is None or cpnet_csr is None or path_utils.cpnet_path != cpnet_graph_path:
+        # the graph is loaded once per file and shared with utils.paths, whose CSR adjacency replaces all_simple_paths
+        if path_utils.cpnet is None or path_utils.cpnet_path != cpnet_graph_path:
+            path_utils.load_cpnet(cpnet_graph_path)
+        cpnet, cpnet_simple, cpnet_csr = path_utils.cpnet, path_utils.cpnet_simple, path_utils.cpnet_csr
 
     with open(grounded_path, 'r') as fin:
         data = [json.loads(line) for line in fin]
@@ -0,0 +1,168 @@
+import pickle
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from .packed_utils import PackedWriter, load_packed
+except ImportError:
+    from packed_utils import PackedWriter, load_packed
+
+__all__ = ['TripleStoreWriter', 'TripleStore', 'open_triple_writer', 'load_triples', 'is_triple_store',
+           'pickle_to_triple_store']
+
+TRIPLE_STORE_EXT = '.bin'
+
+
+def is_triple_store(path):
+    return path.endswith(TRIPLE_STORE_EXT)
+
+
+class TripleStoreWriter(object):
+    """
+    streaming binary replacement for the pickled (triples, mc_triple_num) files
+
+    Every sample is a list of (relation, head, tail) triples. The store keeps
+        offsets, head, rel, tail, mc_triple_num
+    where the triples of sample i are head/rel/tail[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, path):
+        self.writer = PackedWriter(path, {'offsets': np.int64, 'head': np.int32, 'rel': np.int32, 'tail': np.int32,
+                                          'mc_triple_num': np.int64},
+                                   meta={'format': 'triples', 'version': 1})
+        self.n_triple = 0
+        self.writer.append('offsets', [0])
+
+    def write(self, rel, head, tail, mc_triple_num):
+        self.writer.append('head', head)
+        self.writer.append('rel', rel)
+        self.writer.append('tail', tail)
+        self.writer.append('mc_triple_num', [mc_triple_num])
+        self.n_triple += len(head)
+        self.writer.append('offsets', [self.n_triple])
+
+    def write_many(self, rel, head, tail, counts, mc_triple_num):
+        """
+        write several samples at once, counts gives the number of triples of every sample in the concatenated arrays
+        """
+        self.writer.append('head', head)
+        self.writer.append('rel', rel)
+        self.writer.append('tail', tail)
+        self.writer.append('mc_triple_num', mc_triple_num)
+        self.writer.append('offsets', self.n_triple + np.cumsum(counts))
+        self.n_triple += int(np.sum(counts))
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.abort()
+
+
+class TripleStore(object):
+    """
+    memory-mapped reader of a file written by TripleStoreWriter, indexing returns (rel, head, tail) like the pickled lists
+    """
+
+    def __init__(self, path, mmap=True):
+        arrays, self.meta = load_packed(path, mmap=mmap)
+        if self.meta.get('format') != 'triples':
+            raise ValueError(f'{path} is not a triple store')
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx:idx + 2].tolist()
+        return np.array(self.rel[start:end]), np.array(self.head[start:end]), np.array(self.tail[start:end])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def num_triples(self):
+        return np.diff(self.offsets)
+
+    def padded(self, indices, max_triple_num):
+        """
+        indices: array-like of sample indices
+        returns: (np.ndarray of shape (len(indices), max_triple_num * 3) holding (head, rel, tail) of the first
+                  max_triple_num triples of every sample and zeros after them, np.ndarray of the number of triples kept)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        counts = np.minimum(self.offsets[indices + 1] - starts, max_triple_num)
+        row_offsets = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(indices.shape[0]), counts)
+        cols = np.arange(rows.shape[0]) - np.repeat(row_offsets, counts)
+        pos = np.repeat(starts, counts) + cols
+        res = np.zeros((indices.shape[0], max_triple_num, 3), dtype=np.int64)
+        res[rows, cols, 0] = self.head[pos]
+        res[rows, cols, 1] = self.rel[pos]
+        res[rows, cols, 2] = self.tail[pos]
+        return res.reshape(indices.shape[0], max_triple_num * 3), counts
+
+
+class PickleTripleWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.triples = []
+        self.mc_triple_num = []
+
+    def write(self, rel, head, tail, mc_triple_num):
+        self.triples.append((rel, head, tail))
+        self.mc_triple_num.append(mc_triple_num)
+
+    def write_many(self, rel, head, tail, counts, mc_triple_num):
+        splits = np.cumsum(counts)[:-1]
+        for i, j, k, mc_num in zip(np.split(rel, splits), np.split(head, splits), np.split(tail, splits), list(mc_triple_num)):
+            self.write(i, j, k, mc_num)
+
+    def close(self):
+        with open(self.path, 'wb') as fout:
+            pickle.dump((self.triples, self.mc_triple_num), fout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def open_triple_writer(path):
+    """
+    returns: a TripleStoreWriter if path ends with .bin, otherwise a writer of the pickled format
+    """
+    if is_triple_store(path):
+        return TripleStoreWriter(path)
+    return PickleTripleWriter(path)
+
+
+def load_triples(path):
+    """
+    returns: (triples, mc_triple_num), triples is a TripleStore for .bin files and a list of (rel, head, tail) otherwise
+    """
+    if is_triple_store(path):
+        store = TripleStore(path)
+        return store, store.mc_triple_num
+    with open(path, 'rb') as fin:
+        return pickle.load(fin)
+
+
+def pickle_to_triple_store(pk_path, output_path):
+    triples, mc_triple_num = load_triples(pk_path)
+    with TripleStoreWriter(output_path) as writer:
+        for (i, j, k), mc_num in tqdm(zip(triples, mc_triple_num), total=len(triples), desc='converting triples'):
+            writer.write(i, j, k, mc_num)
+    print(f'triple store saved to {output_path}')
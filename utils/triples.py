@@ -1,5 +1,5 @@
+import time
 import torch
-import pickle
 import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool
@@ -12,9 +12,15 @@ try:
 except ModuleNotFoundError:
     from conceptnet import merged_relations
 try:
-    from .utils import check_path
+    from .utils import check_path, sharded_imap
 except:
-    from utils import check_path
+    from utils import check_path, sharded_imap
+try:
+    from .adj_store import AdjStore, load_adj_concept_pairs, is_adj_store
+    from .triple_store import open_triple_writer, load_triples
+except ImportError:
+    from adj_store import AdjStore, load_adj_concept_pairs, is_adj_store
+    from triple_store import open_triple_writer, load_triples
 import json
 
 MODEL_CLASSES = {
@@ -41,62 +47,101 @@ def load_resources(cpnet_vocab_path):
     relation2id = {r: i for i, r in enumerate(id2relation)}
 
 
-def generate_triples_from_adj(adj_pk_path, mentioned_cpt_path, cpnet_vocab_path, triple_path):
+adj_stores = {}  # per-process AdjStore of every adjacency file a shard refers to
+
+
+def flatten_adj_shard(adj_shard):
+    """
+    adj_shard: list of (adj, concepts, qm, am) or (path of an AdjStore, start, end)
+    returns: (node_offsets, concepts, edge_samples, rel, src, dst) of the concatenated instances, src and dst index
+             into the concepts of the instance edge_samples
+    """
+    if isinstance(adj_shard, tuple):
+        path, start, end = adj_shard
+        if path not in adj_stores:
+            adj_stores[path] = AdjStore(path)
+        store = adj_stores[path]
+        node_offsets = store.node_offsets[start:end + 1] - store.node_offsets[start]
+        e_start, e_end = store.edge_offsets[start], store.edge_offsets[end]
+        edge_samples = np.repeat(np.arange(end - start), np.diff(store.edge_offsets[start:end + 1]))
+        concepts = np.asarray(store.concepts[store.node_offsets[start]:store.node_offsets[end]], dtype=np.int64)
+        return (node_offsets, concepts, edge_samples, np.asarray(store.rel[e_start:e_end], dtype=np.int64),
+                np.asarray(store.src[e_start:e_end], dtype=np.int64), np.asarray(store.dst[e_start:e_end], dtype=np.int64))
+    n_nodes = [adj[0].shape[1] for adj in adj_shard]
+    node_offsets = np.zeros(len(adj_shard) + 1, dtype=np.int64)
+    np.cumsum(n_nodes, out=node_offsets[1:])
+    rows = [adj[0].row.astype(np.int64) for adj in adj_shard]
+    edge_samples = np.repeat(np.arange(len(adj_shard)), [r.shape[0] for r in rows])
+    n_node = np.repeat(np.maximum(n_nodes, 1), [r.shape[0] for r in rows])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    concepts = np.concatenate([np.asarray(adj[1], dtype=np.int64) for adj in adj_shard]) if adj_shard else np.zeros(0, dtype=np.int64)
+    dst = np.concatenate([adj[0].col.astype(np.int64) for adj in adj_shard]) if adj_shard else np.zeros(0, dtype=np.int64)
+    return node_offsets, concepts, edge_samples, rows // n_node, rows % n_node, dst
+
+
+def partition_triples_shard(data):
+    """
+    turn the adjacency matrices of a shard of instances into triples with array operations over the whole shard
+
+    data: (adj_shard, mentioned) where mentioned is the list of mentioned concept ids of every instance
+    returns: (rel, head, tail, counts, mc_counts) of the concatenated instances; the triples of every instance are ordered
+             as mentioned-mentioned, mentioned-other and other-other triples, mc_counts counts the first two groups
+    """
+    adj_shard, mentioned = data
+    node_offsets, concepts, edge_samples, rel, src, dst = flatten_adj_shard(adj_shard)
+    head_nodes = node_offsets[edge_samples] + src
+    tail_nodes = node_offsets[edge_samples] + dst
+
+    # whether every node is a mentioned concept of its instance, looked up in the sorted (instance, concept) keys
+    mc_samples = np.repeat(np.arange(len(mentioned)), [len(mc) for mc in mentioned])
+    mc_keys = np.sort((mc_samples << 32) | np.array([c for mc in mentioned for c in mc], dtype=np.int64))
+    node_keys = (np.repeat(np.arange(len(mentioned)), np.diff(node_offsets)) << 32) | concepts
+    pos = np.minimum(np.searchsorted(mc_keys, node_keys), max(mc_keys.shape[0] - 1, 0))
+    node_mc = (mc_keys[pos] == node_keys) if mc_keys.shape[0] > 0 else np.zeros(node_keys.shape[0], dtype=np.bool_)
+
+    group = 2 - node_mc[head_nodes].astype(np.int64) - node_mc[tail_nodes]  # 0: mc2mc, 1: mc2nmc, 2: others
+    order = np.argsort(edge_samples * 3 + group, kind='stable')  # keeps the adjacency order within every group
+    head, tail = concepts[head_nodes], concepts[tail_nodes]
+
+    counts = np.bincount(edge_samples, minlength=len(mentioned))
+    mc_counts = np.bincount(edge_samples[group < 2], minlength=len(mentioned))
+    return rel[order].astype(np.int32), head[order].astype(np.int32), tail[order].astype(np.int32), counts, mc_counts
+
+
+def generate_triples_from_adj(adj_pk_path, mentioned_cpt_path, cpnet_vocab_path, triple_path, num_processes=1, shard_size=1000):
+    """
+    triples of every instance are (relation, head, tail) of the edges of its adjacency matrix, written to triple_path
+    as soon as the shard of the instance is processed
+    """
     global concept2id, id2concept, relation2id, id2relation
     if any(x is None for x in [concept2id, id2concept, relation2id, id2relation]):
         load_resources(cpnet_vocab_path)
 
-    with open(mentioned_cpt_path, 'r') as fin:
-        data = [json.loads(line) for line in fin]
-    mentioned_concepts = [([concept2id[ac] for ac in item["ac"]] + [concept2id[qc] for qc in item["qc"]]) for item in data]
-
-    with open(adj_pk_path, 'rb') as fin:
-        adj_concept_pairs = pickle.load(fin)
-
-    n_samples = len(adj_concept_pairs)
-    triples = []
-    mc_triple_num = []
-    for idx, (adj_data, mc) in tqdm(enumerate(zip(adj_concept_pairs, mentioned_concepts)),
-                                    total=n_samples, desc='loading adj matrices'):
-        adj, concepts, _, _ = adj_data
-        mapping = {i: (concepts[i]) for i in range(len(concepts))}  # index to corresponding grounded concept id
-        ij = adj.row
-        k = adj.col
-        n_node = adj.shape[1]
-        if n_node != 0:
-            n_rel = 2 * adj.shape[0] // n_node
-            i, j = ij // n_node, ij % n_node
-        else:
-            n_rel = 2 * adj.shape[0]
-            i, j = ij, ij
-
-        j = np.array([mapping[j[idx]] for idx in range(len(j))])
-        k = np.array([mapping[k[idx]] for idx in range(len(k))])
-
-        mc2mc_mask = np.isin(j, mc) & np.isin(k, mc)
-        mc2nmc_mask = np.isin(j, mc) | np.isin(k, mc)
-        others_mask = np.invert(mc2nmc_mask)
-        mc2nmc_mask = ~mc2mc_mask & mc2nmc_mask
-        mc2mc = i[mc2mc_mask], j[mc2mc_mask], k[mc2mc_mask]
-        mc2nmc = i[mc2nmc_mask], j[mc2nmc_mask], k[mc2nmc_mask]
-        others = i[others_mask], j[others_mask], k[others_mask]
-        [i, j, k] = [np.concatenate((a, b, c), axis=-1) for (a, b, c) in zip(mc2mc, mc2nmc, others)]
-        triples.append((i, j, k))
-        mc_triple_num.append(len(mc2mc) + len(mc2nmc))
-
-        # i, j, k = np.concatenate((i, i + n_rel // 2), 0), np.concatenate((j, k), 0), np.concatenate((k, j), 0)  # add inverse relations
-        # mask = np.isin(j, mc)
-        # inverted_mask = np.invert(mask)
-        # masked = i[mask], j[mask], k[mask]
-        # mc_triple_num.append(len(masked[0]))
-        # remaining = i[inverted_mask], j[inverted_mask], k[inverted_mask]
-        # [i, j, k] = [np.concatenate((m, r), axis=-1) for (m, r) in zip(masked, remaining)]
-        # triples.append((i, j, k))  # i: relation, j: head, k: tail
+    start_time = time.time()
+    adj_concept_pairs = None if is_adj_store(adj_pk_path) else load_adj_concept_pairs(adj_pk_path)
+    n_samples = len(AdjStore(adj_pk_path)) if adj_concept_pairs is None else len(adj_concept_pairs)
+
+    def shards():
+        with open(mentioned_cpt_path, 'r') as fin:
+            for a in range(0, n_samples, shard_size):
+                b = min(n_samples, a + shard_size)
+                mentioned = []
+                for _ in range(b - a):
+                    item = json.loads(next(fin))
+                    mentioned.append([concept2id[ac] for ac in item["ac"]] + [concept2id[qc] for qc in item["qc"]])
+                yield ((adj_pk_path, a, b) if adj_concept_pairs is None else adj_concept_pairs[a:b]), mentioned
 
     check_path(triple_path)
-    with open(triple_path, 'wb') as fout:
-        pickle.dump((triples, mc_triple_num), fout)
-        print(f"Triples saved to {triple_path}")
+    n_triples = 0
+    with Pool(num_processes) as p, open_triple_writer(triple_path) as writer:
+        # at most 2 * num_processes shards are read ahead of the writer
+        for rel, head, tail, counts, mc_counts in tqdm(sharded_imap(p, partition_triples_shard, shards(), 2 * num_processes), total=-(-n_samples // shard_size),
+                                                       desc='generating triples'):
+            writer.write_many(rel, head, tail, counts, mc_counts.tolist())
+            n_triples += rel.shape[0]
+
+    print(f"Triples saved to {triple_path} ({n_samples} instances, {n_triples} triples, {time.time() - start_time:.2f}s)")
+    print()
 
 
 def load_templates(str_template_path):
@@ -143,8 +188,7 @@ def generate_triple_string(str_template_path, cpnet_vocab_path, triple_path, out
         load_resources(cpnet_vocab_path)
     if template is None:
         load_templates(str_template_path=str_template_path)
-    with open(triple_path, 'rb') as fin:
-        triples, _ = pickle.load(fin)
+    triples, _ = load_triples(triple_path)
     with Pool(num_processes) as p, open(output_path, 'w') as fout:
         for res in tqdm(p.imap(generate_triple_string_per_inst, triples), total=len(triples)):
             fout.write(json.dumps(res) + '\n')
@@ -2,6 +2,7 @@ import json
 import os
 import time
 import argparse
+import itertools
 
 
 def bool_flag(v):
@@ -40,6 +41,17 @@ def unfreeze_net(module):
         p.requires_grad = True
 
 
+def sharded_imap(pool, func, iterable, shard_size):
+    """
+    pool.imap over iterable that hands the pool shard_size items at a time and yields all results of a shard
+    before reading the next one, so at most shard_size inputs and results are in memory
+    (pool.imap alone consumes its whole input at once)
+    """
+    iterator = iter(iterable)
+    for shard in iter(lambda: list(itertools.islice(iterator, shard_size)), []):
+        yield from pool.imap(func, shard)
+
+
 def test_data_loader_ms_per_batch(data_loader, max_steps=10000):
     start = time.time()
     n_batch = sum(1 for batch, _ in zip(data_loader, range(max_steps)))